@@ -0,0 +1,187 @@
+"""
+Local stand-in for the boto3 S3 client used by the benchmarks.
+
+Buckets are directories under `root` and keys are file paths inside them. Only the calls the
+thumbnail scripts make are implemented: head_object, get_object (with Range), download_file,
+download_fileobj, put_object, list_objects_v2 (first page only) and its paginator (with Delimiter). ETags are the MD5 of the content, like
+single-part uploads on S3.
+
+Every call is counted with the bytes it moved, so a benchmark can report the requests and
+bytes a code path would have transferred from and to S3.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+
+class LocalS3:
+    class exceptions:
+        ClientError = ClientError
+
+    def __init__(self, root):
+        """
+        Args:
+        - root (str): Directory holding one sub-directory per bucket.
+        """
+        self.root = root
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_in = 0   # Bytes read from S3 (GET, download_file)
+        self.bytes_out = 0  # Bytes written to S3 (PUT)
+        self.etags = {}
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def counters(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+    def _count(self, operation, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.requests[operation] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def _path(self, bucket_name, key):
+        return os.path.join(self.root, bucket_name, key)
+
+    def _not_found(self, operation, key):
+        return ClientError({'Error': {'Code': 'NoSuchKey' if operation == 'GetObject' else '404', 'Message': f'Not Found: {key}'}}, operation)
+
+    def _etag(self, path):
+        # MD5 is cached by (path, mtime, size) so repeated HEADs of large videos stay cheap
+        stat = os.stat(path)
+        cache_key = (path, stat.st_mtime_ns, stat.st_size)
+        etag = self.etags.get(cache_key)
+        if etag is None:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    md5.update(chunk)
+            etag = f'"{md5.hexdigest()}"'
+            self.etags[cache_key] = etag
+        return etag
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        self._count('HeadObject')
+        if not os.path.isfile(path):
+            raise self._not_found('HeadObject', Key)
+        return {'ContentLength': os.path.getsize(path), 'ETag': self._etag(path)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            self._count('GetObject')
+            raise self._not_found('GetObject', Key)
+        with open(path, 'rb') as f:
+            if Range:
+                start, end = Range[len('bytes='):].split('-')
+                f.seek(int(start))
+                data = f.read(int(end) - int(start) + 1)
+            else:
+                data = f.read()
+        self._count('GetObject', bytes_in=len(data))
+        return {'Body': _Body(data), 'ContentLength': len(data), 'ETag': self._etag(path)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            self._count('GetObject')
+            raise self._not_found('GetObject', Key)
+        shutil.copyfile(path, Filename)
+        self._count('GetObject', bytes_in=os.path.getsize(path))
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            self._count('GetObject')
+            raise self._not_found('GetObject', Key)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+        self._count('GetObject', bytes_in=os.path.getsize(path))
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000, **kwargs):
+        return next(iter(self.get_paginator('list_objects_v2').paginate(
+            Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter, PaginationConfig={'PageSize': MaxKeys}
+        )))
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode()
+        elif not isinstance(Body, (bytes, bytearray)):
+            Body = Body.read()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        self._count('PutObject', bytes_out=len(Body))
+        return {'ETag': f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return _ListObjectsV2Paginator(self)
+
+
+class _Body:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, amount=None):
+        data, self.data = (self.data, b'') if amount is None else (self.data[:amount], self.data[amount:])
+        return data
+
+    def close(self):
+        self.data = b''
+
+
+class _ListObjectsV2Paginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, PaginationConfig=None, **kwargs):
+        bucket_root = os.path.join(self.client.root, Bucket)
+        keys = set()
+        for directory, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(directory, filename), bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    # With a delimiter, keys below the next one are rolled up into a common prefix
+                    if Delimiter and Delimiter in key[len(Prefix):]:
+                        key = key[:key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                    keys.add(key)
+        keys = sorted(keys)
+        page_size = (PaginationConfig or {}).get('PageSize') or 1000
+        for start in range(0, max(len(keys), 1), page_size):
+            self.client._count('ListObjectsV2')
+            contents = []
+            common_prefixes = []
+            for key in keys[start:start + page_size]:
+                if Delimiter and key.endswith(Delimiter):
+                    common_prefixes.append({'Prefix': key})
+                    continue
+                path = os.path.join(bucket_root, key)
+                stat = os.stat(path)
+                contents.append({
+                    'Key': key,
+                    'Size': stat.st_size,
+                    'ETag': self.client._etag(path),
+                    'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+                })
+            page = {'KeyCount': len(contents) + len(common_prefixes), 'IsTruncated': start + page_size < len(keys)}
+            if contents:
+                page['Contents'] = contents
+            if common_prefixes:
+                page['CommonPrefixes'] = common_prefixes
+            yield page
@@ -0,0 +1,390 @@
+"""
+End-to-end benchmark of the thumbnail code paths on synthetic videos and a local S3 stand-in.
+
+It performs the following steps:
+1. Generates synthetic MP4s with the bundled FFmpeg and the lavfi test sources, for every
+   combination of duration, resolution, GOP size and layout (faststart or moov at the end).
+   Videos already in --video-dir are reused.
+2. Uploads them to a directory-backed S3 stand-in (benchmarks/local_s3.py).
+3. Runs each video through:
+   - all:       thumbnail_generator_all.process_videos
+   - lambda:    lambda_thumbnail_generator.lambda_handler, cold and then warm (/tmp cache kept)
+   - on-demand: thumbnail_on-demand process_video, cold and then warm (manifest hit)
+4. Reports per run the wall and CPU time (including FFmpeg child processes), the latency of
+   every stage, the requests and bytes transferred from and to S3 and the peak disk usage of
+   the scratch files under /tmp.
+
+Stages are timed by wrapping the functions that implement them, so nested stages overlap:
+the render stage of the `all` path includes the probe and frame selection.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py [--durations 60 420] [--resolutions 1280x720 1920x1080]
+        [--gops 2 10] [--layouts faststart moov-at-end] [--paths all lambda on-demand]
+        [--backend auto] [--video-dir DIR] [--json results.json]
+"""
+
+import argparse
+import contextlib
+import glob
+import importlib.util
+import io
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# The scripts create their boto3 clients at import time, a region is all they need offline
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import decode_backend
+import frame_selection
+import lambda_thumbnail_generator
+import thumbnail_generator_all
+import tmp_cache
+import video_probe
+from local_s3 import LocalS3
+from resize_benchmark import quiet_stderr
+from tmp_cache import SourceVideoCache
+
+BUNDLED_FFMPEG = os.path.join(REPO_ROOT, 'ffmpeg-7.0.1-amd64-static', 'ffmpeg')
+BUNDLED_FFPROBE = os.path.join(REPO_ROOT, 'ffmpeg-7.0.1-amd64-static', 'ffprobe')
+
+SOURCE_BUCKET = 'bench-source'
+DESTINATION_BUCKET = 'bench-thumbnails'
+
+# Stage columns of the report, in order
+STAGES = ['download', 'probe', 'select', 'render', 'upload', 'manifest']
+
+
+def load_on_demand():
+    """Imports thumbnail_on-demand/thumbnail_on-demand.py, whose name is not a valid module name."""
+    path = os.path.join(REPO_ROOT, 'thumbnail_on-demand', 'thumbnail_on-demand.py')
+    spec = importlib.util.spec_from_file_location('thumbnail_on_demand', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def video_name(duration, width, height, gop, layout):
+    return f'bench-{height}p-{duration}s-gop{gop}-{"fs" if layout == "faststart" else "nofs"}'
+
+
+def generate_video(ffmpeg_path, video_path, duration, width, height, gop, layout, rate=25):
+    """Generates an H.264 test video with a keyframe every `gop` seconds."""
+    ffmpeg_command = [
+        ffmpeg_path, '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={rate}:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '28', '-g', str(gop * rate), '-keyint_min', str(gop * rate),
+        '-pix_fmt', 'yuv420p'
+    ]
+    if layout == 'faststart':
+        ffmpeg_command += ['-movflags', '+faststart']
+    subprocess.run(ffmpeg_command + [video_path], check=True)
+
+
+class TmpUsageSampler:
+    def __init__(self, patterns, interval=0.01):
+        """
+        Polls the disk usage of the files matching `patterns` and keeps the peak.
+
+        Args:
+        - patterns (list): Glob patterns of the scratch files and directories to watch.
+        - interval (float): Seconds between samples.
+        """
+        self.patterns = patterns
+        self.interval = interval
+        self.peak = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def usage(self):
+        total = 0
+        for pattern in self.patterns:
+            for path in glob.glob(pattern):
+                paths = [path] if os.path.isfile(path) else (
+                    os.path.join(directory, filename) for directory, _, filenames in os.walk(path) for filename in filenames
+                )
+                for file_path in paths:
+                    try:
+                        # Blocks actually allocated, the fetched videos are sparse
+                        total += os.stat(file_path).st_blocks * 512
+                    except FileNotFoundError:
+                        pass
+        return total
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.peak = max(self.peak, self.usage())
+            self.stopping.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.usage())
+
+
+class StageTimer:
+    def __init__(self, stages):
+        """
+        Wraps the functions implementing each stage and records the wall time of every call.
+
+        Args:
+        - stages (list): (stage, owner, attribute) entries; owner is a module or a class.
+        """
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.originals = []
+
+    def _wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.timings[stage].append(time.perf_counter() - started)
+        return timed
+
+    def __enter__(self):
+        for stage, owner, attribute in self.stages:
+            function = getattr(owner, attribute)
+            self.originals.append((owner, attribute, function))
+            setattr(owner, attribute, self._wrap(stage, function))
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, attribute, function in reversed(self.originals):
+            setattr(owner, attribute, function)
+        self.originals = []
+
+    def totals(self):
+        """Returns the total seconds spent in each stage."""
+        return {stage: sum(timings) for stage, timings in self.timings.items()}
+
+
+def cpu_seconds():
+    """User and system CPU time of this process and of its finished child processes (FFmpeg)."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(s3, stages, tmp_patterns, run):
+    """
+    Runs `run()` with the stages timed, the S3 calls counted and /tmp sampled.
+
+    Returns:
+    - metrics (dict): wall and cpu seconds, per-stage seconds, S3 counters and peak /tmp bytes.
+    """
+    s3.reset_counters()
+    cpu_started = cpu_seconds()
+    started = time.perf_counter()
+    output = io.StringIO()
+    with TmpUsageSampler(tmp_patterns) as sampler, StageTimer(stages) as timer, \
+            contextlib.redirect_stdout(output), quiet_stderr():
+        error = None
+        try:
+            run()
+        except Exception as e:
+            error = str(e)
+    metrics = {
+        'wall': time.perf_counter() - started,
+        'cpu': cpu_seconds() - cpu_started,
+        'stages': timer.totals(),
+        'peak_tmp_bytes': sampler.peak,
+        'error': error,
+        'log': output.getvalue()
+    }
+    metrics.update(s3.counters())
+    return metrics
+
+
+def reset_destination(s3_root):
+    shutil.rmtree(os.path.join(s3_root, DESTINATION_BUCKET), ignore_errors=True)
+
+
+def run_all(s3, s3_root, video_key, tmp_patterns):
+    module = thumbnail_generator_all
+    module.s3 = s3
+    module.source_bucket_name = f'{SOURCE_BUCKET}-{video_key.split("/")[1]}'
+    module.destination_bucket_name = DESTINATION_BUCKET
+    module.state_db_path = None
+    module.catalog_path = None
+    module.probe_cache = video_probe.ProbeCache(ffprobe_path=module.ffprobe_path)
+    reset_destination(s3_root)
+
+    stages = [
+        ('download', module, 'download_video'),
+        ('probe', video_probe.ProbeCache, 'get'),
+        ('select', frame_selection, 'select_frame'),
+        ('render', module, 'render_thumbnails'),
+        ('upload', module, 'upload_thumbnails'),
+    ]
+
+    def run():
+        summary = module.process_videos()
+        if summary['processed'] != 1:
+            raise RuntimeError(f'Pipeline summary {summary}')
+    return [('cold', measure(s3, stages, tmp_patterns, run))]
+
+
+def run_lambda(s3, s3_root, video_key, tmp_patterns, scratch_dir):
+    module = lambda_thumbnail_generator
+    module.s3 = s3
+    module.source_bucket_name = f'{SOURCE_BUCKET}-{video_key.split("/")[1]}'
+    module.destination_bucket_name = DESTINATION_BUCKET
+    module.source_cache = SourceVideoCache(os.path.join(scratch_dir, 'source-cache'))
+    module.probe_cache = video_probe.ProbeCache(os.path.join(scratch_dir, 'probe-cache'), module.ffprobe_path)
+    reset_destination(s3_root)
+
+    stages = [
+        ('download', tmp_cache, 'fetch_video'),
+        ('probe', video_probe.ProbeCache, 'get'),
+        ('select', frame_selection, 'select_frame'),
+        ('render', decode_backend, 'render_thumbnails'),
+        ('render', decode_backend.FFmpegReader, 'encode_frames'),
+        ('upload', module, 's3_upload_bytes'),
+    ]
+    event = {'Records': [{'s3': {'bucket': {'name': module.source_bucket_name}, 'object': {'key': video_key}}}]}
+
+    def run():
+        response = module.lambda_handler(event, None)
+        if response['statusCode'] != 200:
+            raise RuntimeError(response['body'])
+    return [(run_label, measure(s3, stages, tmp_patterns, run)) for run_label in ('cold', 'warm')]
+
+
+def run_on_demand(module, s3, s3_root, video_key, tmp_patterns, scratch_dir, time_frames):
+    module.s3 = s3
+    module.SOURCE_CACHE = SourceVideoCache(os.path.join(scratch_dir, 'source-cache'))
+    module.PROBE_CACHE = video_probe.ProbeCache(os.path.join(scratch_dir, 'probe-cache'), module.FFPROBE_PATH)
+    source_bucket_name = f'{SOURCE_BUCKET}-{video_key.split("/")[1]}'
+    reset_destination(s3_root)
+    shutil.rmtree(os.path.join(s3_root, module.MANIFEST_BUCKET or ''), ignore_errors=True)
+
+    stages = [
+        ('download', tmp_cache, 'fetch_video'),
+        ('probe', video_probe.ProbeCache, 'get'),
+        ('render', decode_backend, 'render_thumbnails'),
+        ('render', decode_backend.FFmpegReader, 'encode_frames'),
+        ('upload', module, 's3_upload'),
+        ('manifest', module, 'load_manifest'),
+        ('manifest', module, 'save_manifest'),
+    ]
+
+    def run():
+        module.process_video(source_bucket_name, video_key, DESTINATION_BUCKET, time_frames, [], 'benchmark')
+    return [(run_label, measure(s3, stages, tmp_patterns, run)) for run_label in ('cold', 'warm')]
+
+
+def print_report(rows):
+    header = (
+        f'{"path":<10} {"video":<28} {"run":<5} {"wall s":>7} {"cpu s":>7} '
+        + ' '.join(f'{stage + " ms":>11}' for stage in STAGES)
+        + f' {"GET MiB":>8} {"GETs":>5} {"PUT KiB":>8} {"PUTs":>5} {"tmp MiB":>8}'
+    )
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        metrics = row['metrics']
+        stages = ' '.join(
+            f'{metrics["stages"][stage] * 1000:>11.1f}' if stage in metrics['stages'] else f'{"-":>11}' for stage in STAGES
+        )
+        requests = metrics['requests']
+        print(
+            f'{row["path"]:<10} {row["video"]:<28} {row["run"]:<5} {metrics["wall"]:>7.2f} {metrics["cpu"]:>7.2f} {stages}'
+            f' {metrics["bytes_in"] / 1024 ** 2:>8.2f} {requests.get("GetObject", 0):>5}'
+            f' {metrics["bytes_out"] / 1024:>8.1f} {requests.get("PutObject", 0):>5}'
+            f' {metrics["peak_tmp_bytes"] / 1024 ** 2:>8.2f}'
+        )
+        if metrics['error']:
+            print(f'    error: {metrics["error"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--durations', type=int, nargs='+', default=[60, 420], help='Video lengths in seconds')
+    parser.add_argument('--resolutions', nargs='+', default=['1280x720', '1920x1080'])
+    parser.add_argument('--gops', type=int, nargs='+', default=[2, 10], help='Seconds between keyframes')
+    parser.add_argument('--layouts', nargs='+', default=['faststart', 'moov-at-end'], choices=['faststart', 'moov-at-end'])
+    parser.add_argument('--paths', nargs='+', default=['all', 'lambda', 'on-demand'], choices=['all', 'lambda', 'on-demand'])
+    parser.add_argument('--backend', default='auto', choices=['auto', 'pyav', 'ffmpeg'], help='Decode backend of every path')
+    parser.add_argument('--time-frames', nargs='+', default=None, help='Time frames to capture, the scripts\' own when omitted')
+    parser.add_argument('--ffmpeg', default=BUNDLED_FFMPEG if os.path.exists(BUNDLED_FFMPEG) else 'ffmpeg')
+    parser.add_argument('--ffprobe', default=BUNDLED_FFPROBE if os.path.exists(BUNDLED_FFPROBE) else 'ffprobe')
+    parser.add_argument('--video-dir', help='Directory where the synthetic videos are kept between runs')
+    parser.add_argument('--json', help='Write every measurement to this JSON file')
+    args = parser.parse_args()
+
+    on_demand = load_on_demand() if 'on-demand' in args.paths else None
+    time_frames = args.time_frames or thumbnail_generator_all.time_frames
+    for module in (thumbnail_generator_all, lambda_thumbnail_generator):
+        module.ffmpeg_path = args.ffmpeg
+        module.ffprobe_path = args.ffprobe
+        module.decode_backend_name = args.backend
+        module.time_frames = time_frames
+    if on_demand is not None:
+        on_demand.FFMPEG_PATH = args.ffmpeg
+        on_demand.FFPROBE_PATH = args.ffprobe
+        on_demand.DECODE_BACKEND = args.backend
+
+    with tempfile.TemporaryDirectory(prefix='thumbnail-bench-', dir='/tmp') as scratch_dir:
+        video_dir = args.video_dir or os.path.join(scratch_dir, 'videos')
+        os.makedirs(video_dir, exist_ok=True)
+        s3_root = os.path.join(scratch_dir, 's3')
+        s3 = LocalS3(s3_root)
+
+        rows = []
+        matrix = itertools.product(args.durations, args.resolutions, args.gops, args.layouts)
+        for duration, resolution, gop, layout in matrix:
+            width, height = (int(value) for value in resolution.split('x'))
+            name = video_name(duration, width, height, gop, layout)
+            video_path = os.path.join(video_dir, f'{name}.mp4')
+            if not os.path.exists(video_path):
+                print(f'Generating {name}...', flush=True)
+                generate_video(args.ffmpeg, video_path, duration, width, height, gop, layout)
+
+            # One bucket per video, so process_videos only sees this one
+            video_key = f'bench/{name}/1/video/{name}.mp4'
+            source_path = os.path.join(s3_root, f'{SOURCE_BUCKET}-{name}', video_key)
+            os.makedirs(os.path.dirname(source_path), exist_ok=True)
+            shutil.copyfile(video_path, source_path)
+
+            # Scratch files of every path: the per-video job directory and the /tmp caches
+            cache_dir = os.path.join(scratch_dir, 'cache')
+            tmp_patterns = [os.path.join('/tmp', f'{name}-*'), cache_dir]
+            for path in args.paths:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                if path == 'all':
+                    results = run_all(s3, s3_root, video_key, tmp_patterns)
+                elif path == 'lambda':
+                    results = run_lambda(s3, s3_root, video_key, tmp_patterns, cache_dir)
+                else:
+                    results = run_on_demand(on_demand, s3, s3_root, video_key, tmp_patterns, cache_dir, time_frames)
+                for run_label, metrics in results:
+                    rows.append({'path': path, 'video': name, 'run': run_label, 'metrics': metrics})
+
+            shutil.rmtree(os.path.join(s3_root, f'{SOURCE_BUCKET}-{name}'), ignore_errors=True)
+
+        print_report(rows)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump([{**row, 'metrics': {k: v for k, v in row['metrics'].items() if k != 'log'}} for row in rows], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Micro-benchmark of the thumbnail resizing strategies.
+
+It compares, for one time frame of one video:
+1. per-size FFmpeg: one FFmpeg process per thumbnail size (the original behaviour), used as the
+   quality reference.
+2. split FFmpeg: one FFmpeg process that decodes once and scales every size (split/scale graph).
+3. The decode backends scaling every size from the full-resolution frame.
+4. The decode backends decoding at the largest size and deriving the smaller ones with Pillow.
+
+For each strategy it reports the median wall time and the PSNR of every size against the
+per-size FFmpeg output.
+
+Usage:
+    python benchmarks/resize_benchmark.py [--video clip.mp4] [--time-frame 00:00:30] [--repeat 5]
+
+Without --video a 1080p synthetic clip is generated with the bundled FFmpeg and lavfi.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import decode_backend
+import thumbnail_generator_all
+from s3_range_fetch import parse_timestamp
+
+BUNDLED_FFMPEG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ffmpeg-7.0.1-amd64-static', 'ffmpeg')
+
+
+def generate_clip(ffmpeg_path, video_path, duration=60):
+    """Generates a 1080p H.264 test clip with a 2 second GOP."""
+    subprocess.run([
+        ffmpeg_path, '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=size=1920x1080:rate=25:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', '50', '-pix_fmt', 'yuv420p', video_path
+    ], check=True)
+
+
+def per_size_ffmpeg(ffmpeg_path, video_path, frame, sizes):
+    thumbnails = []
+    for width, height, name in sizes:
+        result = subprocess.run([
+            ffmpeg_path, '-v', 'error', '-ss', frame, '-i', video_path, '-vframes', '1',
+            '-vf', f'scale={width}:{height}', '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1'
+        ], check=True, capture_output=True)
+        thumbnails.append((name, result.stdout))
+    return thumbnails
+
+
+@contextlib.contextmanager
+def quiet_stderr():
+    """Silences the FFmpeg banner of code paths that do not pass -v error."""
+    saved = os.dup(2)
+    with open(os.devnull, 'wb') as devnull:
+        os.dup2(devnull.fileno(), 2)
+    try:
+        yield
+    finally:
+        os.dup2(saved, 2)
+        os.close(saved)
+
+
+def split_ffmpeg(ffmpeg_path, video_path, frame, sizes):
+    with decode_backend.FFmpegBackend(ffmpeg_path).open(video_path) as video:
+        return video.encode_thumbnails(parse_timestamp(frame), sizes)
+
+
+def backend_render(backend, video_path, frame, sizes, downscale):
+    with backend.open(video_path) as video:
+        return decode_backend.render_thumbnails(video, frame, sizes, 'jpg', downscale)
+
+
+def psnr(reference, candidate):
+    reference = np.asarray(Image.open(io.BytesIO(reference)).convert('RGB'), dtype=np.float64)
+    candidate = np.asarray(Image.open(io.BytesIO(candidate)).convert('RGB'), dtype=np.float64)
+    mse = np.mean((reference - candidate) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--video', help='Video to benchmark, a synthetic clip is generated when omitted')
+    parser.add_argument('--ffmpeg', default=BUNDLED_FFMPEG if os.path.exists(BUNDLED_FFMPEG) else 'ffmpeg')
+    parser.add_argument('--time-frame', default='00:00:30')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    sizes = thumbnail_generator_all.sizes
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = args.video
+        if video_path is None:
+            video_path = os.path.join(tmp_dir, 'clip.mp4')
+            generate_clip(args.ffmpeg, video_path)
+
+        strategies = {
+            'per-size ffmpeg': lambda: per_size_ffmpeg(args.ffmpeg, video_path, args.time_frame, sizes),
+            'split ffmpeg': lambda: split_ffmpeg(args.ffmpeg, video_path, args.time_frame, sizes),
+        }
+        backends = [decode_backend.get_backend('ffmpeg', args.ffmpeg)]
+        if decode_backend.av is not None:
+            backends.append(decode_backend.get_backend('pyav'))
+        for backend in backends:
+            strategies[f'{backend.name} full-res'] = lambda backend=backend: backend_render(backend, video_path, args.time_frame, sizes, False)
+            strategies[f'{backend.name} downscale'] = lambda backend=backend: backend_render(backend, video_path, args.time_frame, sizes, True)
+
+        reference = dict(strategies['per-size ffmpeg']())
+        print(f'{"strategy":<20} {"median ms":>10}  ' + '  '.join(f'{name.rsplit("-", 1)[-1]:>12}' for _, _, name in sizes))
+        for label, run in strategies.items():
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                thumbnails = run()
+                timings.append((time.perf_counter() - started) * 1000)
+            scores = '  '.join(f'{psnr(reference[name], image):>9.2f} dB' for name, image in thumbnails)
+            print(f'{label:<20} {statistics.median(timings):>10.1f}  {scores}')
+
+
+if __name__ == '__main__':
+    main()
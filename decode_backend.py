@@ -0,0 +1,397 @@
+"""
+Pluggable decode backends that hand back decoded video frames as NumPy arrays (RGB, HxWx3).
+
+Backends:
+- PyAVBackend: opens the container once in-process with PyAV and seeks to every timestamp,
+  so several timestamps and sizes cost one probe and no process start-up.
+- FFmpegBackend: runs the FFmpeg binary once per timestamp and reads a PPM image from its
+  stdout, or once for many timestamps when it encodes the thumbnails itself (`encode_frames`).
+  It is the fallback when PyAV, Pillow or NumPy is not installed. Given a probe (see
+  video_probe) it knows the duration up front and seeks to the keyframe before each timestamp.
+
+Frames are scaled and encoded with Pillow by `encode_image`; Pillow-SIMD is a drop-in
+replacement that vectorizes the resize. `render_thumbnails` can decode straight to the
+largest thumbnail size and derive the smaller ones from that buffer. Without Pillow or NumPy,
+the FFmpeg reader scales and encodes every size itself (`encode_thumbnails`), so a Lambda
+whose layer only ships the FFmpeg binary still renders thumbnails.
+
+Dependencies (all optional, the FFmpeg binary alone is enough):
+- numpy, imported when a frame is first decoded to an array
+- av (PyAV)
+- Pillow, for encoding
+"""
+
+import importlib.util
+import io
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import av
+except ImportError:
+    av = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from s3_range_fetch import clamp_seconds, parse_timestamp
+from video_probe import seek_arguments
+
+# Pillow format names for the thumbnail extensions used by the scripts
+PILLOW_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG'}
+
+# FFmpeg encoders for the same extensions, used when Pillow is not installed
+FFMPEG_CODECS = {'jpg': 'mjpeg', 'jpeg': 'mjpeg', 'png': 'png'}
+
+
+def pillow_available():
+    """True when Pillow and NumPy are installed, both are needed to encode decoded frames in process."""
+    return Image is not None and importlib.util.find_spec('numpy') is not None
+
+
+def get_backend(name='auto', ffmpeg_path='ffmpeg'):
+    """
+    Returns a decode backend.
+
+    Args:
+    - name (str): 'pyav', 'ffmpeg' or 'auto' (PyAV when it, Pillow and NumPy are installed,
+      FFmpeg otherwise).
+    - ffmpeg_path (str): FFmpeg binary used by the FFmpeg backend.
+    """
+    if name == 'pyav' or (name == 'auto' and av is not None and pillow_available()):
+        if av is None:
+            raise ImportError('PyAV is not installed, install it with "pip install av" or use the ffmpeg backend.')
+        return PyAVBackend()
+    if name in ('ffmpeg', 'auto'):
+        return FFmpegBackend(ffmpeg_path)
+    raise ValueError(f'Unknown decode backend: {name}')
+
+
+class PyAVBackend:
+    name = 'pyav'
+
+    def open(self, video_path, probe=None):
+        # PyAV reads the duration and seeks through the index itself, the probe is not needed
+        return PyAVReader(video_path)
+
+
+class PyAVReader:
+    def __init__(self, video_path):
+        self.container = av.open(video_path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+        self.duration = self.container.duration / av.time_base if self.container.duration else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.container.close()
+
+    def read_frame(self, seconds, width=None, height=None):
+        """Seeks to the keyframe before `seconds` and decodes forward to the first frame at or after it."""
+        seconds = clamp_seconds(seconds, self.duration)
+        self.container.seek(int(seconds / self.stream.time_base), stream=self.stream, backward=True)
+        last = None
+        for frame in self.container.decode(self.stream):
+            last = frame
+            if frame.time is not None and frame.time >= seconds - 0.001:
+                break
+        if last is None:
+            raise ValueError(f'No frame could be decoded at {seconds}s')
+        return last.to_ndarray(format='rgb24', width=width, height=height)
+
+    def read_frames(self, time_frames, width=None, height=None):
+        """
+        Decodes one frame per time frame, seeking in timestamp order within the open container.
+
+        Returns:
+        - frames (list): RGB arrays in the same order as `time_frames`.
+        """
+        frames = {}
+        for frame in sorted(set(time_frames), key=parse_timestamp):
+            frames[frame] = self.read_frame(parse_timestamp(frame), width, height)
+        return [frames[frame] for frame in time_frames]
+
+    def read_keyframes(self, start, end, width=None, height=None):
+        """
+        Decodes only the keyframes between `start` and `end` seconds; every other frame is skipped
+        by the decoder.
+
+        Returns:
+        - keyframes (list): (seconds, RGB array) tuples in presentation order.
+        """
+        codec_context = self.stream.codec_context
+        codec_context.skip_frame = 'NONKEY'
+        keyframes = []
+
+        def collect(frames):
+            for frame in frames:
+                # Frames drained from the decoder carry no time base, so use the stream's
+                if frame.pts is None:
+                    continue
+                seconds = float(frame.pts * self.stream.time_base)
+                if start <= seconds <= end:
+                    keyframes.append((seconds, frame.to_ndarray(format='rgb24', width=width, height=height)))
+
+        try:
+            self.container.seek(int(start / self.stream.time_base), stream=self.stream, backward=True)
+            # Stop demuxing at the end of the window, the rest of a sparse file may not be fetched
+            for packet in self.container.demux(self.stream):
+                # demux() ends with an empty packet that flushes the decoder, which is done below
+                if packet.dts is None and not packet.size:
+                    break
+                if packet.pts is not None and packet.pts * self.stream.time_base > end:
+                    break
+                collect(packet.decode())
+            collect(self.stream.decode(None))
+        finally:
+            codec_context.skip_frame = 'DEFAULT'
+        return keyframes
+
+
+class FFmpegBackend:
+    name = 'ffmpeg'
+
+    def __init__(self, ffmpeg_path='ffmpeg'):
+        self.ffmpeg_path = ffmpeg_path
+
+    def open(self, video_path, probe=None):
+        return FFmpegReader(self.ffmpeg_path, video_path, probe)
+
+
+class FFmpegReader:
+    def __init__(self, ffmpeg_path, video_path, probe=None):
+        self.ffmpeg_path = ffmpeg_path
+        self.video_path = video_path
+        self.probe = probe
+        self.duration = probe['duration'] if probe else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def read_frame(self, seconds, width=None, height=None):
+        """Runs FFmpeg with an input-side seek and parses the PPM image it writes to stdout."""
+        input_args, output_args = seek_arguments(self.probe, clamp_seconds(seconds, self.duration))
+        ffmpeg_command = [self.ffmpeg_path, '-v', 'error', *input_args, '-i', self.video_path, *output_args, '-vframes', '1']
+        if width and height:
+            ffmpeg_command += ['-vf', f'scale={width}:{height}']
+        ffmpeg_command += ['-f', 'image2pipe', '-c:v', 'ppm', 'pipe:1']
+        result = subprocess.run(ffmpeg_command, check=True, capture_output=True)
+        return parse_ppm(result.stdout)
+
+    def read_frames(self, time_frames, width=None, height=None):
+        return [self.read_frame(parse_timestamp(frame), width, height) for frame in time_frames]
+
+    def encode_thumbnails(self, seconds, thumbnail_sizes, format='jpg'):
+        """
+        Decodes the frame once and lets FFmpeg scale and encode every size (split/scale graph),
+        each image written to its own pipe. Needs neither Pillow nor NumPy.
+
+        Returns:
+        - thumbnails (list): (name, image bytes) per entry of `thumbnail_sizes`.
+        """
+        return self.encode_frames([seconds], thumbnail_sizes, format)[0]
+
+    def encode_frames(self, time_frames, thumbnail_sizes, format='jpg'):
+        """
+        Renders every size of every time frame in a single FFmpeg run. Each time frame is an input of
+        the same command with its own keyframe seek, in timestamp order, so FFmpeg starts once and
+        decodes only the GOPs of the time frames instead of everything between the first and the last.
+        Every (time frame, size) image is written to its own pipe.
+
+        Args:
+        - time_frames (list): Time frames in seconds.
+        - thumbnail_sizes (list): (width, height, name) entries.
+        - format (str): Image format of the thumbnails.
+
+        Returns:
+        - thumbnails (list): Per entry of `time_frames`, the (name, image bytes) of every size.
+        """
+        unique_seconds = sorted({clamp_seconds(seconds, self.duration) for seconds in time_frames})
+        ffmpeg_command = [self.ffmpeg_path, '-v', 'error']
+        filter_graphs, outputs = [], []
+        for input_index, seconds in enumerate(unique_seconds):
+            input_args, output_args = seek_arguments(self.probe, seconds)
+            ffmpeg_command += [*input_args, '-i', self.video_path]
+            split_labels = ''.join(f'[s{input_index}_{i}]' for i in range(len(thumbnail_sizes)))
+            filter_graph = f'[{input_index}:v]split={len(thumbnail_sizes)}{split_labels}'
+            for i, (width, height, name) in enumerate(thumbnail_sizes):
+                filter_graph += f';[s{input_index}_{i}]scale={width}:{height}[o{input_index}_{i}]'
+                outputs.append((f'[o{input_index}_{i}]', output_args))
+            filter_graphs.append(filter_graph)
+        for filter_graph in filter_graphs:
+            ffmpeg_command += ['-filter_complex', filter_graph]
+
+        read_fds, write_fds = [], []
+        for label, output_args in outputs:
+            read_fd, write_fd = os.pipe()
+            read_fds.append(read_fd)
+            write_fds.append(write_fd)
+            ffmpeg_command += [
+                '-map', label, *output_args, '-vframes', '1', '-f', 'image2pipe',
+                '-c:v', FFMPEG_CODECS[format.lower()], f'pipe:{write_fd}'
+            ]
+        try:
+            process = subprocess.Popen(ffmpeg_command, pass_fds=write_fds)
+        finally:
+            for write_fd in write_fds:
+                os.close(write_fd)
+
+        # Drain every pipe at once so FFmpeg never blocks on a full pipe buffer
+        with ThreadPoolExecutor(max_workers=len(read_fds)) as executor:
+            images = list(executor.map(read_pipe, read_fds))
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, ffmpeg_command)
+
+        thumbnails = {}
+        for input_index, seconds in enumerate(unique_seconds):
+            thumbnails[seconds] = []
+            for i, (width, height, name) in enumerate(thumbnail_sizes):
+                image = images[input_index * len(thumbnail_sizes) + i]
+                if not image:
+                    raise ValueError(f'FFmpeg did not return the {name} thumbnail at {seconds}s')
+                thumbnails[seconds].append((name, image))
+        return [thumbnails[clamp_seconds(seconds, self.duration)] for seconds in time_frames]
+
+    def read_keyframes(self, start, end, width=None, height=None):
+        """
+        Decodes only the keyframes between `start` and `end` seconds (`-skip_frame nokey`) in one
+        FFmpeg run, reading their timestamps from showinfo and the images from stdout as PPM.
+        The duration FFmpeg reports is kept in `self.duration`.
+
+        Returns:
+        - keyframes (list): (seconds, RGB array) tuples in presentation order.
+        """
+        video_filter = 'showinfo' if not (width and height) else f'scale={width}:{height},showinfo'
+        ffmpeg_command = [
+            self.ffmpeg_path, '-hide_banner', '-skip_frame', 'nokey', '-ss', str(start), '-t', str(end - start + 0.001),
+            '-copyts', '-i', self.video_path, '-vf', video_filter, '-fps_mode', 'passthrough',
+            '-f', 'image2pipe', '-c:v', 'ppm', 'pipe:1'
+        ]
+        result = subprocess.run(ffmpeg_command, capture_output=True)
+        log = result.stderr.decode(errors='replace')
+        duration = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', log)
+        if duration:
+            self.duration = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+        if result.returncode != 0 and not (result.stdout or duration):
+            # FFmpeg also fails when the window is past the end of the video, which is not an error here
+            raise subprocess.CalledProcessError(result.returncode, ffmpeg_command, result.stdout, result.stderr)
+        times = [float(match) for match in re.findall(r'pts_time:\s*(-?[\d.]+)', log)]
+
+        keyframes = []
+        offset = 0
+        for seconds in times:
+            if offset >= len(result.stdout):
+                break
+            frame, offset = read_ppm(result.stdout, offset)
+            if start <= seconds <= end:
+                keyframes.append((seconds, frame))
+        return keyframes
+
+
+def read_pipe(read_fd):
+    """Reads everything written to one output pipe."""
+    with os.fdopen(read_fd, 'rb') as pipe:
+        return pipe.read()
+
+
+def parse_ppm(data):
+    """Converts a binary PPM (P6, 8 bits) image to an RGB array."""
+    return read_ppm(data)[0]
+
+
+def read_ppm(data, offset=0):
+    """
+    Reads one binary PPM image starting at `offset` of `data`.
+
+    Returns:
+    - (frame, next_offset) (tuple): RGB array and the offset right after the image.
+    """
+    fields = []
+    while len(fields) < 4:
+        while data[offset:offset + 1].isspace():
+            offset += 1
+        if data[offset:offset + 1] == b'#':
+            offset = data.index(b'\n', offset) + 1
+            continue
+        end = offset
+        while not data[end:end + 1].isspace():
+            end += 1
+        fields.append(data[offset:end])
+        offset = end
+    if fields[0] != b'P6':
+        raise ValueError('FFmpeg did not return a binary PPM image')
+    width, height = int(fields[1]), int(fields[2])
+    # Only imported when a frame is decoded to an array, the FFmpeg-only path never needs it
+    import numpy as np
+    pixels = np.frombuffer(data, dtype=np.uint8, count=width * height * 3, offset=offset + 1)
+    return pixels.reshape(height, width, 3), offset + 1 + width * height * 3
+
+
+def encode_image(frame, width=None, height=None, format='jpg', quality=90):
+    """
+    Scales an RGB array and encodes it with Pillow.
+
+    Returns:
+    - image (bytes): Encoded image.
+    """
+    if Image is None:
+        raise ImportError('Pillow is not installed, install it with "pip install pillow".')
+    image = Image.fromarray(frame)
+    if width and height and image.size != (width, height):
+        image = image.resize((width, height), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, PILLOW_FORMATS[format.lower()], quality=quality)
+    return buffer.getvalue()
+
+
+def render_thumbnails(reader, frame, thumbnail_sizes, format='jpg', downscale=False, executor=None):
+    """
+    Decodes `frame` once and encodes it at every size. Without Pillow or NumPy, an FFmpeg reader
+    scales and encodes every size itself and `downscale` does not apply.
+
+    Args:
+    - reader: Open reader of a decode backend.
+    - frame (str): Time frame to decode.
+    - thumbnail_sizes (list): (width, height, name) entries.
+    - format (str): Image format of the thumbnails.
+    - downscale (bool): Decode straight to the largest size and derive the smaller ones from that
+      buffer instead of scaling every size from the full-resolution frame.
+    - executor (Executor): Pool used to resize and encode the sizes concurrently (Pillow releases
+      the GIL while resizing and encoding). One is created when omitted.
+
+    Returns:
+    - thumbnails (list): (name, image bytes) per entry of `thumbnail_sizes`.
+    """
+    if not pillow_available():
+        if not isinstance(reader, FFmpegReader):
+            raise ImportError('Pillow and NumPy are needed to encode the frames decoded by PyAV, install them or use the ffmpeg backend.')
+        return reader.encode_thumbnails(parse_timestamp(frame), thumbnail_sizes, format)
+    if downscale:
+        width, height, _ = max(thumbnail_sizes, key=lambda size: size[0] * size[1])
+        decoded = reader.read_frames([frame], width, height)[0]
+    else:
+        decoded = reader.read_frames([frame])[0]
+
+    def encode(size):
+        width, height, name = size
+        return name, encode_image(decoded, width, height, format)
+
+    if executor is not None:
+        return list(executor.map(encode, thumbnail_sizes))
+    with ThreadPoolExecutor(max_workers=len(thumbnail_sizes)) as pool:
+        return list(pool.map(encode, thumbnail_sizes))
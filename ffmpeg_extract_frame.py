@@ -1,6 +1,7 @@
 import os
 import boto3
 import ffmpeg
+from s3_range_fetch import fetch_video
 
 s3 = boto3.client('s3')
 bucket_name = 'thumbnail-generator-poc'
@@ -15,7 +16,7 @@ os.makedirs(output_dir, exist_ok=True)
 def s3_download(bucket_name, video_key, video_path):
     try:
         print(f'Downloading video: {video_key} from the S3 bucket: {bucket_name} to {video_path}')
-        s3.download_file(bucket_name, video_key, video_path)
+        fetch_video(s3, bucket_name, video_key, video_path, time_frames)
         # Verificar se o arquivo foi baixado com sucesso
         if not os.path.exists(video_path):
             raise Exception(f'File {video_path} does not exist after download.')
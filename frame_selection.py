@@ -0,0 +1,121 @@
+"""
+Picks the best thumbnail frame near a requested time frame instead of grabbing it blindly.
+
+It performs the following steps:
+1. Decodes only the keyframes (non-key frames are skipped by the decoder) within `window`
+   seconds of the time frame, at a small size, through an open decode backend reader.
+2. Scores every candidate in one batch with vectorized NumPy metrics: luma mean (exposure),
+   luma standard deviation (contrast) and variance of the Laplacian (sharpness).
+3. Rejects near-black frames and flat frames (fades, blank title cards) and returns the time
+   of the best remaining keyframe, so rendering it is a single seek to that keyframe.
+
+A time frame past the end of the video is moved to the middle of the video before searching,
+so short videos get a thumbnail instead of failing.
+
+Without NumPy the requested time frame is used as it is.
+
+Dependencies:
+- numpy, optional
+"""
+
+import importlib.util
+
+from s3_range_fetch import clamp_seconds, parse_timestamp
+
+# Seconds searched on each side of the requested time frame
+SELECTION_WINDOW = 15.0
+
+# Size the candidates are decoded at for scoring
+SCORE_SIZE = (192, 108)
+
+# Luma below this level counts as black
+BLACK_LEVEL = 24
+
+# Candidates with more than this fraction of black pixels are rejected
+MAX_BLACK_FRACTION = 0.9
+
+# Candidates with a lower luma standard deviation are rejected as flat
+MIN_CONTRAST = 6.0
+
+# Score lost by a candidate at the edge of the window, to prefer frames near the requested time
+DISTANCE_PENALTY = 0.5
+
+# ITU-R BT.601 luma weights
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def score_frames(frames):
+    """
+    Scores a batch of RGB frames of the same size.
+
+    Args:
+    - frames (list): HxWx3 uint8 arrays.
+
+    Returns:
+    - scores (ndarray): One score per frame, -inf for rejected frames.
+    - metrics (dict): Per-frame 'mean', 'contrast', 'sharpness' and 'black_fraction' arrays.
+    """
+    import numpy as np
+
+    luma = np.stack(frames).astype(np.float32) @ np.array(LUMA_WEIGHTS, dtype=np.float32)  # N x H x W
+
+    mean = luma.mean(axis=(1, 2))
+    contrast = luma.std(axis=(1, 2))
+    black_fraction = (luma < BLACK_LEVEL).mean(axis=(1, 2))
+
+    # 4-neighbour Laplacian on the interior pixels of every frame at once
+    laplacian = (
+        luma[:, :-2, 1:-1] + luma[:, 2:, 1:-1] + luma[:, 1:-1, :-2] + luma[:, 1:-1, 2:]
+        - 4 * luma[:, 1:-1, 1:-1]
+    )
+    sharpness = laplacian.var(axis=(1, 2))
+
+    exposure = 1 - np.abs(mean - 128) / 128
+    scores = np.log1p(sharpness) + np.log1p(contrast) + exposure
+    scores[(black_fraction > MAX_BLACK_FRACTION) | (contrast < MIN_CONTRAST)] = -np.inf
+
+    metrics = {'mean': mean, 'contrast': contrast, 'sharpness': sharpness, 'black_fraction': black_fraction}
+    return scores, metrics
+
+
+def select_frame(reader, frame, window=SELECTION_WINDOW, score_size=SCORE_SIZE):
+    """
+    Finds the best keyframe within `window` seconds of a time frame.
+
+    Args:
+    - reader: Open reader of a decode backend (see decode_backend).
+    - frame (str): Requested time frame.
+    - window (float): Seconds searched on each side of the time frame.
+    - score_size (tuple): (width, height) the candidates are decoded at for scoring.
+
+    Returns:
+    - frame (str): Time frame of the selected keyframe in seconds, or the (clamped) requested
+      time frame when no candidate is usable (unchanged without NumPy).
+    """
+    if importlib.util.find_spec('numpy') is None:
+        print(f'NumPy is not installed, using {frame} without selecting a keyframe')
+        return frame
+    import numpy as np
+
+    seconds = clamp_seconds(parse_timestamp(frame), reader.duration)
+    candidates = reader.read_keyframes(max(seconds - window, 0), seconds + window, *score_size)
+    if not candidates:
+        # The FFmpeg reader only learns the duration after its first run
+        clamped = clamp_seconds(seconds, reader.duration)
+        if clamped != seconds:
+            seconds = clamped
+            candidates = reader.read_keyframes(max(seconds - window, 0), seconds + window, *score_size)
+    if not candidates:
+        print(f'No keyframes found around {frame}, using {seconds:.3f}s')
+        return f'{seconds:.3f}'
+
+    times = np.array([time for time, _ in candidates])
+    scores, _ = score_frames([image for _, image in candidates])
+    scores -= DISTANCE_PENALTY * np.abs(times - seconds) / max(window, 1e-6)
+    best = int(np.argmax(scores))
+    if not np.isfinite(scores[best]):
+        print(f'Every keyframe around {frame} is black or flat, using {seconds:.3f}s')
+        return f'{seconds:.3f}'
+
+    print(f'Selected keyframe at {times[best]:.3f}s out of {len(candidates)} candidates around {frame}')
+    return f'{times[best]:.3f}'
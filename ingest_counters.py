@@ -0,0 +1,241 @@
+"""
+Running counters of the .mp4 objects of an ingest bucket, kept in a local SQLite database.
+
+The store is fed by S3 event notifications instead of listing the bucket:
+- ObjectCreated events add the object, or move it to the day of its new upload when it is
+  overwritten.
+- ObjectRemoved events remove it.
+
+Events can arrive late, twice or out of order. Each object keeps the sequencer of the last
+event applied to it, and older events are ignored. Removed objects are kept as tombstones, so
+a late ObjectCreated event cannot bring them back.
+
+The total is a counter updated with every change and the objects are indexed by upload day,
+so a report costs O(uploads of the day) whatever the size of the bucket. `bootstrap` seeds
+an empty store from one listing of the bucket.
+
+A store does not have to hold the whole bucket: `load_rows` and `rows` move the state of
+chosen objects in and out without touching the total, which is how ingest_state.py applies a
+day's events to only the objects they touch.
+"""
+
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+
+def parse_time(value):
+    """Converts a datetime or an ISO 8601 string (S3 eventTime, 'Z' suffix) to an aware UTC datetime."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def sequencer_order(sequencer):
+    """
+    Makes S3 sequencers comparable: they are hexadecimal strings of varying length that must be
+    compared as numbers, so they are left-padded to the same length.
+    """
+    return sequencer.upper().rjust(32, '0') if sequencer else None
+
+
+class IngestCounters:
+    def __init__(self, path='ingest_counters.db', suffix='.mp4'):
+        """
+        Args:
+        - path (str): Location of the SQLite database file, created on first use.
+        - suffix (str): Only keys ending with this suffix are counted.
+        """
+        self.path = path
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                object_key TEXT PRIMARY KEY,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                day TEXT,
+                sequencer TEXT,
+                deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS objects_by_day ON objects (day, object_key) WHERE deleted = 0;
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value
+            );
+            INSERT OR IGNORE INTO counters (name, value) VALUES ('total', 0);
+        ''')
+        self.connection.commit()
+
+    def _apply(self, object_key, deleted, last_modified=None, size=None, etag=None, sequencer=None):
+        """Applies one change inside the current transaction; returns True unless it was stale."""
+        sequencer = sequencer_order(sequencer)
+        row = self.connection.execute(
+            'SELECT sequencer, deleted FROM objects WHERE object_key = ?', (object_key,)
+        ).fetchone()
+        if row is not None and row[0] is not None and sequencer is not None and sequencer <= row[0]:
+            return False
+        was_live = row is not None and not row[1]
+
+        if deleted:
+            if row is None:
+                self.connection.execute(
+                    'INSERT INTO objects (object_key, sequencer, deleted) VALUES (?, ?, 1)', (object_key, sequencer)
+                )
+            else:
+                self.connection.execute(
+                    'UPDATE objects SET deleted = 1, day = NULL, sequencer = ? WHERE object_key = ?',
+                    (sequencer, object_key)
+                )
+        else:
+            last_modified = parse_time(last_modified)
+            self.connection.execute(
+                'INSERT INTO objects (object_key, size, etag, last_modified, day, sequencer, deleted) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0) ON CONFLICT(object_key) DO UPDATE SET '
+                'size = excluded.size, etag = excluded.etag, last_modified = excluded.last_modified, '
+                'day = excluded.day, sequencer = excluded.sequencer, deleted = 0',
+                (object_key, size, etag, last_modified.isoformat(), last_modified.strftime('%Y-%m-%d'), sequencer)
+            )
+
+        change = (0 if deleted else 1) - (1 if was_live else 0)
+        if change:
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'total'", (change,))
+        return True
+
+    def apply_records(self, records):
+        """
+        Applies the records of S3 event notifications in one transaction.
+
+        Args:
+        - records (list): 'Records' entries of S3 events (ObjectCreated:* and ObjectRemoved:*).
+
+        Returns:
+        - applied (int): Records that changed the store; other suffixes, other event types
+          and stale or repeated events are skipped.
+        """
+        applied = 0
+        with self.lock, self.connection:
+            for record in records:
+                event_name = record.get('eventName', '')
+                s3_object = record['s3']['object']
+                # Keys in event notifications are URL-encoded, spaces as '+'
+                object_key = unquote_plus(s3_object['key'])
+                if not object_key.endswith(self.suffix):
+                    continue
+                if event_name.startswith('ObjectCreated:'):
+                    applied += self._apply(
+                        object_key, False, record['eventTime'], s3_object.get('size'), s3_object.get('eTag'), s3_object.get('sequencer')
+                    )
+                elif event_name.startswith('ObjectRemoved:'):
+                    applied += self._apply(object_key, True, sequencer=s3_object.get('sequencer'))
+        return applied
+
+    def bootstrap(self, objects):
+        """
+        Seeds the store from a listing of the bucket (list_objects_v2 'Contents' entries).
+        Objects already known from events keep their state.
+        """
+        with self.lock, self.connection:
+            for obj in objects:
+                if not obj['Key'].endswith(self.suffix):
+                    continue
+                known = self.connection.execute('SELECT 1 FROM objects WHERE object_key = ?', (obj['Key'],)).fetchone()
+                if known is None:
+                    self._apply(obj['Key'], False, obj['LastModified'], obj.get('Size'), obj.get('ETag'))
+            self.connection.execute(
+                "INSERT INTO counters (name, value) VALUES ('bootstrapped_at', ?) "
+                'ON CONFLICT(name) DO UPDATE SET value = excluded.value',
+                (datetime.now(timezone.utc).isoformat(),)
+            )
+
+    def load_rows(self, rows):
+        """
+        Inserts or replaces the state of objects as returned by `rows`, without changing the total.
+
+        Args:
+        - rows (iterable): Dictionaries with object_key, size, etag, last_modified, day,
+          sequencer and deleted.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO objects (object_key, size, etag, last_modified, day, sequencer, deleted) '
+                'VALUES (:object_key, :size, :etag, :last_modified, :day, :sequencer, :deleted)',
+                [dict(row, deleted=int(bool(row['deleted']))) for row in rows]
+            )
+
+    def remove_rows(self, object_keys):
+        """Forgets the state of objects, without changing the total."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM objects WHERE object_key = ?', [(key,) for key in object_keys])
+
+    def rows(self, object_keys=None):
+        """
+        Returns the stored state of objects, tombstones included.
+
+        Args:
+        - object_keys (iterable): Keys to return, every object when None.
+
+        Returns:
+        - rows (dict): Row dictionaries (see `load_rows`) by object key.
+        """
+        query = 'SELECT object_key, size, etag, last_modified, day, sequencer, deleted FROM objects'
+        columns = ('object_key', 'size', 'etag', 'last_modified', 'day', 'sequencer', 'deleted')
+        with self.lock:
+            if object_keys is None:
+                found = self.connection.execute(query + ' ORDER BY object_key').fetchall()
+            else:
+                found = []
+                for object_key in object_keys:
+                    found += self.connection.execute(query + ' WHERE object_key = ?', (object_key,)).fetchall()
+        return {row[0]: dict(zip(columns, row), deleted=bool(row[6])) for row in found}
+
+    def is_bootstrapped(self):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM counters WHERE name = 'bootstrapped_at'").fetchone() is not None
+
+    def total(self):
+        """Returns the number of .mp4 objects in the bucket."""
+        with self.lock:
+            return self.connection.execute("SELECT value FROM counters WHERE name = 'total'").fetchone()[0]
+
+    def iter_day(self, day, batch_size=1000):
+        """
+        Lazily yields the objects (Key and LastModified) uploaded on a day ('YYYY-MM-DD', UTC), in
+        key order, reading them from the database in batches.
+        """
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT object_key, last_modified FROM objects WHERE day = ? AND deleted = 0 AND object_key > ? '
+                    'ORDER BY object_key LIMIT ?', (day, last_key, batch_size)
+                ).fetchall()
+            for object_key, last_modified in rows:
+                yield {'Key': object_key, 'LastModified': last_modified}
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1][0]
+
+    def report(self, day):
+        """
+        Returns the report of a day ('YYYY-MM-DD', UTC) as one dictionary.
+
+        Returns:
+        - report (dict): total_files_until_current_date, total_files_today and the Files
+          (Key and LastModified) uploaded that day.
+        """
+        files = list(self.iter_day(day))
+        return {
+            'total_files_until_current_date': self.total(),
+            'total_files_today': len(files),
+            'Files': files
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
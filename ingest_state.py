@@ -0,0 +1,322 @@
+"""
+Ingest counters kept in an S3 bucket as many small objects, so a daily run of s3_report.py only
+transfers what its events touch instead of a store with one row per object ever seen.
+
+Objects under `prefix`:
+- totals.json: the running total, the day the state was seeded and the event objects applied by
+  the last run (`applied_events`). It is written before anything else a run changes, so it is
+  the commit point of the run.
+- keys/<sha256 of the key>.json: the state (see IngestCounters.rows) of every object changed by
+  an event since the state was seeded, tombstones included.
+- baseline/index.json and baseline/<n>.jsonl.gz: the listing that seeded the state, in key order
+  and chunks of BASELINE_CHUNK objects, never written again. The state of an object no event
+  changed yet is read from the one chunk that can hold it.
+- days/<YYYY-MM-DD>.db: IngestCounters stores of the live objects uploaded on a day, from the
+  seeding day on. The report of a day only downloads its partition.
+- lock: lease of the run changing the state, taken over once it expires.
+
+A run applies its events to an in-memory IngestCounters loaded with the prior state of the
+objects they name, so late, repeated and out of order events are still resolved by their
+sequencer. The event objects stay in the bucket until the run has written everything. A run
+that fails after committing totals.json leaves them pending and listed in `applied_events`: the
+next run applies them again to rebuild the states of their objects without counting them twice.
+"""
+
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+
+from ingest_counters import IngestCounters, parse_time
+
+# Objects per chunk of the baseline listing, one GET reads the state of any of them
+BASELINE_CHUNK = 1000
+
+# Seconds a run holds the lock, longer than a Lambda invocation can last
+LEASE_SECONDS = 15 * 60
+
+# Error codes of a conditional write that lost to another writer
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+def is_missing(error):
+    return error.response['Error']['Code'] in ('NoSuchKey', '404')
+
+
+def listing_row(obj):
+    """Converts a list_objects_v2 'Contents' entry to the row IngestCounters would store for it."""
+    last_modified = parse_time(obj['LastModified'])
+    return {
+        'object_key': obj['Key'],
+        'size': obj.get('Size'),
+        'etag': obj.get('ETag'),
+        'last_modified': last_modified.isoformat(),
+        'day': last_modified.strftime('%Y-%m-%d'),
+        'sequencer': None,
+        'deleted': False
+    }
+
+
+def live_day(row):
+    """Returns the upload day of a row, None when the object is unknown or deleted."""
+    return row['day'] if row is not None and not row['deleted'] else None
+
+
+class IngestState:
+    def __init__(self, s3, bucket_name, prefix='report/ingest_state/', scratch_dir='/tmp/ingest-state', suffix='.mp4', workers=16):
+        """
+        Args:
+        - s3 (botocore client): S3 client, shared by the workers.
+        - bucket_name (str): Bucket holding the state.
+        - prefix (str): Prefix of the state objects.
+        - scratch_dir (str): Local directory of the day partitions being read or updated.
+        - suffix (str): Only keys ending with this suffix are counted.
+        - workers (int): Concurrent requests when reading or writing many state objects.
+        """
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.scratch_dir = scratch_dir
+        self.suffix = suffix
+        self.workers = workers
+        self.owner = uuid.uuid4().hex
+        self.totals = None
+        self.baseline_index = None
+        os.makedirs(scratch_dir, exist_ok=True)
+
+    def _get(self, key):
+        """Returns the body and ETag of a state object, (None, None) when it does not exist."""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.prefix + key)
+        except ClientError as e:
+            if is_missing(e):
+                return None, None
+            raise
+        return response['Body'].read(), response['ETag']
+
+    def _get_json(self, key):
+        body, etag = self._get(key)
+        return (json.loads(body) if body is not None else None), etag
+
+    def _put_json(self, key, value, **condition):
+        self.s3.put_object(
+            Bucket=self.bucket_name, Key=self.prefix + key, Body=json.dumps(value), ContentType='application/json', **condition
+        )
+
+    def _map(self, function, items):
+        items = list(items)
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(function, items))
+
+    def _key_state(self, object_key):
+        return f'keys/{hashlib.sha256(object_key.encode()).hexdigest()}.json'
+
+    @contextmanager
+    def locked(self):
+        """Holds the lock of the state, raises RuntimeError while another run holds an unexpired lease."""
+        if 'IfMatch' not in self.s3.meta.service_model.operation_model('PutObject').input_shape.members:
+            raise RuntimeError('This boto3 cannot write the state conditionally, package boto3 >= 1.35.69 with the function')
+        lease = {'owner': self.owner, 'expires': time.time() + LEASE_SECONDS}
+        try:
+            self._put_json('lock', lease, IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CONFLICT_CODES:
+                raise
+            held, etag = self._get_json('lock')
+            if held is not None and held['expires'] > time.time():
+                raise RuntimeError(f'The ingest state is locked by another run until {datetime.fromtimestamp(held["expires"], timezone.utc)}')
+            # The lease expired (or was just released): take it over unless another run is faster
+            try:
+                self._put_json('lock', lease, **({'IfMatch': etag} if etag else {'IfNoneMatch': '*'}))
+            except ClientError as e:
+                if e.response['Error']['Code'] in CONFLICT_CODES:
+                    raise RuntimeError('The ingest state was locked by another run') from e
+                raise
+        try:
+            yield self
+        finally:
+            held, _ = self._get_json('lock')
+            if held is not None and held['owner'] == self.owner:
+                self.s3.delete_object(Bucket=self.bucket_name, Key=self.prefix + 'lock')
+
+    def load(self):
+        """Reads totals.json, returns False when the state was never seeded."""
+        self.totals, _ = self._get_json('totals.json')
+        return self.totals is not None
+
+    def total(self):
+        """Returns the number of live objects."""
+        return self.totals['total']
+
+    def bootstrap(self, objects, day):
+        """
+        Seeds the state from one listing of the bucket.
+
+        Args:
+        - objects (iterable): list_objects_v2 'Contents' entries, in key order.
+        - day (str): Current day ('YYYY-MM-DD', UTC), the first one with a partition.
+        """
+        first_keys = []
+        today = []
+        total = 0
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            chunk = []
+            for obj in objects:
+                if not obj['Key'].endswith(self.suffix):
+                    continue
+                row = listing_row(obj)
+                chunk.append(row)
+                total += 1
+                if row['day'] == day:
+                    today.append(row)
+                if len(chunk) == BASELINE_CHUNK:
+                    pending.append(executor.submit(self._put_chunk, len(first_keys), chunk))
+                    first_keys.append(chunk[0]['object_key'])
+                    chunk = []
+                # Keep a bounded number of chunks in memory while the listing goes on
+                while len(pending) > self.workers:
+                    pending.pop(0).result()
+            if chunk:
+                pending.append(executor.submit(self._put_chunk, len(first_keys), chunk))
+                first_keys.append(chunk[0]['object_key'])
+            for future in pending:
+                future.result()
+
+        self._put_json('baseline/index.json', {'first_keys': first_keys})
+        self.baseline_index = first_keys
+        self._update_partition(day, {row['object_key']: row for row in today}, set())
+        self.totals = {
+            'total': total,
+            'seeded_day': day,
+            'bootstrapped_at': datetime.now(timezone.utc).isoformat(),
+            'applied_events': []
+        }
+        self._put_json('totals.json', self.totals)
+        print(f'Seeded the ingest state with {total} objects in {len(first_keys)} baseline chunks')
+
+    def _put_chunk(self, number, rows):
+        body = gzip.compress(''.join(json.dumps(row) + '\n' for row in rows).encode())
+        self.s3.put_object(Bucket=self.bucket_name, Key=f'{self.prefix}baseline/{number}.jsonl.gz', Body=body)
+
+    def _baseline_rows(self, object_keys):
+        """Looks up objects in the baseline listing, one GET per chunk holding any of them."""
+        if self.baseline_index is None:
+            index, _ = self._get_json('baseline/index.json')
+            self.baseline_index = index['first_keys'] if index else []
+        chunks = {}
+        for object_key in object_keys:
+            number = bisect.bisect_right(self.baseline_index, object_key) - 1
+            if number >= 0:
+                chunks.setdefault(number, set()).add(object_key)
+
+        def read_chunk(number):
+            body, _ = self._get(f'baseline/{number}.jsonl.gz')
+            rows = [json.loads(line) for line in gzip.decompress(body).splitlines()] if body else []
+            return [row for row in rows if row['object_key'] in chunks[number]]
+
+        return {row['object_key']: row for rows in self._map(read_chunk, chunks) for row in rows}
+
+    def prior_rows(self, object_keys):
+        """Returns the current state of objects by key; unknown objects are left out."""
+        object_keys = sorted(object_keys)
+        states = dict(zip(object_keys, self._map(lambda key: self._get_json(self._key_state(key))[0], object_keys)))
+        rows = {key: row for key, row in states.items() if row is not None}
+        rows.update(self._baseline_rows([key for key in object_keys if key not in rows]))
+        return rows
+
+    def _partition_path(self, day):
+        return os.path.join(self.scratch_dir, f'{day}.db')
+
+    def _download_partition(self, day):
+        path = self._partition_path(day)
+        if os.path.exists(path):
+            os.remove(path)
+        body, _ = self._get(f'days/{day}.db')
+        if body is not None:
+            with open(path, 'wb') as f:
+                f.write(body)
+        return path
+
+    def _update_partition(self, day, upserts, removals):
+        path = self._download_partition(day)
+        partition = IngestCounters(path, self.suffix)
+        try:
+            partition.remove_rows(removals)
+            partition.load_rows(upserts.values())
+        finally:
+            partition.close()
+        with open(path, 'rb') as f:
+            self.s3.put_object(Bucket=self.bucket_name, Key=f'{self.prefix}days/{day}.db', Body=f.read())
+        os.remove(path)
+
+    def apply(self, events):
+        """
+        Applies event objects to the state.
+
+        Args:
+        - events (dict): 'Records' of S3 event notifications by event object key.
+
+        Returns:
+        - applied (int): Records of events not applied before that changed the state.
+        """
+        records = {event_key: events[event_key] for event_key in sorted(events)}
+        object_keys = {
+            unquote_plus(record['s3']['object']['key'])
+            for event_records in records.values() for record in event_records
+        }
+        object_keys = {key for key in object_keys if key.endswith(self.suffix)}
+        prior = self.prior_rows(object_keys)
+
+        counters = IngestCounters(':memory:', self.suffix)
+        try:
+            counters.load_rows(prior.values())
+            # Events committed by a run that failed afterwards only rebuild the states it did not write
+            already_applied = set(self.totals['applied_events'])
+            for event_key, event_records in records.items():
+                if event_key in already_applied:
+                    counters.apply_records(event_records)
+            before = counters.total()
+            applied = sum(
+                counters.apply_records(event_records)
+                for event_key, event_records in records.items() if event_key not in already_applied
+            )
+            change = counters.total() - before
+            rows = counters.rows(object_keys)
+        finally:
+            counters.close()
+
+        self.totals = dict(self.totals, total=self.totals['total'] + change, applied_events=list(records))
+        self._put_json('totals.json', self.totals)
+
+        changed = {key: row for key, row in rows.items() if row != prior.get(key)}
+        self._map(lambda item: self._put_json(self._key_state(item[0]), item[1]), changed.items())
+
+        # Move the changed objects between the partitions of their old and new upload days
+        upserts = {}
+        removals = {}
+        for key, row in changed.items():
+            old_day, new_day = live_day(prior.get(key)), live_day(row)
+            if old_day is not None and old_day != new_day:
+                removals.setdefault(old_day, set()).add(key)
+            if new_day is not None:
+                upserts.setdefault(new_day, {})[key] = row
+        # Days before the seeding have no partition
+        days = [day for day in set(upserts) | set(removals) if day >= self.totals['seeded_day']]
+        self._map(lambda day: self._update_partition(day, upserts.get(day, {}), removals.get(day, set())), days)
+        return applied
+
+    def open_day(self, day):
+        """Downloads the partition of a day and returns it as an IngestCounters, to be closed by the caller."""
+        return IngestCounters(self._download_partition(day), self.suffix)
@@ -1,6 +1,15 @@
 import os
 import boto3
-import subprocess
+import decode_backend
+import frame_selection
+import video_probe
+import json
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from s3_range_fetch import SEEK_MARGIN, parse_timestamp
+from tmp_cache import SourceVideoCache
 
 # Initialize the S3 client
 s3 = boto3.client('s3')
@@ -9,11 +18,13 @@ s3 = boto3.client('s3')
 source_bucket_name = 'avs-vod-mc-input-2c87c40d939653bdbef99ff1ce204afc'
 destination_bucket_name = 'caracol-image-ingest-prod'
 
-# Time frames to capture thumbnails from the video
+# Time frames to capture thumbnails from the video. The thumbnail keys do not name the frame, so
+# only the first one is rendered; the others would overwrite it under the same keys
 time_frames = ['00:05:00']
 
 # Path to the FFmpeg binary
 ffmpeg_path = "/opt/bin/ffmpeg"
+ffprobe_path = "/opt/bin/ffprobe"
 
 # Thumbnail sizes and corresponding names
 sizes = [
@@ -25,108 +36,191 @@ sizes = [
 # Format for the thumbnail images
 format = 'jpg'
 
-# Function to download a video from S3
-def s3_download(bucket_name, video_key, video_path):
+# Frame decoder: 'pyav' decodes in-process, 'ffmpeg' runs the binary, 'auto' uses PyAV when it, Pillow and
+# NumPy are installed (the Lambda layer must ship them), FFmpeg otherwise
+decode_backend_name = 'auto'
+
+# With PyAV, decode once at the largest size and derive the smaller sizes from it with Pillow
+# (FFmpeg scales every size itself in one split/scale run)
+downscale_from_largest = True
+
+# Use the best keyframe (not black, flat or blurry) within selection_window seconds of each time frame
+select_best_frames = True
+selection_window = 15
+
+# Source videos stay in /tmp between warm invocations, keyed by bucket/key/ETag, within the size of
+# /tmp minus the room a render needs (or SOURCE_CACHE_MAX_BYTES bytes)
+source_cache = SourceVideoCache('/tmp/source-cache')
+
+# Duration and keyframe index of every source version (ETag) probed by this container, used to seek with FFmpeg
+probe_cache = video_probe.ProbeCache('/tmp/probe-cache', ffprobe_path)
+
+# Records of one event processed at the same time (1 processes them one by one)
+record_workers = os.cpu_count() or 1
+
+# A record only starts while /tmp has room for its download plus min_free_tmp_bytes (after evicting unused
+# videos from the source cache and setting aside the downloads of running records) and memory has
+# min_available_memory_bytes, unless no other record is running
+min_free_tmp_bytes = 256 * 1024 ** 2
+min_available_memory_bytes = 256 * 1024 ** 2
+
+# Function to download a video from S3, reusing the copy cached in /tmp by earlier invocations
+def s3_download(bucket_name, video_key, head=None):
+    print(f'Downloading video: {video_key} from the S3 bucket: {bucket_name}')
+    margin = selection_window + SEEK_MARGIN if select_best_frames else SEEK_MARGIN
+    return source_cache.open(s3, bucket_name, video_key, time_frames[:1], margin, head)
+
+# Function to estimate the /tmp space the download of a video takes: nothing when the source cache already
+# covers the time frame, otherwise the whole object, as the ranged fetch falls back to a full download
+def expected_download_bytes(bucket_name, video_key, head):
+    margin = selection_window + SEEK_MARGIN if select_best_frames else SEEK_MARGIN
+    if source_cache.covers(bucket_name, video_key, head['ETag'], time_frames[:1], margin):
+        return 0
+    return head['ContentLength']
+
+# Function to upload a thumbnail held in memory to S3
+def s3_upload_bytes(file_key, bucket_name, image):
     try:
-        print(f'Downloading video: {video_key} from the S3 bucket: {bucket_name} to {video_path}')
-        s3.download_file(bucket_name, video_key, video_path)
-        if not os.path.exists(video_path):
-            raise Exception(f'File {video_path} does not exist after download.')
+        print(f'Uploading {len(image)} bytes to {bucket_name} bucket on the path {file_key}')
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Body=image,
+            ContentType='image/jpeg'
+        )
     except Exception as e:
-        print(f'Error downloading video from S3: {str(e)}')
+        print(f'Error uploading thumbnail to S3: {str(e)}')
         raise
 
-# Function to create a thumbnail from the video
-def create_thumbnail(video_path, frame, frame_thumbnail, width, height):
+# Function to log how much of /tmp is in use without spawning a process
+def log_tmp_usage(stage):
+    usage = shutil.disk_usage('/tmp')
+    print(f'/tmp usage {stage}: {usage.used / 1024 ** 2:.1f} MiB used, {usage.free / 1024 ** 2:.1f} MiB free')
+
+# Function to read the memory available to new work, in bytes
+def available_memory_bytes():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+# Admission control: records wait for /tmp space and memory before they start, and the /tmp space their
+# downloads will take stays reserved until they finish
+records_running = 0
+reserved_tmp_bytes = 0
+records_condition = threading.Condition()
+
+def has_room(download_bytes):
+    # Unused videos of the source cache are evicted first when the space is needed
+    needed = reserved_tmp_bytes + download_bytes + min_free_tmp_bytes
+    memory = available_memory_bytes()
+    return (source_cache.make_room(needed) >= needed
+            and (memory is None or memory >= min_available_memory_bytes))
+
+def admit_record(video_key, download_bytes):
+    global records_running, reserved_tmp_bytes
+    with records_condition:
+        # Always admit a record when nothing is running, otherwise the batch could never finish
+        while records_running > 0 and not has_room(download_bytes):
+            print(f'Waiting for /tmp space or memory before processing {video_key}')
+            records_condition.wait(timeout=1)
+        records_running += 1
+        reserved_tmp_bytes += download_bytes
+
+def release_record(download_bytes):
+    global records_running, reserved_tmp_bytes
+    with records_condition:
+        records_running -= 1
+        reserved_tmp_bytes -= download_bytes
+        records_condition.notify_all()
+
+# Function to process one S3 event record
+def process_record(record):
+    """
+    Generates and uploads the thumbnails of the video of one S3 event record.
+
+    Returns:
+    - result (dict): video_key, status ('succeeded' or 'failed'), the thumbnail keys uploaded,
+      the error if any and the seconds spent.
+    """
+    video_key = record['s3']['object']['key']
+    result = {'video_key': video_key, 'status': 'succeeded', 'thumbnails': [], 'error': None}
+    started = time.monotonic()
+
+    download_bytes = None
     try:
-        ffmpeg_command = [
-            ffmpeg_path, '-i', video_path, '-ss', frame, '-vframes', '1', 
-            '-vf', f'scale={width}:{height}', f'{frame_thumbnail}.{format}'
-        ]
-        subprocess.run(ffmpeg_command, check=True)
-        if not os.path.exists(f'{frame_thumbnail}.{format}'):
-            raise Exception(f'Thumbnail {frame_thumbnail}.{format} was not created successfully.')
-    except subprocess.CalledProcessError as e:
-        print(f'FFmpeg error: {str(e)}')
-        raise
+        print(f'Processing video: {video_key}')  # Additional logging
+
+        # Parse the video key to get the desired root directory and video filename
+        key_parts = video_key.split('/')
+        if len(key_parts) < 5:
+            raise Exception(f'Unexpected video key format: {video_key}')
+        
+        root_dir = '/'.join(key_parts[:-2])  # Root directory based on your key format
+
+        # Wait for room in /tmp for the download, unless a warm container already holds the video
+        head = s3.head_object(Bucket=source_bucket_name, Key=video_key)
+        expected_bytes = expected_download_bytes(source_bucket_name, video_key, head)
+        admit_record(video_key, expected_bytes)
+        download_bytes = expected_bytes
+
+        with s3_download(source_bucket_name, video_key, head) as local_video_path:
+            backend = decode_backend.get_backend(decode_backend_name, ffmpeg_path)
+            # FFmpeg needs the duration and keyframes up front to clamp and seek, PyAV reads them itself
+            probe = probe_cache.get(local_video_path, source_bucket_name, video_key, head['ETag']) if backend.name == 'ffmpeg' else None
+            with backend.open(local_video_path, probe) as video:
+                # Thumbnail keys do not name the frame, see time_frames
+                frame = time_frames[0]
+                if select_best_frames:
+                    frame = frame_selection.select_frame(video, frame, selection_window)
+                if backend.name == 'pyav':
+                    thumbnails = decode_backend.render_thumbnails(video, frame, sizes, format, downscale_from_largest)
+                else:
+                    # Decode the frame once and keep every size in memory, nothing is written to /tmp
+                    thumbnails = video.encode_thumbnails(parse_timestamp(frame), sizes, format)
+                for name, image in thumbnails:
+                    thumbnail_key = f'{root_dir}/{name}.{format}'
+                    s3_upload_bytes(thumbnail_key, destination_bucket_name, image)
+                    result['thumbnails'].append(thumbnail_key)
+
+        # The video stays in the source cache for the next invocations, evicted when over budget
+        log_tmp_usage(f'after processing {video_key}')
 
-# Function to upload a file to S3
-def s3_upload(file_key, bucket_name, image_file):
-    try:
-        print(f'Uploading file {image_file} to {bucket_name} bucket on the path {file_key}')
-        with open(image_file, 'rb') as f:
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=file_key,
-                Body=f
-            )
     except Exception as e:
-        print(f'Error uploading thumbnail to S3: {str(e)}')
-        raise
+        print(f'Error in processing {video_key}: {str(e)}')
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    finally:
+        if download_bytes is not None:
+            release_record(download_bytes)
+
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
 
 # Lambda function handler
 def lambda_handler(event, context):
-    # List contents of /tmp at the start of the process
-    print("Contents of /tmp before starting the process:")
-    subprocess.run(['ls', '-lh', '/tmp'])
-    
-    for record in event['Records']:
-        video_key = record['s3']['object']['key']
-        local_video_path = f'/tmp/{os.path.basename(video_key)}'
-        output_dir = '/tmp'
-
-        try:
-            print(f'Processing video: {video_key}')  # Additional logging
-            # Download video from S3
-            s3_download(source_bucket_name, video_key, local_video_path)
-            
-            # Parse the video key to get the desired root directory and video filename
-            key_parts = video_key.split('/')
-            print(f'Key Parts: {key_parts}')  # Debug statement to inspect the key parts
-            
-            if len(key_parts) < 5:
-                raise Exception(f'Unexpected video key format: {video_key}')
-            
-            root_dir = '/'.join(key_parts[:-2])  # Root directory based on your key format
-            video_filename = os.path.splitext(key_parts[-1])[0]  # Video filename without extension
-
-            for frame in time_frames:
-                for width, height, name in sizes:
-                    frame_thumbnail = os.path.join(output_dir, f'{name}')
-                    create_thumbnail(local_video_path, frame, frame_thumbnail, width, height)
-                    thumbnail_key = f'{root_dir}/{name}.{format}'
-                    s3_upload(thumbnail_key, destination_bucket_name, f'{frame_thumbnail}.{format}')
-                    
-                    # List contents of /tmp before removing thumbnail
-                    print("Contents of /tmp before removing thumbnail:")
-                    subprocess.run(['ls', '-lh', '/tmp'])
-
-                    # Clean up each thumbnail after upload
-                    thumbnail_path = f'{frame_thumbnail}.{format}'
-                    if os.path.exists(thumbnail_path):
-                        os.remove(thumbnail_path)
-                        print(f'Thumbnail {thumbnail_path} removed from /tmp/')  # Added print to signal deletion
-                    
-                    # List contents of /tmp after removing thumbnail
-                    print("Contents of /tmp after removing thumbnail:")
-                    subprocess.run(['ls', '-lh', '/tmp'])
-
-            # List contents of /tmp before removing video
-            print("Contents of /tmp before removing video:")
-            subprocess.run(['ls', '-lh', '/tmp'])
-
-            # Clean up local video file
-            os.remove(local_video_path)
-            print(f'Video {local_video_path} removed from /tmp/')  # Additional print for video removal
-
-            # List contents of /tmp after removing video
-            print("Contents of /tmp after removing video:")
-            subprocess.run(['ls', '-lh', '/tmp'])
-
-        except Exception as e:
-            print(f'Error in processing: {str(e)}')
-
+    log_tmp_usage('before starting the process')
+
+    records = event.get('Records', [])
+    with ThreadPoolExecutor(max_workers=max(1, min(record_workers, len(records)))) as executor:
+        results = list(executor.map(process_record, records))
+
+    failed = sum(1 for result in results if result['status'] == 'failed')
+    log_tmp_usage('after processing the event')
+
+    # 200 when every record succeeded, 207 when only some did, 500 when all of them failed
+    if not failed:
+        status_code = 200
+    elif failed < len(results):
+        status_code = 207
+    else:
+        status_code = 500
     return {
-        'statusCode': 200,
-        'body': 'Thumbnails generated, uploaded, and cleaned up successfully!'
+        'statusCode': status_code,
+        'body': json.dumps({
+            'succeeded': len(results) - failed,
+            'failed': failed,
+            'records': results
+        })
     }
@@ -0,0 +1,188 @@
+"""
+Runs AWS Rekognition label detection over many videos and collects their key frames.
+
+It performs the following steps for every video:
+1. Reads the ETag of the video and returns the cached labels when this version of the video was
+   already analyzed, so repeat runs never start a new job for it.
+2. Starts a label detection job, retrying with backoff while the account is at its limit of
+   concurrent jobs or the API is throttled, up to a number of attempts and a deadline.
+3. Polls the job with exponential backoff instead of a fixed sleep, one label per poll.
+4. Streams every page of the results (following NextToken) and caches the labels as JSON.
+
+At most `concurrency` videos are analyzed at the same time. The Rekognition and S3 clients and
+the sleep function are passed in, so the orchestrator can run against local fakes.
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Labels whose timestamps are used as key frames
+LABELS_OF_INTEREST = ['Person', 'Face', 'Object', 'Scene']
+
+
+def wait_for_job(rekognition, job_id, initial_delay=2, max_delay=60, timeout=None, sleep=time.sleep):
+    """
+    Polls a label detection job until it leaves IN_PROGRESS, doubling the delay between polls.
+    Polls ask for a single label, the results are paged by iter_labels once the job finished.
+
+    Args:
+    - rekognition (botocore client): Rekognition client.
+    - job_id (str): ID of the label detection job.
+    - initial_delay, max_delay (float): First and largest delay between polls, in seconds.
+    - timeout (float): Seconds to wait before giving up, no limit when None.
+    - sleep (callable): Function used to wait between polls.
+
+    Returns:
+    - status (dict): First page (of at most one label) of get_label_detection once the job finished.
+    """
+    delay = initial_delay
+    waited = 0
+    while True:
+        status = rekognition.get_label_detection(JobId=job_id, SortBy='TIMESTAMP', MaxResults=1)
+        if status['JobStatus'] != 'IN_PROGRESS':
+            return status
+        if timeout is not None and waited >= timeout:
+            raise TimeoutError(f'Label detection job {job_id} still in progress after {waited} seconds')
+        print(f'Job {job_id} in progress, checking again in {delay} seconds...')
+        sleep(delay)
+        waited += delay
+        delay = min(delay * 2, max_delay)
+
+
+def iter_labels(rekognition, job_id, first_page=None):
+    """
+    Lazily yields every label detection of a finished job, following NextToken across pages.
+
+    Args:
+    - rekognition (botocore client): Rekognition client.
+    - job_id (str): ID of the label detection job.
+    - first_page (dict): First page when it was already fetched (e.g. by wait_for_job).
+    """
+    page = first_page or rekognition.get_label_detection(JobId=job_id, SortBy='TIMESTAMP')
+    while True:
+        if page['JobStatus'] != 'SUCCEEDED':
+            raise RuntimeError(f'Label detection job {job_id} ended with status {page["JobStatus"]}: {page.get("StatusMessage")}')
+        yield from page['Labels']
+        next_token = page.get('NextToken')
+        if not next_token:
+            return
+        page = rekognition.get_label_detection(JobId=job_id, SortBy='TIMESTAMP', NextToken=next_token)
+
+
+def key_frames_from_labels(labels, labels_of_interest=LABELS_OF_INTEREST):
+    """Returns the timestamps (in milliseconds) of the labels of interest, without duplicates."""
+    return sorted({label['Timestamp'] for label in labels if label['Name'] in labels_of_interest})
+
+
+class LabelDetectionOrchestrator:
+    def __init__(self, rekognition, s3, bucket, concurrency=5, cache_dir='rekognition_cache',
+                 initial_delay=2, max_delay=60, timeout=None, max_start_attempts=20, start_timeout=900, sleep=time.sleep):
+        """
+        Args:
+        - rekognition, s3 (botocore client): Clients used for the jobs and the ETag lookups.
+        - bucket (str): S3 bucket where the videos are stored.
+        - concurrency (int): Label detection jobs running at the same time.
+        - cache_dir (str): Directory of the per-ETag JSON result cache (None disables it).
+        - initial_delay, max_delay, timeout (float): Polling backoff, see wait_for_job.
+        - max_start_attempts (int): Attempts to start a job while throttled before giving up.
+        - start_timeout (float): Seconds spent waiting to start a job before giving up, no limit when None.
+        - sleep (callable): Function used to wait between polls and retries.
+        """
+        self.rekognition = rekognition
+        self.s3 = s3
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.cache_dir = cache_dir
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.max_start_attempts = max_start_attempts
+        self.start_timeout = start_timeout
+        self.sleep = sleep
+        self.errors = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, video_key, etag):
+        name = hashlib.sha256(f'{self.bucket}/{video_key}'.encode()).hexdigest()[:32]
+        etag = etag.strip('"')
+        return os.path.join(self.cache_dir, f'{name}-{etag}.json')
+
+    def start_job(self, video_key):
+        """
+        Starts a label detection job, backing off while too many jobs are running or the API is
+        throttled. The last error is raised after `max_start_attempts` attempts, or once the next
+        wait would pass `start_timeout` seconds of waiting.
+        """
+        retryable = (
+            self.rekognition.exceptions.LimitExceededException,
+            self.rekognition.exceptions.ThrottlingException,
+            self.rekognition.exceptions.ProvisionedThroughputExceededException
+        )
+        delay = self.initial_delay
+        waited = 0
+        for attempt in range(1, self.max_start_attempts + 1):
+            try:
+                response = self.rekognition.start_label_detection(
+                    Video={'S3Object': {'Bucket': self.bucket, 'Name': video_key}}
+                )
+                print(f'Started video analysis of {video_key}, JobId: {response["JobId"]}')
+                return response['JobId']
+            except retryable as e:
+                if attempt == self.max_start_attempts or (self.start_timeout is not None and waited + delay > self.start_timeout):
+                    raise
+                print(f'{type(e).__name__} starting {video_key}, retrying in {delay} seconds ({attempt}/{self.max_start_attempts})...')
+                self.sleep(delay)
+                waited += delay
+                delay = min(delay * 2, self.max_delay)
+
+    def analyze(self, video_key):
+        """
+        Returns the labels detected in one video, from the cache when its ETag was already analyzed.
+
+        Returns:
+        - labels (list): Dicts with the Timestamp (ms), Name and Confidence of every detection.
+        """
+        etag = self.s3.head_object(Bucket=self.bucket, Key=video_key)['ETag']
+        path = self.cache_path(video_key, etag) if self.cache_dir else None
+        if path and os.path.exists(path):
+            print(f'Using cached labels of {video_key} ({etag})')
+            with open(path) as f:
+                return json.load(f)['labels']
+
+        job_id = self.start_job(video_key)
+        first_page = wait_for_job(self.rekognition, job_id, self.initial_delay, self.max_delay, self.timeout, self.sleep)
+        labels = [
+            {'Timestamp': label['Timestamp'], 'Name': label['Label']['Name'], 'Confidence': label['Label'].get('Confidence')}
+            for label in iter_labels(self.rekognition, job_id, first_page)
+        ]
+
+        if path:
+            # Write then rename so an interrupted run never leaves a partial cache entry
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump({'video_key': video_key, 'etag': etag, 'job_id': job_id, 'labels': labels}, f)
+            os.replace(f'{path}.tmp', path)
+        return labels
+
+    def run(self, video_keys, labels_of_interest=LABELS_OF_INTEREST):
+        """
+        Analyzes every video, at most `concurrency` at a time.
+
+        Returns:
+        - key_frames (dict): Timestamps (in milliseconds) of the labels of interest per video key.
+          Videos that failed are listed in `self.errors` instead.
+        """
+        def analyze(video_key):
+            try:
+                return video_key, key_frames_from_labels(self.analyze(video_key), labels_of_interest)
+            except Exception as e:
+                print(f'Error analyzing {video_key}: {str(e)}')
+                self.errors[video_key] = str(e)
+                return video_key, None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = pool.map(analyze, video_keys)
+            return {video_key: key_frames for video_key, key_frames in results if key_frames is not None}
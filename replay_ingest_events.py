@@ -0,0 +1,72 @@
+import json
+import os
+from datetime import datetime, timezone
+from ingest_counters import IngestCounters
+
+# This script replays recorded S3 event notifications into a local ingest counters store (see ingest_counters.py),
+# so the incremental mode of s3_report.py can be tested and compared with a full scan without AWS.
+# It performs the following steps:
+# 1. Reads the events from `events_path`: a JSON file with one event ({"Records": [...]}), a JSON array of events,
+#    a JSON Lines file with one event per line, or a directory of such files (read in name order), such as a copy of
+#    the event objects s3_report.py saves under 'report/ingest_events/<day>/'.
+# 2. Optionally seeds the store from a listing saved as JSON (the 'Contents' entries of list_objects_v2).
+# 3. Applies the events in batches, like the daily run of s3_report.py applies the event objects; late, repeated and
+#    out of order events are resolved by their sequencer.
+# 4. Prints the report of `report_date` in the same format as s3_report.py.
+
+# Recorded events and the local SQLite store they are replayed into
+events_path = 'events'
+db_path = 'ingest_counters.db'
+
+# Listing used to seed an empty store (None starts from an empty bucket)
+bootstrap_listing_path = None
+
+# Records applied per transaction
+batch_size = 100
+
+# Day of the report ('YYYY-MM-DD', UTC), today when None
+report_date = None
+
+# Function to list the event files to replay, in name order
+def list_event_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(('.json', '.jsonl'))]
+    return [path]
+
+# Function to read every S3 event record of one file
+def read_records(file_path):
+    with open(file_path) as f:
+        content = f.read()
+    try:
+        events = json.loads(content)
+        events = events if isinstance(events, list) else [events]
+    except json.JSONDecodeError:
+        # JSON Lines, one event per line
+        events = [json.loads(line) for line in content.splitlines() if line.strip()]
+    return [record for event in events for record in event.get('Records', []) if 's3' in record]
+
+# Function to replay the events into the store
+def replay(counters, path):
+    replayed = applied = 0
+    for file_path in list_event_files(path):
+        records = read_records(file_path)
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            applied += counters.apply_records(batch)
+            replayed += len(batch)
+        print(f'Replayed {len(records)} records from {file_path}')
+    return replayed, applied
+
+if __name__ == '__main__':
+    counters = IngestCounters(db_path)
+    try:
+        if bootstrap_listing_path and not counters.is_bootstrapped():
+            with open(bootstrap_listing_path) as f:
+                counters.bootstrap(json.load(f))
+        replayed, applied = replay(counters, events_path)
+        print(f'{applied} of {replayed} records changed the store (the others were stale, repeated or not .mp4)')
+
+        day = report_date or datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        print(json.dumps(counters.report(day), indent=4))
+    finally:
+        counters.close()
@@ -1,18 +1,23 @@
 import json
 import boto3
+import s3_listing
 from datetime import datetime
+from report_writer import write_day_report
 
 # This AWS Lambda function interacts with an S3 bucket named 'media-ingest-temporary'.
 # It performs the following steps:
 # 1. Initializes an S3 client using boto3.
 # 2. Retrieves the current date in the format 'YYYY-MM-DD'.
-# 3. Iterates through all objects in the specified S3 bucket using pagination.
-# 4. Filters objects to include only those with the .mp4 extension and whose LastModified date matches the current date.
-# 5. Collects the filtered objects' keys and their last modified timestamps into a list.
-# 6. Constructs a JSON report that includes the total count of filtered files and their details.
-# 7. Saves the JSON report to the same S3 bucket under the 'report/' directory, naming the file with the current date.
-# 8. Returns a success response with the report data if successful.
-# 9. Handles any exceptions by returning an error response with a 500 status code and the error message.
+# 3. Iterates through all objects in the specified S3 bucket, listing its prefixes concurrently (see s3_listing.py).
+# 4. Counts the objects with the .mp4 extension and keeps those whose LastModified date matches the current date.
+# 5. Streams the report to the same S3 bucket under the 'report/' directory, naming the file with the current date:
+#    gzip-compressed JSON Lines (see report_writer.py), one line per filtered file and a last line with the total
+#    count of files and today's count. Nothing is collected in memory, so it stays flat whatever the size of the bucket.
+# 6. Returns a success response with the counts and the report key if successful.
+# 7. Handles any exceptions by returning an error response with a 500 status code and the error message.
+
+# Concurrent list_objects_v2 requests, one prefix shard each
+listing_workers = 16
 
 def lambda_handler(event, context):
     # Initialize an S3 client
@@ -23,64 +28,14 @@ def lambda_handler(event, context):
     current_date = datetime.now().strftime('%Y-%m-%d')
 
     try:
-        day_objects = []
-        all_objects = []
-        continuation_token = None
-
-        # Loop to handle paginated results from S3
-        while True:
-            if continuation_token:
-                # List objects with continuation token if it exists
-                response = s3.list_objects_v2(
-                    Bucket=bucket_name,
-                    ContinuationToken=continuation_token
-                )
-            else:
-                # List objects without continuation token
-                response = s3.list_objects_v2(Bucket=bucket_name)
-
-            # Ensure 'Contents' exists in the response
-            if 'Contents' in response:
-                # Filter objects by .mp4 extension and current date
-                filtered_objects = [
-                    {'Key': obj['Key'], 'LastModified': obj['LastModified'].isoformat()}
-                    for obj in response['Contents']
-                    if obj['Key'].endswith('.mp4') and obj['LastModified'].strftime('%Y-%m-%d') == current_date
-                ]
-
-                # Get all .mp4 objects
-                all_mp4_objects = [
-                    {'Key': obj['Key'], 'LastModified': obj['LastModified'].isoformat()}
-                    for obj in response['Contents']
-                    if obj['Key'].endswith('.mp4')
-                ]
-
-                # Append all objects to the list
-                all_objects.extend(all_mp4_objects)
-
-                # Append filtered objects to the list
-                day_objects.extend(filtered_objects)
-
-            # Check if there are more objects to fetch
-            if 'NextContinuationToken' in response:
-                continuation_token = response['NextContinuationToken']
-            else:
-                break
-
-        # Include the total count at the beginning of the JSON data
-        output_data = {
-            'total_files_until_current_date': len(all_objects),
-            'total_files_today': len(day_objects),
-            'Files': day_objects
-        }
-
-        # Convert the output data to JSON with pretty-printing and save to S3
-        json_data = json.dumps(output_data, indent=4)
-        file_key = f"report/mp4_objects_{current_date}.json"
+        file_key = f"report/mp4_objects_{current_date}.jsonl.gz"
 
-        # Upload the JSON report to the specified S3 bucket
-        s3.put_object(Bucket=bucket_name, Key=file_key, Body=json_data)
+        # Stream the report to S3 while listing: every .mp4 object is counted, only today's are written
+        mp4_objects = s3_listing.iter_objects(s3, bucket_name, suffix='.mp4', ordered=True, workers=listing_workers)
+        output_data = write_day_report(s3, bucket_name, file_key, current_date, mp4_objects)
 
+        # The response only carries the counts, the list of files is in the report
+        output_data['report_key'] = file_key
         return {
             'statusCode': 200,
             'body': json.dumps(output_data, indent=4)
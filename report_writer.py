@@ -0,0 +1,127 @@
+"""
+Streams reports to S3 as gzip-compressed JSON Lines, in constant memory.
+
+Records are compressed as they are written and every `part_size` bytes of compressed output
+are sent as one part of a multipart upload, so memory stays at about one part whatever the
+number of records. A report smaller than one part is sent with a single put_object instead.
+If writing fails, the multipart upload is aborted so no orphaned parts are left behind.
+
+`write_day_report` streams the .mp4 objects of one day from any iterable of objects and only
+counts the others, then appends a summary line with the totals.
+"""
+
+import json
+import zlib
+
+# Compressed bytes per uploaded part (S3 requires at least 5 MiB for every part but the last)
+PART_SIZE = 8 * 1024 ** 2
+
+
+class GzipJsonLinesWriter:
+    def __init__(self, s3, bucket_name, key, part_size=PART_SIZE):
+        """
+        Args:
+        - s3 (botocore client): S3 client used for the upload.
+        - bucket_name (str): Destination bucket.
+        - key (str): Destination key, usually ending with .jsonl.gz.
+        - part_size (int): Compressed bytes per part, at least 5 MiB.
+        """
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.records = 0
+        self.compressed_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record):
+        """Appends one record (any JSON-serializable value) as a line."""
+        line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        self.buffer += self.compressor.compress(line.encode())
+        self.records += 1
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.key, ContentType='application/gzip')
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.compressed_bytes += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        """Flushes the compressor and completes the upload."""
+        self.buffer += self.compressor.flush()
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer), ContentType='application/gzip')
+            self.compressed_bytes += len(self.buffer)
+            self.buffer = bytearray()
+            return
+        self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        """Drops the parts uploaded so far."""
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def write_day_report(s3, bucket_name, report_key, current_date, objects, total=None):
+    """
+    Streams the report of one day to S3.
+
+    Each line of the report is one file {"Key", "LastModified"} uploaded on `current_date`. The
+    last line holds the totals {"total_files_until_current_date", "total_files_today"}.
+
+    Args:
+    - s3 (botocore client): S3 client used for the upload.
+    - bucket_name, report_key (str): Where the report is written.
+    - current_date (str): Day of the report, 'YYYY-MM-DD'.
+    - objects (iterable): .mp4 objects with Key and LastModified (datetime or ISO string). Only
+      the objects of `current_date` are written, the others are only counted.
+    - total (int): Total number of .mp4 objects when it is known without counting `objects`
+      (which then only holds the objects of the day).
+
+    Returns:
+    - summary (dict): The totals, as written on the last line.
+    """
+    counted = 0
+    today = 0
+    with GzipJsonLinesWriter(s3, bucket_name, report_key) as writer:
+        for obj in objects:
+            counted += 1
+            last_modified = obj['LastModified']
+            if not isinstance(last_modified, str):
+                last_modified = last_modified.isoformat()
+            if last_modified[:10] == current_date:
+                writer.write({'Key': obj['Key'], 'LastModified': last_modified})
+                today += 1
+        summary = {
+            'total_files_until_current_date': counted if total is None else total,
+            'total_files_today': today
+        }
+        writer.write(summary)
+    print(f'Wrote {writer.records} lines ({writer.compressed_bytes} compressed bytes) to s3://{bucket_name}/{report_key}')
+    return summary
@@ -0,0 +1,283 @@
+"""
+Local catalog of the objects of S3 buckets, stored in a SQLite database.
+
+Every object is recorded with its key, size, ETag and LastModified, so the scripts that need
+the contents of a bucket query the catalog instead of listing it again on every run.
+
+The catalog is refreshed per shard, the prefixes found by `s3_listing.discover_shards`
+(1014000000/1014080000/ with our numeric hierarchy). A refresh always re-discovers the shards,
+which only lists the top levels of the bucket, then only lists again:
+- shards that were never listed (new prefixes),
+- shards listed longer than `max_age` ago, oldest first (at most `max_shards` per refresh),
+- the prefixes passed explicitly, e.g. those of the videos known to have been uploaded.
+Shards that disappeared are dropped with their objects. Objects found above the shards while
+discovering them are replaced on every refresh.
+
+Objects uploaded into a shard since it was last listed are not in the catalog until it is listed
+again, so the data served can be up to `max_age` old. The scripts only use the catalog when
+catalog_path is set, and every refresh logs how old its oldest listing is. MAX_AGE is kept below
+the daily cadence of the jobs, so a run that starts a little early still lists yesterday's shards.
+
+Queries filter by prefix, suffix, LastModified range and ID range (the numeric value of one
+component of the key) and use the indexes on key and LastModified.
+"""
+
+import bisect
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import s3_listing
+
+# Shards listed more recently than this are not listed again, below the daily cadence of the jobs
+MAX_AGE = timedelta(hours=20)
+
+# LastModified is stored with a fixed width so it sorts as text
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def format_time(value):
+    """Converts an aware datetime (naive ones are taken as UTC) to the stored text."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime(TIME_FORMAT)
+
+
+def parse_time(value):
+    """Converts the stored text back to an aware UTC datetime, like boto3 returns LastModified."""
+    return datetime.strptime(value, TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def key_part(key, level):
+    """Returns the numeric value of the component `level` (0 is the first) of a key, or None."""
+    parts = key.split('/')
+    if level < len(parts) and parts[level].isdigit():
+        return int(parts[level])
+    return None
+
+
+class S3Catalog:
+    def __init__(self, path='s3_catalog.db'):
+        """
+        Args:
+        - path (str): Location of the SQLite database file, created on first use.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # Buckets refreshed by this process, see ensure_fresh
+        self.refreshed = set()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.create_function('key_part', 2, key_part, deterministic=True)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT,
+                object_key TEXT,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                shard TEXT,
+                refresh TEXT,
+                PRIMARY KEY (bucket, object_key)
+            );
+            CREATE INDEX IF NOT EXISTS objects_by_shard ON objects (bucket, shard);
+            CREATE INDEX IF NOT EXISTS objects_by_last_modified ON objects (bucket, last_modified);
+            CREATE TABLE IF NOT EXISTS shards (
+                bucket TEXT,
+                prefix TEXT,
+                listed_at TEXT,
+                objects INTEGER,
+                PRIMARY KEY (bucket, prefix)
+            );
+        ''')
+        self.connection.commit()
+
+    def _store(self, bucket_name, shard, refresh, objects):
+        """Upserts one page of objects listed from `shard` (None for the objects above the shards)."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO objects (bucket, object_key, size, etag, last_modified, shard, refresh) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(bucket, object_key) DO UPDATE SET '
+                'size = excluded.size, etag = excluded.etag, last_modified = excluded.last_modified, '
+                'shard = excluded.shard, refresh = excluded.refresh',
+                [
+                    (bucket_name, obj['Key'], obj.get('Size'), obj.get('ETag'), format_time(obj['LastModified']), shard, refresh)
+                    for obj in objects
+                ]
+            )
+
+    def _list_shard(self, s3, bucket_name, shard, refresh):
+        """Lists a shard again and replaces its objects; returns the number of objects found."""
+        count = 0
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=shard):
+            objects = page.get('Contents', [])
+            if objects:
+                self._store(bucket_name, shard, refresh, objects)
+                count += len(objects)
+        with self.lock, self.connection:
+            # Objects not seen by this listing were deleted
+            self.connection.execute(
+                'DELETE FROM objects WHERE bucket = ? AND shard = ? AND refresh != ?', (bucket_name, shard, refresh)
+            )
+            self.connection.execute(
+                'INSERT INTO shards (bucket, prefix, listed_at, objects) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(bucket, prefix) DO UPDATE SET listed_at = excluded.listed_at, objects = excluded.objects',
+                (bucket_name, shard, refresh, count)
+            )
+        return count
+
+    def refresh(self, s3, bucket_name, max_age=MAX_AGE, max_shards=None, prefixes=None, depth=s3_listing.DEPTH, workers=s3_listing.WORKERS):
+        """
+        Brings the catalog of a bucket up to date by listing only the shards that need it.
+
+        Args:
+        - s3 (botocore client): S3 client, shared by the workers.
+        - bucket_name (str): Bucket to refresh.
+        - max_age (timedelta): Shards listed longer ago are listed again; None lists only new shards.
+        - max_shards (int): Most stale shards listed again, oldest first, so a large bucket can be
+          refreshed over several runs. New shards are always listed.
+        - prefixes (list): Keys or prefixes known to have changed; the shards holding them are listed again.
+        - depth, workers: See `s3_listing.discover_shards`.
+
+        Returns:
+        - stats (dict): Shards found, listed again and dropped, objects listed, and the age
+          (timedelta) of the oldest listing the catalog now serves.
+        """
+        refresh = format_time(datetime.now(timezone.utc))
+        shards, objects = s3_listing.discover_shards(s3, bucket_name, depth=depth, workers=workers)
+
+        with self.lock:
+            listed_at = dict(self.connection.execute(
+                'SELECT prefix, listed_at FROM shards WHERE bucket = ?', (bucket_name,)
+            ).fetchall())
+            catalog_shards = {row[0] for row in self.connection.execute(
+                'SELECT DISTINCT shard FROM objects WHERE bucket = ? AND shard IS NOT NULL', (bucket_name,)
+            )}
+
+        # Shards that disappeared, or were split into new ones, are dropped
+        dropped = (set(listed_at) | catalog_shards) - set(shards)
+        with self.lock, self.connection:
+            for shard in dropped:
+                self.connection.execute('DELETE FROM objects WHERE bucket = ? AND shard = ?', (bucket_name, shard))
+                self.connection.execute('DELETE FROM shards WHERE bucket = ? AND prefix = ?', (bucket_name, shard))
+
+        # The objects above the shards were all listed by the discovery
+        self._store(bucket_name, None, refresh, objects)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM objects WHERE bucket = ? AND shard IS NULL AND refresh != ?', (bucket_name, refresh)
+            )
+
+        new = [shard for shard in shards if shard not in listed_at]
+        changed = set()
+        for prefix in prefixes or []:
+            # The shard holding the prefix sorts right before it, the shards under it right after
+            position = bisect.bisect_right(shards, prefix)
+            if position and prefix.startswith(shards[position - 1]):
+                changed.add(shards[position - 1])
+            for shard in shards[bisect.bisect_left(shards, prefix):]:
+                if not shard.startswith(prefix):
+                    break
+                changed.add(shard)
+        stale = []
+        if max_age is not None:
+            threshold = format_time(datetime.now(timezone.utc) - max_age)
+            stale = sorted(
+                (shard for shard in shards if shard in listed_at and listed_at[shard] < threshold and shard not in changed),
+                key=lambda shard: listed_at[shard]
+            )[:max_shards]
+        to_list = new + sorted(changed - set(new)) + stale
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            listed = sum(executor.map(lambda shard: self._list_shard(s3, bucket_name, shard, refresh), to_list))
+        self.refreshed.add(bucket_name)
+        with self.lock:
+            oldest = self.connection.execute('SELECT MIN(listed_at) FROM shards WHERE bucket = ?', (bucket_name,)).fetchone()[0]
+        age = datetime.now(timezone.utc) - parse_time(oldest) if oldest else timedelta(0)
+        stats = {
+            'shards': len(shards),
+            'listed_shards': len(to_list),
+            'dropped_shards': len(dropped),
+            'listed_objects': listed + len(objects),
+            'age': age
+        }
+        print(
+            f'Catalog of {bucket_name}: listed {len(to_list)} of {len(shards)} shards ({stats["listed_objects"]} objects), '
+            f'dropped {len(dropped)}; oldest listing served is {timedelta(seconds=int(age.total_seconds()))} old'
+        )
+        return stats
+
+    def ensure_fresh(self, s3, bucket_name, **refresh_args):
+        """
+        Refreshes the catalog of a bucket the first time it is used by this process, so a script
+        querying the same bucket many times only refreshes it once. Takes the arguments of `refresh`.
+
+        Returns:
+        - stats (dict): Statistics of the refresh, or None if the bucket was already refreshed.
+        """
+        if bucket_name in self.refreshed:
+            return None
+        return self.refresh(s3, bucket_name, **refresh_args)
+
+    def _where(self, bucket_name, prefix='', suffix=None, modified_since=None, modified_before=None, id_range=None, id_level=2):
+        """Builds the WHERE clause and parameters shared by `query` and `count`."""
+        conditions = ['bucket = ?']
+        params = [bucket_name]
+        if prefix:
+            # A range on the key uses the primary key index, unlike LIKE
+            conditions.append('object_key >= ? AND object_key < ?')
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if suffix:
+            conditions.append('substr(object_key, -?) = ?')
+            params += [len(suffix), suffix]
+        if modified_since is not None:
+            conditions.append('last_modified >= ?')
+            params.append(format_time(modified_since))
+        if modified_before is not None:
+            conditions.append('last_modified < ?')
+            params.append(format_time(modified_before))
+        if id_range is not None:
+            conditions.append('key_part(object_key, ?) BETWEEN ? AND ?')
+            params += [id_level, id_range[0], id_range[1]]
+        return ' AND '.join(conditions), params
+
+    def query(self, bucket_name, prefix='', suffix=None, modified_since=None, modified_before=None, id_range=None, id_level=2, batch_size=1000):
+        """
+        Lazily yields the catalogued objects of a bucket in key order, as list_objects_v2 'Contents'
+        entries (Key, Size, ETag and LastModified as an aware datetime).
+
+        Args:
+        - bucket_name (str): Bucket to query.
+        - prefix (str): Only keys starting with it.
+        - suffix (str): Only keys ending with it, like '.mp4'.
+        - modified_since, modified_before (datetime): Only objects with modified_since <= LastModified < modified_before.
+        - id_range (tuple): (first, last) IDs, inclusive; only keys whose component `id_level` is a
+          number in that range.
+        - id_level (int): Component of the key holding the ID (0 is the first), 2 for
+          1014000000/1014080000/1014080067/video/...
+        - batch_size (int): Rows read from the database at once.
+        """
+        where, params = self._where(bucket_name, prefix, suffix, modified_since, modified_before, id_range, id_level)
+        last_key = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    f'SELECT object_key, size, etag, last_modified FROM objects WHERE {where} AND object_key > ? '
+                    'ORDER BY object_key LIMIT ?', params + [last_key, batch_size]
+                ).fetchall()
+            for object_key, size, etag, last_modified in rows:
+                yield {'Key': object_key, 'Size': size, 'ETag': etag, 'LastModified': parse_time(last_modified)}
+            if len(rows) < batch_size:
+                return
+            last_key = rows[-1][0]
+
+    def count(self, bucket_name, prefix='', suffix=None, modified_since=None, modified_before=None, id_range=None, id_level=2):
+        """Returns the number of catalogued objects matching the same filters as `query`."""
+        where, params = self._where(bucket_name, prefix, suffix, modified_since, modified_before, id_range, id_level)
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM objects WHERE {where}', params).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
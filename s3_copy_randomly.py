@@ -2,10 +2,26 @@ import boto3
 import random
 from botocore.exceptions import NoCredentialsError
 import os
+import s3_inventory
+import s3_listing
+from s3_catalog import S3Catalog
 
 LOG_FILE = "copied_productions.log"
 MP4_KEYS_FILE = "copied_mp4_keys.log"
 
+# Concurrent list_objects_v2 requests used by list_objects
+LISTING_WORKERS = 16
+
+# Local catalog of the buckets shared by the scripts (see s3_catalog.py), e.g. "s3_catalog.db"; objects uploaded into a
+# prefix listed less than s3_catalog.MAX_AGE ago are not seen. None lists the buckets on every call
+CATALOG_PATH = None
+catalog = None
+
+# S3 Inventory of a bucket (manifest.json or configuration folder, s3://... or local, see s3_inventory.py), read
+# once per run instead of listing it, e.g. {"media-ingest-temporary": "s3://inventory-bucket/media-ingest-temporary/daily/"}
+INVENTORY_LOCATIONS = {}
+inventory_objects = {}
+
 def load_copied_productions():
     """Load the list of copied productions from the log file."""
     if os.path.exists(LOG_FILE):
@@ -25,12 +41,25 @@ def log_copied_mp4_key(key):
 
 def list_objects(s3_client, bucket_name, prefix):
     """List all objects in a bucket with the given prefix."""
+    global catalog
     print(f"Listing objects in bucket '{bucket_name}' with prefix '{prefix}'...")
-    paginator = s3_client.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-    objects = []
-    for page in pages:
-        objects.extend(page.get('Contents', []))
+    if bucket_name in INVENTORY_LOCATIONS:
+        if bucket_name not in inventory_objects:
+            inventory = s3_inventory.iter_objects(s3_client, INVENTORY_LOCATIONS[bucket_name])
+            inventory_objects[bucket_name] = sorted(inventory, key=lambda obj: obj['Key'])
+        objects = [obj for obj in inventory_objects[bucket_name] if obj['Key'].startswith(prefix)]
+        print(f"Total objects found: {len(objects)}")
+        return objects
+    if CATALOG_PATH:
+        # Each bucket is refreshed once per run, then every listing is a local query
+        if catalog is None:
+            catalog = S3Catalog(CATALOG_PATH)
+        catalog.ensure_fresh(s3_client, bucket_name, workers=LISTING_WORKERS)
+        objects = list(catalog.query(bucket_name, prefix=prefix))
+        print(f"Total objects found: {len(objects)}")
+        return objects
+    # The prefixes below `prefix` are listed concurrently (see s3_listing.py), then sorted back by key
+    objects = sorted(s3_listing.iter_objects(s3_client, bucket_name, prefix, workers=LISTING_WORKERS), key=lambda obj: obj['Key'])
     print(f"Total objects found: {len(objects)}")
     return objects
 
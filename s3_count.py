@@ -1,24 +1,47 @@
 import boto3
+import s3_inventory
+import s3_listing
+from s3_catalog import S3Catalog
 
 def count_mp4_files(bucket_name):
     # Inicializa o cliente S3
     s3 = boto3.client('s3')
     
+    if inventory_location:
+        # Lê o S3 Inventory mais recente do bucket (veja s3_inventory.py): poucos GETs em vez de milhões de LISTs,
+        # só a coluna Key é decodificada
+        return sum(1 for item in s3_inventory.iter_objects(s3, inventory_location, suffix='.mp4', columns=('Key',)))
+
+    if catalog_path:
+        # Atualiza só os prefixos novos ou antigos do catálogo local e conta com uma consulta
+        catalog = S3Catalog(catalog_path)
+        try:
+            catalog.refresh(s3, bucket_name, workers=listing_workers)
+            return catalog.count(bucket_name, suffix='.mp4')
+        finally:
+            catalog.close()
+
     # Conta de arquivos .mp4
     mp4_count = 0
     
-    # Pagina através de todos os objetos no bucket
-    paginator = s3.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name)
-    
-    for page in page_iterator:
-        if 'Contents' in page:
-            for item in page['Contents']:
-                if item['Key'].endswith('.mp4'):
-                    mp4_count += 1
+    # Lista os prefixos do bucket em paralelo (veja s3_listing.py), o filtro .mp4 é aplicado durante a listagem
+    for item in s3_listing.iter_objects(s3, bucket_name, suffix='.mp4', workers=listing_workers):
+        mp4_count += 1
     
     return mp4_count
 
+# Requisições list_objects_v2 simultâneas
+listing_workers = 32
+
+# Catálogo local dos buckets (veja s3_catalog.py), compartilhado com os outros scripts, por exemplo 's3_catalog.db'.
+# Prefixos listados há menos de s3_catalog.MAX_AGE não são listados de novo, então a contagem pode não incluir os
+# uploads mais recentes; None lista o bucket inteiro
+catalog_path = None
+
+# S3 Inventory do bucket: manifest.json ou pasta da configuração (s3://... ou local), a contagem fica com a data
+# do inventário; None usa o catálogo ou a listagem
+inventory_location = None
+
 # Nome do bucket
 bucket_name = 'avs-vod-mc-input-2c87c40d939653bdbef99ff1ce204afc'
 
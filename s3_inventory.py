@@ -0,0 +1,264 @@
+"""
+Reads the objects of a bucket from its S3 Inventory instead of listing it.
+
+S3 Inventory writes, daily or weekly, a manifest.json and data files listing every object of the
+source bucket, under <destination prefix>/<source bucket>/<configuration ID>/. Reading them costs
+a handful of GET requests whatever the size of the bucket, where list_objects_v2 costs one request
+per 1000 objects.
+
+`iter_objects` yields the same entries as the list_objects_v2 'Contents' (Key, Size, ETag with
+quotes, LastModified as an aware datetime, StorageClass) with the filters of
+`s3_listing.iter_objects`, so it can replace a listing anywhere. The inventory location is either:
+- an S3 URI (s3://bucket/prefix/...), read with the given S3 client, or
+- a local copy of the configuration folder (its data/ folder and its dated manifest folders).
+It can point at one manifest.json, or at the configuration folder to read its latest manifest.
+
+Data files are streamed:
+- CSV (gzip): decompressed while downloading, one row at a time. Keys are URL-encoded in CSV
+  inventories (spaces as '+') and are decoded.
+- Parquet and ORC: need pyarrow (pip install pyarrow). Only the columns asked for are decoded,
+  one row group or stripe at a time. Files on S3 are downloaded to a temporary file first, since
+  both formats are read from their footer.
+
+Versioned inventories list every version; only the latest versions that are not delete markers
+are yielded, like list_objects_v2.
+
+Dependencies:
+- pyarrow, optional, for Parquet and ORC inventories
+"""
+
+import csv
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+try:
+    import pyarrow.orc as orc
+except ImportError:
+    orc = None
+
+from s3_listing import object_filter
+
+# Columns read when none are asked for, as named in list_objects_v2 entries
+COLUMNS = ('Key', 'Size', 'ETag', 'LastModified', 'StorageClass')
+
+# Inventory fields (snake_case, as named in Parquet and ORC files) and their list_objects_v2 names
+FIELDS = {
+    'key': 'Key',
+    'size': 'Size',
+    'e_tag': 'ETag',
+    'last_modified_date': 'LastModified',
+    'storage_class': 'StorageClass',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker'
+}
+
+# Needed to skip the old versions and delete markers of versioned inventories
+VERSION_FIELDS = ('is_latest', 'is_delete_marker')
+
+# Name of the dated folders holding the manifests of an inventory configuration
+MANIFEST_FOLDER = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/?$')
+
+# Rows decoded at once from Parquet files
+BATCH_SIZE = 65536
+
+
+def snake_case(name):
+    """Converts a CSV fileSchema name (LastModifiedDate, ETag) to its Parquet/ORC name (last_modified_date, e_tag)."""
+    return re.sub(r'(?<!^)(?=[A-Z][a-z])', '_', name).lower()
+
+
+def parse_location(location):
+    """
+    Splits an inventory location.
+
+    Returns:
+    - (bucket_name, path) (tuple): The bucket and key of an s3:// URI, or None and the local path.
+    """
+    if location.startswith('s3://'):
+        bucket_name, _, key = location[len('s3://'):].partition('/')
+        return bucket_name, key
+    return None, location
+
+
+def find_manifest(location, s3=None):
+    """
+    Returns the location of the manifest to read: `location` itself when it is a manifest.json,
+    otherwise the latest manifest of the configuration folder `location`.
+    """
+    if location.endswith('manifest.json'):
+        return location
+    bucket_name, path = parse_location(location)
+    if bucket_name is None:
+        folders = [name for name in os.listdir(path) if MANIFEST_FOLDER.match(name)]
+        for folder in sorted(folders, reverse=True):
+            manifest_path = os.path.join(path, folder, 'manifest.json')
+            if os.path.exists(manifest_path):
+                return manifest_path
+    else:
+        prefix = path.rstrip('/') + '/' if path else ''
+        folders = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            folders.extend(
+                common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])
+                if MANIFEST_FOLDER.match(common_prefix['Prefix'][len(prefix):])
+            )
+        # A manifest is written once all its data files are, the newest folder may not have it yet
+        for folder in sorted(folders, reverse=True):
+            response = s3.list_objects_v2(Bucket=bucket_name, Prefix=f'{folder}manifest.json', MaxKeys=1)
+            if response.get('KeyCount'):
+                return f's3://{bucket_name}/{folder}manifest.json'
+    raise FileNotFoundError(f'No inventory manifest found under {location}')
+
+
+def read_manifest(location, s3=None):
+    """
+    Reads an inventory manifest.
+
+    Returns:
+    - manifest (dict): The manifest.json content, with 'location' set to where it was read from.
+    """
+    location = find_manifest(location, s3)
+    bucket_name, path = parse_location(location)
+    if bucket_name is None:
+        with open(path) as f:
+            manifest = json.load(f)
+    else:
+        manifest = json.loads(s3.get_object(Bucket=bucket_name, Key=path)['Body'].read())
+    manifest['location'] = location
+    return manifest
+
+
+def data_file_location(manifest, data_key):
+    """Returns where a data file of the manifest is: in the destination bucket, or in the local copy's data/ folder."""
+    bucket_name, path = parse_location(manifest['location'])
+    if bucket_name is None:
+        configuration_path = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        return os.path.join(configuration_path, 'data', os.path.basename(data_key))
+    return f's3://{manifest["destinationBucket"].split(":::")[-1]}/{data_key}'
+
+
+def to_object(row):
+    """Converts an inventory row (snake_case fields) to a list_objects_v2 entry."""
+    obj = {FIELDS[name]: value for name, value in row.items() if name in FIELDS and name not in VERSION_FIELDS}
+    if obj.get('Size') not in (None, ''):
+        obj['Size'] = int(obj['Size'])
+    if obj.get('ETag'):
+        obj['ETag'] = f'"{obj["ETag"]}"'
+    last_modified = obj.get('LastModified')
+    if isinstance(last_modified, str) and last_modified:
+        last_modified = datetime.fromisoformat(last_modified.replace('Z', '+00:00'))
+    if isinstance(last_modified, datetime):
+        obj['LastModified'] = last_modified if last_modified.tzinfo else last_modified.replace(tzinfo=timezone.utc)
+    return obj
+
+
+def is_current(row):
+    """False for the old versions and delete markers of a versioned inventory."""
+    for name in VERSION_FIELDS:
+        value = row.get(name)
+        if isinstance(value, str):
+            value = value.lower() == 'true' if value else None
+        if value is not None and value != (name == 'is_latest'):
+            return False
+    return True
+
+
+def iter_csv_rows(stream, schema, fields):
+    """Yields the rows of a gzip CSV data file as dictionaries of the projected fields."""
+    names = [snake_case(name.strip()) for name in schema.split(',')]
+    positions = [(position, name) for position, name in enumerate(names) if name in fields]
+    with gzip.open(stream, 'rt', newline='') as text:
+        for values in csv.reader(text):
+            row = {name: values[position] for position, name in positions}
+            if 'key' in row:
+                row['key'] = unquote_plus(row['key'])
+            yield row
+
+
+def iter_arrow_rows(path, file_format, fields):
+    """Yields the rows of a Parquet or ORC data file as dictionaries of the projected fields."""
+    if (parquet if file_format == 'Parquet' else orc) is None:
+        raise ImportError(f'pyarrow is not installed, install it with "pip install pyarrow" to read {file_format} inventories.')
+    if file_format == 'Parquet':
+        data_file = parquet.ParquetFile(path)
+        columns = [name for name in data_file.schema_arrow.names if name in fields]
+        batches = data_file.iter_batches(batch_size=BATCH_SIZE, columns=columns)
+    else:
+        data_file = orc.ORCFile(path)
+        columns = [name for name in data_file.schema.names if name in fields]
+        batches = (data_file.read_stripe(stripe, columns=columns) for stripe in range(data_file.nstripes))
+    for batch in batches:
+        yield from batch.to_pylist()
+
+
+def iter_data_file(location, file_format, schema, fields, s3=None):
+    """Yields the rows of one data file, local or on S3."""
+    bucket_name, path = parse_location(location)
+    if file_format == 'CSV':
+        if bucket_name is None:
+            with open(path, 'rb') as stream:
+                yield from iter_csv_rows(stream, schema, fields)
+        else:
+            body = s3.get_object(Bucket=bucket_name, Key=path)['Body']
+            try:
+                yield from iter_csv_rows(body, schema, fields)
+            finally:
+                body.close()
+    elif bucket_name is None:
+        yield from iter_arrow_rows(path, file_format, fields)
+    else:
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(path)[1]) as local_file:
+            s3.download_fileobj(bucket_name, path, local_file)
+            local_file.flush()
+            yield from iter_arrow_rows(local_file.name, file_format, fields)
+
+
+def iter_objects(
+    s3,
+    location,
+    prefix='',
+    suffix=None,
+    modified_since=None,
+    modified_before=None,
+    columns=COLUMNS
+):
+    """
+    Lazily yields the objects of the inventoried bucket as list_objects_v2 'Contents' entries, in
+    the order of the data files.
+
+    Args:
+    - s3 (botocore client): S3 client for inventories on S3, None for local copies.
+    - location (str): manifest.json, or the configuration folder to read its latest manifest (s3:// URI or local path).
+    - prefix (str): Only keys starting with it are yielded.
+    - suffix, modified_since, modified_before: Filters, see `s3_listing.object_filter`.
+    - columns (tuple): Fields of the entries (names of COLUMNS, VersionId); only those, the key and
+      the ones needed by the filters are decoded.
+    """
+    manifest = read_manifest(location, s3)
+    file_format = manifest['fileFormat']
+    wanted = {'Key', *columns}
+    if modified_since is not None or modified_before is not None:
+        wanted.add('LastModified')
+    fields = {name for name, column in FIELDS.items() if column in wanted} | set(VERSION_FIELDS)
+    accept = object_filter(suffix, modified_since, modified_before)
+
+    for data_file in manifest['files']:
+        rows = iter_data_file(data_file_location(manifest, data_file['key']), file_format, manifest['fileSchema'], fields, s3)
+        for row in rows:
+            if not row['key'].startswith(prefix) or not is_current(row):
+                continue
+            obj = to_object(row)
+            if accept(obj):
+                yield obj
@@ -0,0 +1,249 @@
+"""
+Parallel, prefix-sharded listing of S3 buckets.
+
+A list_objects_v2 paginator is sequential: every page needs the continuation token of the one
+before, so listing a multi-million-object bucket costs one round trip after another. Our keys
+follow a numeric hierarchy (1014000000/1014080000/1014080067/video/...), so the bucket splits
+into independent shards:
+- `discover_shards` lists the first `depth` levels with Delimiter='/' (each level's prefixes
+  concurrently) and returns the prefixes found at the last level. Objects met on the way, above
+  that level, are returned as they are; a prefix holding many objects directly is not split
+  further but becomes a shard itself.
+- `iter_objects` lists the shards concurrently with a bounded pool of workers and yields the
+  objects as their pages arrive. Suffix and date filters are applied by the workers, and at most
+  `queue_pages` pages wait for the consumer, so memory stays bounded.
+
+`index_keys` lists a bucket (or some of its prefixes) the same way and keeps the keys with
+given file names, such as the thumbnails that already exist in a destination bucket.
+
+With ordered=True the objects are yielded in key order, like a single paginator: shards are
+disjoint key ranges, so they are read one after the other while the next ones are prefetched.
+
+Stopping the iteration early (break, or closing the generator) cancels the workers.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Concurrent list_objects_v2 requests
+WORKERS = 16
+
+# Hierarchy levels discovered with Delimiter='/' before the shards are listed
+DEPTH = 2
+
+# Pages of objects waiting for the consumer
+QUEUE_PAGES = 64
+
+# Objects kept in memory per prefix while discovering shards, a prefix with more is listed as a shard
+LEVEL_OBJECTS = 1000
+
+# Marks the end of a shard in the queues
+_DONE = object()
+
+
+def list_level(s3, bucket_name, prefix, max_objects=LEVEL_OBJECTS):
+    """
+    Lists one level of the hierarchy under `prefix` with Delimiter='/'.
+
+    Returns:
+    - (prefixes, objects) (tuple): Sub-prefixes (ending with '/') and the objects directly under `prefix`,
+      or None when more than `max_objects` objects are directly under it: the level is mostly flat,
+      so `prefix` is better listed as a shard of its own than kept in memory.
+    """
+    prefixes = []
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+        objects.extend(page.get('Contents', []))
+        if len(objects) > max_objects:
+            return None
+    return prefixes, objects
+
+
+def discover_shards(s3, bucket_name, prefix='', depth=DEPTH, workers=WORKERS):
+    """
+    Discovers the prefixes `depth` levels below `prefix`.
+
+    Args:
+    - s3 (botocore client): S3 client, shared by the workers.
+    - bucket_name (str): Bucket to list.
+    - prefix (str): Only keys starting with it are listed.
+    - depth (int): Levels to discover; 0 makes `prefix` the only shard.
+    - workers (int): Concurrent list_objects_v2 requests.
+
+    Returns:
+    - (shards, objects) (tuple): Sorted shard prefixes, and the objects found above the last level
+      (already listed, so they are not part of any shard). Prefixes holding more than LEVEL_OBJECTS
+      objects directly are shards themselves.
+    """
+    shards = [prefix]
+    leaves = []
+    objects = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(depth):
+            next_shards = []
+            for shard, level in zip(shards, executor.map(lambda shard: list_level(s3, bucket_name, shard), shards)):
+                if level is None:
+                    leaves.append(shard)
+                    continue
+                next_shards.extend(level[0])
+                objects.extend(level[1])
+            shards = next_shards
+            if not shards:
+                break
+    return sorted(shards + leaves), objects
+
+
+def object_filter(suffix=None, modified_since=None, modified_before=None):
+    """
+    Returns a function telling whether an object passes the filters.
+
+    Args:
+    - suffix (str or tuple): Key suffix(es) to keep, like '.mp4'.
+    - modified_since, modified_before (datetime): Keep objects with modified_since <= LastModified < modified_before.
+      They must be timezone-aware, like the LastModified values returned by boto3.
+    """
+    def accept(obj):
+        if suffix and not obj['Key'].endswith(suffix):
+            return False
+        if modified_since is not None and obj['LastModified'] < modified_since:
+            return False
+        if modified_before is not None and obj['LastModified'] >= modified_before:
+            return False
+        return True
+    return accept
+
+
+def _put(out, item, stop):
+    """Puts `item` on a bounded queue unless the consumer has stopped; returns False when it has."""
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _list_shard(s3, bucket_name, shard, accept, out, stop):
+    """Lists one shard and puts its filtered pages, then _DONE (or the error that stopped it), on `out`."""
+    try:
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=shard):
+            objects = [obj for obj in page.get('Contents', []) if accept(obj)]
+            if objects and not _put(out, objects, stop):
+                return
+    except Exception as e:
+        _put(out, e, stop)
+    _put(out, _DONE, stop)
+
+
+def _drain(out):
+    """Yields the pages of one shard's queue until _DONE, raising the error of a failed shard."""
+    while True:
+        item = out.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield from item
+
+
+def iter_objects(
+    s3,
+    bucket_name,
+    prefix='',
+    suffix=None,
+    modified_since=None,
+    modified_before=None,
+    ordered=False,
+    depth=DEPTH,
+    workers=WORKERS,
+    queue_pages=QUEUE_PAGES
+):
+    """
+    Lazily yields the objects of a bucket (list_objects_v2 'Contents' entries), listing its shards
+    concurrently.
+
+    Args:
+    - s3 (botocore client): S3 client, shared by the workers.
+    - bucket_name (str): Bucket to list.
+    - prefix (str): Only keys starting with it are listed.
+    - suffix, modified_since, modified_before: Filters, see `object_filter`.
+    - ordered (bool): Yield the objects in key order. Otherwise they come in the order their pages
+      arrive, which keeps every worker busy.
+    - depth (int): Levels discovered with Delimiter='/' to split the listing into shards.
+    - workers (int): Concurrent list_objects_v2 requests.
+    - queue_pages (int): Pages of objects that may wait for the consumer.
+    """
+    accept = object_filter(suffix, modified_since, modified_before)
+    shards, objects = discover_shards(s3, bucket_name, prefix, depth, workers)
+    objects = [obj for obj in objects if accept(obj)]
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        if ordered:
+            # A shard's keys all sort between the objects found above it, so shards and those
+            # objects are interleaved by key, then every shard is read in turn
+            units = sorted([(obj['Key'], obj) for obj in objects] + [(shard, None) for shard in shards], key=lambda unit: unit[0])
+            # Shards are started ahead of the one being read, at most `workers` at once, so the one
+            # being read always has a worker
+            pending = iter([shard for shard, obj in units if obj is None])
+            started = []
+            # The pages that may wait are shared among the shards started at once
+            shard_pages = max(1, queue_pages // max(1, min(workers, len(shards))))
+
+            def start_next():
+                shard = next(pending, None)
+                if shard is not None:
+                    out = queue.Queue(shard_pages)
+                    executor.submit(_list_shard, s3, bucket_name, shard, accept, out, stop)
+                    started.append(out)
+
+            for _ in range(workers):
+                start_next()
+            for key, obj in units:
+                if obj is not None:
+                    yield obj
+                    continue
+                yield from _drain(started.pop(0))
+                start_next()
+        else:
+            yield from objects
+            out = queue.Queue(queue_pages)
+            for shard in shards:
+                executor.submit(_list_shard, s3, bucket_name, shard, accept, out, stop)
+            remaining = len(shards)
+            while remaining:
+                item = out.get()
+                if item is _DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def index_keys(s3, bucket_name, names, prefixes=None, workers=WORKERS):
+    """
+    Lists a bucket concurrently and returns the set of keys whose last component is in `names`.
+
+    Args:
+    - s3 (botocore client): S3 client, shared by the workers.
+    - bucket_name (str): Bucket to list.
+    - names (iterable): File names to keep, like 'landscape-regular-thumb-tv.jpg'.
+    - prefixes (list): Only list these prefixes, the whole bucket when None.
+    - workers (int): Concurrent list_objects_v2 requests.
+    """
+    names = set(names)
+    return {
+        obj['Key']
+        for prefix in prefixes or ['']
+        for obj in iter_objects(s3, bucket_name, prefix, workers=workers)
+        if obj['Key'].rsplit('/', 1)[-1] in names
+    }
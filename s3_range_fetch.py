@@ -0,0 +1,373 @@
+"""
+Fetches only the parts of an MP4 stored in S3 that are needed to grab frames at a few timestamps.
+
+It performs the following steps:
+1. Reads the start of the object with a ranged GET and walks the top-level boxes to find the `moov` atom,
+   reading only the headers of the boxes past the first GET, so a `moov` after `mdat` is found too.
+2. Parses the sample tables of the video track (stts, stss, stsz/stz2, stsc, stco/co64).
+3. Works out the byte ranges of the GOPs that cover the requested time frames.
+4. Writes the header and those ranges into a sparse local file at their original offsets,
+   so FFmpeg can open it and seek (`-ss` before `-i`) as if it were the full video.
+
+FFmpeg may log decode errors while probing the zero-filled parts of the sparse file; they do not
+affect the frames extracted at the requested time frames.
+
+When there is no `moov` atom among the first top-level boxes or the sample tables cannot be
+parsed, it falls back to downloading the whole object with `download_file`.
+"""
+
+import os
+import struct
+from bisect import bisect_left, bisect_right
+
+# Size of the first ranged GET, large enough to hold ftyp and most faststart moov atoms
+HEADER_READ_SIZE = 256 * 1024
+
+# Top-level box headers read past the first ranged GET before giving up on finding the moov atom
+MAX_BOX_HOPS = 16
+
+# Seconds fetched around each requested time frame to absorb edit lists and B-frame reordering
+SEEK_MARGIN = 1.0
+
+# Ranges closer than this are merged into a single GET
+MERGE_GAP = 512 * 1024
+
+# Boxes that only contain other boxes on the path to the sample tables
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+
+def parse_timestamp(frame):
+    """
+    Converts a time frame such as '00:05:00', '05:00.5' or '300' to seconds.
+
+    Args:
+    - frame (str | int | float): Time frame in FFmpeg duration syntax or seconds.
+
+    Returns:
+    - seconds (float): Time frame in seconds.
+    """
+    if isinstance(frame, (int, float)):
+        return float(frame)
+    seconds = 0.0
+    for part in str(frame).split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def clamp_seconds(seconds, duration):
+    """
+    Keeps a time frame inside the video: a time frame past the end of the video is moved to its
+    middle, which is a better thumbnail than the closing frames of a short clip.
+    """
+    if duration and seconds >= duration:
+        return duration / 2
+    return max(seconds, 0.0)
+
+
+def read_range(s3, bucket_name, video_key, start, end):
+    """Reads bytes `start` to `end` (inclusive) of an S3 object."""
+    response = s3.get_object(Bucket=bucket_name, Key=video_key, Range=f'bytes={start}-{end}')
+    return response['Body'].read()
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yields (box_type, payload_start, box_end) for every box between `start` and `end` in `data`."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise ValueError(f'Invalid MP4 box size {size} at offset {offset}')
+        yield box_type, offset + header_size, min(offset + size, end)
+        offset += size
+
+
+def find_moov(s3, bucket_name, video_key, object_size):
+    """
+    Locates and reads the moov atom with ranged GETs.
+
+    The top-level boxes are walked by their headers. A box that starts past the first
+    HEADER_READ_SIZE bytes costs one small GET for its header, so a moov atom behind the mdat
+    (a file that is not faststart) is found without reading the media data.
+
+    Returns:
+    - (head, moov_offset, moov) (tuple): The bytes read from the start of the object (up to the
+      end of the moov atom when it is near the start), the offset where the moov atom starts and
+      its bytes, or None when there is no moov atom.
+    """
+    if object_size < 8:
+        return None
+    head = read_range(s3, bucket_name, video_key, 0, min(HEADER_READ_SIZE, object_size) - 1)
+    offset = 0
+    hops = 0
+    while offset + 8 <= object_size:
+        if offset + 16 <= len(head) or len(head) == object_size:
+            box_header = head[offset:offset + 16]
+        else:
+            # Past the first read: only fetch the header of the box
+            hops += 1
+            if hops > MAX_BOX_HOPS:
+                return None
+            box_header = read_range(s3, bucket_name, video_key, offset, min(offset + 15, object_size - 1))
+        size, box_type = struct.unpack_from('>I4s', box_header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', box_header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = object_size - offset
+        if size < header_size or offset + size > object_size:
+            raise ValueError(f'Invalid MP4 box size {size} at offset {offset}')
+        end = offset + size
+        if box_type == b'moov':
+            if offset < len(head):
+                head = head[:end]
+                if len(head) < end:
+                    head += read_range(s3, bucket_name, video_key, len(head), end - 1)
+                return head, offset, head[offset:]
+            return head, offset, read_range(s3, bucket_name, video_key, offset, end - 1)
+        offset = end
+    return None
+
+
+def parse_video_track(moov):
+    """
+    Extracts the sample tables of the first video track in a moov atom.
+
+    Returns:
+    - track (dict): timescale, sample decode times, offsets, sizes, 0-based keyframe indexes and
+      the duration in seconds (None when the headers do not give it).
+    """
+    tracks = []
+
+    def walk(start, end, boxes):
+        for box_type, payload, box_end in iter_boxes(moov, start, end):
+            if box_type == b'trak':
+                trak_boxes = {}
+                walk(payload, box_end, trak_boxes)
+                tracks.append(trak_boxes)
+            elif box_type in CONTAINER_BOXES:
+                walk(payload, box_end, boxes)
+            else:
+                boxes[box_type] = (payload, box_end)
+
+    movie_boxes = {}
+    _, moov_payload, moov_end = next(iter_boxes(moov))
+    walk(moov_payload, moov_end, movie_boxes)
+
+    for boxes in tracks:
+        if b'hdlr' in boxes and moov[boxes[b'hdlr'][0] + 8:boxes[b'hdlr'][0] + 12] == b'vide':
+            track = build_sample_table(moov, boxes)
+            # FFmpeg and PyAV report the movie duration (mvhd), or the track's (mdhd) without it
+            track['duration'] = None
+            for header in (movie_boxes.get(b'mvhd'), boxes.get(b'mdhd')):
+                if header is not None:
+                    timescale, duration = read_header_duration(moov, header[0])
+                    if timescale and duration:
+                        track['duration'] = duration / timescale
+                        break
+            return track
+    raise ValueError('No video track found in moov atom')
+
+
+def read_header_duration(moov, payload):
+    """
+    Reads the timescale and duration of an mvhd or mdhd box, which share their layout.
+
+    Returns:
+    - (timescale, duration) (tuple): duration is None when the box leaves it unknown.
+    """
+    if moov[payload] == 1:
+        timescale, duration = struct.unpack_from('>IQ', moov, payload + 20)
+        unknown = 0xFFFFFFFFFFFFFFFF
+    else:
+        timescale, duration = struct.unpack_from('>II', moov, payload + 12)
+        unknown = 0xFFFFFFFF
+    return timescale, None if duration == unknown else duration
+
+
+def build_sample_table(moov, boxes):
+    """Expands the compact MP4 sample tables of a track into per-sample lists."""
+    timescale = read_header_duration(moov, boxes[b'mdhd'][0])[0]
+
+    # Sample sizes
+    if b'stsz' in boxes:
+        payload = boxes[b'stsz'][0]
+        sample_size, sample_count = struct.unpack_from('>II', moov, payload + 4)
+        if sample_size:
+            sizes = [sample_size] * sample_count
+        else:
+            sizes = list(struct.unpack_from(f'>{sample_count}I', moov, payload + 12))
+    else:
+        payload = boxes[b'stz2'][0]
+        field_size = moov[payload + 7]
+        sample_count = struct.unpack_from('>I', moov, payload + 8)[0]
+        if field_size == 4:
+            packed = moov[payload + 12:payload + 12 + (sample_count + 1) // 2]
+            sizes = [nibble for byte in packed for nibble in (byte >> 4, byte & 0x0F)][:sample_count]
+        else:
+            code = {8: 'B', 16: 'H'}[field_size]
+            sizes = list(struct.unpack_from(f'>{sample_count}{code}', moov, payload + 12))
+
+    # Decode times
+    payload = boxes[b'stts'][0]
+    entry_count = struct.unpack_from('>I', moov, payload + 4)[0]
+    entries = struct.unpack_from(f'>{entry_count * 2}I', moov, payload + 8)
+    times = []
+    time = 0
+    for count, delta in zip(entries[0::2], entries[1::2]):
+        for _ in range(count):
+            times.append(time)
+            time += delta
+
+    # Chunk offsets
+    if b'stco' in boxes:
+        payload = boxes[b'stco'][0]
+        chunk_count = struct.unpack_from('>I', moov, payload + 4)[0]
+        chunk_offsets = struct.unpack_from(f'>{chunk_count}I', moov, payload + 8)
+    else:
+        payload = boxes[b'co64'][0]
+        chunk_count = struct.unpack_from('>I', moov, payload + 4)[0]
+        chunk_offsets = struct.unpack_from(f'>{chunk_count}Q', moov, payload + 8)
+
+    # Sample to chunk runs
+    payload = boxes[b'stsc'][0]
+    entry_count = struct.unpack_from('>I', moov, payload + 4)[0]
+    runs = struct.unpack_from(f'>{entry_count * 3}I', moov, payload + 8)
+    offsets = []
+    sample = 0
+    for run in range(entry_count):
+        first_chunk, samples_per_chunk = runs[run * 3], runs[run * 3 + 1]
+        last_chunk = runs[(run + 1) * 3] - 1 if run + 1 < entry_count else chunk_count
+        for chunk in range(first_chunk - 1, last_chunk):
+            offset = chunk_offsets[chunk]
+            for _ in range(samples_per_chunk):
+                if sample >= sample_count:
+                    break
+                offsets.append(offset)
+                offset += sizes[sample]
+                sample += 1
+
+    # Sync samples; every sample is a keyframe when stss is missing
+    if b'stss' in boxes:
+        payload = boxes[b'stss'][0]
+        entry_count = struct.unpack_from('>I', moov, payload + 4)[0]
+        keyframes = [number - 1 for number in struct.unpack_from(f'>{entry_count}I', moov, payload + 8)]
+    else:
+        keyframes = list(range(sample_count))
+
+    sample_count = min(sample_count, len(times), len(offsets))
+    return {
+        'timescale': timescale,
+        'times': times[:sample_count],
+        'offsets': offsets[:sample_count],
+        'sizes': sizes[:sample_count],
+        'keyframes': [k for k in keyframes if k < sample_count],
+    }
+
+
+def gop_byte_ranges(track, time_frames, margin=SEEK_MARGIN):
+    """
+    Computes the merged byte ranges covering the GOPs within `margin` seconds of each time frame.
+
+    Returns:
+    - ranges (list): Sorted, merged (start, end) byte ranges with `end` inclusive.
+    """
+    times, offsets, sizes, keyframes = track['times'], track['offsets'], track['sizes'], track['keyframes']
+    if not times:
+        return []
+    # Clamp with the duration the readers use, so the fetched GOPs are those they will decode
+    duration = track.get('duration') or times[-1] / track['timescale']
+    ranges = []
+    for frame in time_frames:
+        seconds = clamp_seconds(parse_timestamp(frame), duration)
+        first = max(bisect_right(times, (seconds - margin) * track['timescale']) - 1, 0)
+        last = max(bisect_right(times, (seconds + margin) * track['timescale']) - 1, 0)
+
+        # From the keyframe at or before the window up to and including the next keyframe after it
+        gop_start = keyframes[max(bisect_right(keyframes, first) - 1, 0)] if keyframes else 0
+        next_key = bisect_left(keyframes, last + 1)
+        gop_end = keyframes[next_key] if next_key < len(keyframes) else len(times) - 1
+
+        start = min(offsets[gop_start:gop_end + 1])
+        end = max(offset + size for offset, size in zip(offsets[gop_start:gop_end + 1], sizes[gop_start:gop_end + 1]))
+        ranges.append((start, end - 1))
+
+    # The first keyframe lets FFmpeg's stream probing find the codec parameters at open time
+    first_key = keyframes[0] if keyframes else 0
+    ranges.append((offsets[first_key], offsets[first_key] + sizes[first_key] - 1))
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + MERGE_GAP:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def fetch_video(s3, bucket_name, video_key, local_path, time_frames, margin=SEEK_MARGIN, object_size=None, update=False):
+    """
+    Downloads just enough of an MP4 to extract frames at `time_frames`.
+
+    Args:
+    - s3 (botocore client): S3 client used for the requests.
+    - bucket_name (str): S3 bucket name where the video is stored.
+    - video_key (str): Key name of the video file in the S3 bucket.
+    - local_path (str): Local path where the (possibly sparse) video file is written.
+    - time_frames (list): Time frames that will be extracted from the file.
+    - margin (float): Seconds around each time frame that must be decodable.
+    - object_size (int): Size of the object when already known, saves a HEAD request.
+    - update (bool): Add the ranges to a sparse file written by an earlier call instead of
+      starting a new one.
+
+    Returns:
+    - bytes_fetched (int): Number of bytes transferred from S3.
+    """
+    if object_size is None:
+        object_size = s3.head_object(Bucket=bucket_name, Key=video_key)['ContentLength']
+    try:
+        located = find_moov(s3, bucket_name, video_key, object_size)
+        if located is None:
+            print(f'No moov atom found in {video_key}, downloading the whole file.')
+        else:
+            header, moov_offset, moov = located
+            ranges = gop_byte_ranges(parse_video_track(moov), time_frames, margin)
+    except (ValueError, KeyError, struct.error) as e:
+        print(f'Could not parse the moov atom of {video_key} ({e}), downloading the whole file.')
+        located = None
+
+    if located is None:
+        s3.download_file(bucket_name, video_key, local_path)
+        return object_size
+
+    # The moov atom was read on its own when it comes after the media data
+    separate_moov = moov_offset >= len(header)
+    bytes_fetched = len(header) + (len(moov) if separate_moov else 0)
+    update = update and os.path.exists(local_path)
+    with open(local_path, 'r+b' if update else 'wb') as f:
+        if not update:
+            # Sparse file with the original layout so every sample keeps its offset
+            f.truncate(object_size)
+            f.write(header)
+            if separate_moov:
+                f.seek(moov_offset)
+                f.write(moov)
+        for start, end in ranges:
+            start = max(start, len(header))
+            if start > end:
+                continue
+            f.seek(start)
+            data = read_range(s3, bucket_name, video_key, start, min(end, object_size - 1))
+            f.write(data)
+            bytes_fetched += len(data)
+
+    print(f'Fetched {bytes_fetched} of {object_size} bytes of {video_key} for time frames {time_frames}')
+    return bytes_fetched
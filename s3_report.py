@@ -1,18 +1,116 @@
 import json
+import uuid
 import boto3
-from datetime import datetime
+import s3_listing
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+from ingest_state import IngestState
+from report_writer import write_day_report
 
-# This AWS Lambda function interacts with an S3 bucket named 'media-ingest-temporary'.
+# This AWS Lambda function reports the .mp4 objects of the S3 bucket named 'media-ingest-temporary'.
 # It performs the following steps:
 # 1. Initializes an S3 client using boto3.
 # 2. Retrieves the current date in the format 'YYYY-MM-DD'.
-# 3. Iterates through all objects in the specified S3 bucket using pagination.
-# 4. Filters objects to include only those with the .mp4 extension and whose LastModified date matches the current date.
-# 5. Collects the filtered objects' keys and their last modified timestamps into a list.
-# 6. Constructs a JSON report that includes the total count of filtered files and their details.
-# 7. Saves the JSON report to the same S3 bucket under the 'report/' directory, naming the file with the current date.
-# 8. Returns a success response with the report data if successful.
-# 9. Handles any exceptions by returning an error response with a 500 status code and the error message.
+# 3. In 'incremental' mode (the default):
+#    - When invoked by S3 event notifications (ObjectCreated:* and ObjectRemoved:* on the bucket), writes the .mp4
+#      records of the event as one new small object under 'report/ingest_events/' and returns. That is one PUT per
+#      event whatever the size of the bucket, and concurrent invocations never conflict.
+#    - Otherwise (the daily schedule), applies the pending event objects to the ingest state kept in the bucket under
+#      'report/ingest_state/' (see ingest_state.py), deletes the event objects it applied, then reads today's uploads
+#      from today's partition of the state and the running total from its totals object. The state is split into
+#      small objects (one per object an event changed, one partition per upload day and the totals), so a run only
+#      reads and writes what today's events touch instead of listing the whole bucket or moving one store of it.
+#    A lock with a lease keeps two overlapping daily runs apart; an event object is only deleted once the state
+#    holding it is written, and applying one twice is harmless (see the sequencers in ingest_counters.py). The first
+#    run seeds the state with one full listing of the bucket.
+# 4. In 'scan' mode, iterates through all objects in the bucket, listing its prefixes concurrently (see s3_listing.py),
+#    and filters the .mp4 objects whose LastModified date matches the current date.
+# 5. Streams the report to the same S3 bucket under the 'report/' directory, naming the file with the current date:
+#    gzip-compressed JSON Lines (see report_writer.py), one line per file uploaded today and a last line with the total
+#    count of files and today's count. It is written through a multipart upload as it is produced, so memory stays
+#    flat whatever the size of the bucket.
+# 6. Returns a success response with the counts and the report key if successful.
+# 7. Handles any exceptions by returning an error response with a 500 status code and the error message.
+#
+# Dependencies:
+# - boto3 >= 1.35.69 (IfMatch and IfNoneMatch on put_object, for the lock), packaged with the function: the boto3 of
+#   the Lambda Python runtimes may be older.
+
+# 'incremental' keeps event-driven counters, 'scan' lists the whole bucket on every report
+report_mode = 'incremental'
+
+# Prefix of the ingest state in the bucket (see ingest_state.py)
+state_prefix = 'report/ingest_state/'
+
+# Prefix of the event objects waiting to be applied to the counters by the daily run
+events_prefix = 'report/ingest_events/'
+
+# Concurrent list_objects_v2 requests of a full listing, one prefix shard each (see s3_listing.py)
+listing_workers = 16
+
+# Function to lazily yield every .mp4 object (Key, LastModified, Size, ETag) of the bucket in key order, listing its
+# prefixes concurrently
+def iter_mp4_objects(s3, bucket_name):
+    return s3_listing.iter_objects(s3, bucket_name, suffix='.mp4', ordered=True, workers=listing_workers)
+
+# Function to save the .mp4 records of one event notification as a new object, applied later by the daily run
+def save_event_records(s3, bucket_name, records):
+    now = datetime.now(timezone.utc)
+    event_key = f'{events_prefix}{now:%Y-%m-%d}/{now:%H%M%S%f}-{uuid.uuid4().hex}.json'
+    s3.put_object(Bucket=bucket_name, Key=event_key, Body=json.dumps({'Records': records}), ContentType='application/json')
+    return event_key
+
+# Function to list the keys of the event objects not applied to the counters yet, oldest first
+def list_event_keys(s3, bucket_name):
+    paginator = s3.get_paginator('list_objects_v2')
+    return [
+        content['Key']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=events_prefix)
+        for content in page.get('Contents', [])
+    ]
+
+# Function to read the records of event objects concurrently, by event key. Objects already deleted by an earlier
+# run are left out
+def read_event_objects(s3, bucket_name, event_keys):
+    def read(event_key):
+        try:
+            return json.loads(s3.get_object(Bucket=bucket_name, Key=event_key)['Body'].read())['Records']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+    with ThreadPoolExecutor(max_workers=listing_workers) as executor:
+        records = dict(zip(event_keys, executor.map(read, event_keys)))
+    return {event_key: event_records for event_key, event_records in records.items() if event_records is not None}
+
+# Function to delete the event objects once the state holding them is written
+def delete_event_objects(s3, bucket_name, event_keys):
+    for start in range(0, len(event_keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': event_key} for event_key in event_keys[start:start + 1000]], 'Quiet': True}
+        )
+
+# Function to apply the pending events to the ingest state and write the report of a day from its partition and the
+# running total. The event objects are kept until the state holding them is written, so a failed run loses nothing
+def report_from_state(s3, bucket_name, file_key, current_date):
+    state = IngestState(s3, bucket_name, state_prefix, suffix='.mp4', workers=listing_workers)
+    with state.locked():
+        if not state.load():
+            # First run: seed the state with one listing of the bucket
+            state.bootstrap(iter_mp4_objects(s3, bucket_name), current_date)
+        event_keys = list_event_keys(s3, bucket_name)
+        if event_keys:
+            applied = state.apply(read_event_objects(s3, bucket_name, event_keys))
+            print(f'Applied {len(event_keys)} event objects ({applied} records changed the counters)')
+            delete_event_objects(s3, bucket_name, event_keys)
+        partition = state.open_day(current_date)
+        try:
+            return write_day_report(s3, bucket_name, file_key, current_date, partition.iter_day(current_date), state.total())
+        finally:
+            partition.close()
 
 def lambda_handler(event, context):
     # Initialize an S3 client
@@ -23,64 +121,27 @@ def lambda_handler(event, context):
     current_date = datetime.now().strftime('%Y-%m-%d')
 
     try:
-        day_objects = []
-        all_objects = []
-        continuation_token = None
-
-        # Loop to handle paginated results from S3
-        while True:
-            if continuation_token:
-                # List objects with continuation token if it exists
-                response = s3.list_objects_v2(
-                    Bucket=bucket_name,
-                    ContinuationToken=continuation_token
-                )
-            else:
-                # List objects without continuation token
-                response = s3.list_objects_v2(Bucket=bucket_name)
-
-            # Ensure 'Contents' exists in the response
-            if 'Contents' in response:
-                # Filter objects by .mp4 extension and current date
-                filtered_objects = [
-                    {'Key': obj['Key'], 'LastModified': obj['LastModified'].isoformat()}
-                    for obj in response['Contents']
-                    if obj['Key'].endswith('.mp4') and obj['LastModified'].strftime('%Y-%m-%d') == current_date
-                ]
-
-                # Get all .mp4 objects
-                all_mp4_objects = [
-                    {'Key': obj['Key'], 'LastModified': obj['LastModified'].isoformat()}
-                    for obj in response['Contents']
-                    if obj['Key'].endswith('.mp4')
-                ]
-
-                # Append all objects to the list
-                all_objects.extend(all_mp4_objects)
-
-                # Append filtered objects to the list
-                day_objects.extend(filtered_objects)
-
-            # Check if there are more objects to fetch
-            if 'NextContinuationToken' in response:
-                continuation_token = response['NextContinuationToken']
-            else:
-                break
-
-        # Include the total count at the beginning of the JSON data
-        output_data = {
-            'total_files_until_current_date': len(all_objects),
-            'total_files_today': len(day_objects),
-            'Files': day_objects
-        }
-
-        # Convert the output data to JSON with pretty-printing and save to S3
-        json_data = json.dumps(output_data, indent=4)
-        file_key = f"report/mp4_objects_{current_date}.json"
+        file_key = f"report/mp4_objects_{current_date}.jsonl.gz"
 
-        # Upload the JSON report to the specified S3 bucket
-        s3.put_object(Bucket=bucket_name, Key=file_key, Body=json_data)
+        if report_mode == 'scan':
+            # Every .mp4 object is counted, only today's are written
+            output_data = write_day_report(s3, bucket_name, file_key, current_date, iter_mp4_objects(s3, bucket_name))
+        else:
+            records = [record for record in event.get('Records', []) if 's3' in record]
+            if records:
+                # Invoked by S3 event notifications: only save the records for the daily run. Events of other objects
+                # (such as the reports, the event objects and the ingest state themselves) never trigger a write,
+                # which would loop
+                mp4_records = [record for record in records if unquote_plus(record['s3']['object']['key']).endswith('.mp4')]
+                event_key = save_event_records(s3, bucket_name, mp4_records) if mp4_records else None
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'records': len(records), 'saved': len(mp4_records), 'event_key': event_key}, indent=4)
+                }
+            output_data = report_from_state(s3, bucket_name, file_key, current_date)
 
+        # The response only carries the counts, the list of files is in the report
+        output_data['report_key'] = file_key
         return {
             'statusCode': 200,
             'body': json.dumps(output_data, indent=4)
@@ -0,0 +1,107 @@
+"""
+Local stand-in for the boto3 Rekognition client used by the rekognition_jobs tests.
+
+Only the label detection calls are implemented: start_label_detection and get_label_detection
+(with SortBy, MaxResults and NextToken paging). Like the service:
+- at most `max_jobs` jobs run at once, start_label_detection raises LimitExceededException above that;
+- the first `throttled_starts` start_label_detection calls raise ThrottlingException;
+- a job stays IN_PROGRESS for its first `polls` get_label_detection calls, then SUCCEEDED, or
+  FAILED for the videos in `failing`;
+- the labels of a finished job come back `page_size` (or MaxResults if smaller) at a time with a NextToken.
+
+Every job and call is recorded, so a test can check how many jobs were started, how many ran at
+once and how the caller paged through the results.
+"""
+
+import itertools
+import threading
+from collections import Counter
+
+
+class LimitExceededException(Exception):
+    pass
+
+
+class ThrottlingException(Exception):
+    pass
+
+
+class ProvisionedThroughputExceededException(Exception):
+    pass
+
+
+class LocalRekognition:
+    class exceptions:
+        LimitExceededException = LimitExceededException
+        ThrottlingException = ThrottlingException
+        ProvisionedThroughputExceededException = ProvisionedThroughputExceededException
+
+    def __init__(self, labels_per_video=7, page_size=3, polls=2, max_jobs=2, failing=(), throttled_starts=0):
+        """
+        Args:
+        - labels_per_video (int): Label detections returned for every video.
+        - page_size (int): Label detections per get_label_detection page.
+        - polls (int): get_label_detection calls answered IN_PROGRESS before a job finishes.
+        - max_jobs (int): Jobs running at once before start_label_detection is throttled.
+        - failing (iterable): Video keys whose jobs end FAILED.
+        - throttled_starts (int): First start_label_detection calls that raise ThrottlingException.
+        """
+        self.labels_per_video = labels_per_video
+        self.page_size = page_size
+        self.polls = polls
+        self.max_jobs = max_jobs
+        self.failing = set(failing)
+        self.throttled_starts = throttled_starts
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.jobs = {}
+        self.running = 0
+        self.max_running = 0
+        self.requests = Counter()
+        self.max_results = []  # MaxResults of every get_label_detection call, None when not set
+        self.started = []  # Video keys, in the order their jobs were started
+
+    def labels(self, video_key):
+        """Label detections of a video, every other one a Person."""
+        return [
+            {'Timestamp': i * 1000, 'Label': {'Name': 'Person' if i % 2 == 0 else 'Car', 'Confidence': 90.0}}
+            for i in range(self.labels_per_video)
+        ]
+
+    def start_label_detection(self, Video, **kwargs):
+        video_key = Video['S3Object']['Name']
+        with self.lock:
+            self.requests['StartLabelDetection'] += 1
+            if self.throttled_starts > 0:
+                self.throttled_starts -= 1
+                raise ThrottlingException('Rate exceeded')
+            if self.running >= self.max_jobs:
+                raise LimitExceededException(f'{self.running} jobs already running')
+            job_id = f'job-{next(self.job_ids)}'
+            self.jobs[job_id] = {'video_key': video_key, 'polls': self.polls, 'status': 'IN_PROGRESS'}
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.started.append(video_key)
+        return {'JobId': job_id}
+
+    def get_label_detection(self, JobId, SortBy='TIMESTAMP', NextToken=None, MaxResults=None, **kwargs):
+        with self.lock:
+            self.requests['GetLabelDetection'] += 1
+            self.max_results.append(MaxResults)
+            job = self.jobs[JobId]
+            if job['status'] == 'IN_PROGRESS':
+                if job['polls'] > 0:
+                    job['polls'] -= 1
+                    return {'JobStatus': 'IN_PROGRESS'}
+                job['status'] = 'FAILED' if job['video_key'] in self.failing else 'SUCCEEDED'
+                self.running -= 1
+        if job['status'] == 'FAILED':
+            return {'JobStatus': 'FAILED', 'StatusMessage': f'Unsupported codec in {job["video_key"]}'}
+
+        start = int(NextToken or 0)
+        page_size = min(self.page_size, MaxResults or self.page_size)
+        labels = self.labels(job['video_key'])
+        page = {'JobStatus': 'SUCCEEDED', 'Labels': labels[start:start + page_size]}
+        if start + page_size < len(labels):
+            page['NextToken'] = str(start + page_size)
+        return page
@@ -0,0 +1,211 @@
+"""
+Drives rekognition_jobs against local stand-ins of Rekognition and S3: concurrency limits,
+throttled starts and their limits, polling backoff, NextToken paging, failed jobs and the
+per-ETag cache.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, 'benchmarks'), TESTS_DIR]
+
+from local_rekognition import LimitExceededException, LocalRekognition
+from local_s3 import LocalS3
+from rekognition_jobs import LabelDetectionOrchestrator, iter_labels, wait_for_job
+
+BUCKET = 'videos'
+
+
+class RecordingSleep:
+    """Records the requested delays and only yields to the other threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delays = []
+
+    def __call__(self, delay):
+        with self.lock:
+            self.delays.append(delay)
+        time.sleep(0.001)
+
+
+def make_videos(root, count):
+    video_keys = [f'1014000000/1014080000/10140800{i:02d}/video/{i}.mp4' for i in range(count)]
+    for video_key in video_keys:
+        path = os.path.join(root, BUCKET, video_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(video_key.encode())
+    return video_keys
+
+
+def make_orchestrator(rekognition, s3, cache_dir, concurrency=4, sleep=None):
+    return LabelDetectionOrchestrator(
+        rekognition, s3, BUCKET, concurrency=concurrency, cache_dir=cache_dir,
+        initial_delay=1, max_delay=8, sleep=sleep or RecordingSleep()
+    )
+
+
+def test_wait_for_job_backs_off_exponentially():
+    rekognition = LocalRekognition(polls=5)
+    job_id = rekognition.start_label_detection(Video={'S3Object': {'Bucket': BUCKET, 'Name': 'a.mp4'}})['JobId']
+    sleep = RecordingSleep()
+
+    first_page = wait_for_job(rekognition, job_id, initial_delay=1, max_delay=4, sleep=sleep)
+
+    assert first_page['JobStatus'] == 'SUCCEEDED'
+    assert sleep.delays == [1, 2, 4, 4, 4]
+    # Polls only ask for one label
+    assert rekognition.max_results == [1] * 6
+    assert len(first_page['Labels']) == 1
+
+
+def test_wait_for_job_times_out():
+    rekognition = LocalRekognition(polls=10)
+    job_id = rekognition.start_label_detection(Video={'S3Object': {'Bucket': BUCKET, 'Name': 'a.mp4'}})['JobId']
+
+    try:
+        wait_for_job(rekognition, job_id, initial_delay=1, max_delay=4, timeout=5, sleep=RecordingSleep())
+    except TimeoutError:
+        pass
+    else:
+        raise AssertionError('wait_for_job did not time out')
+
+
+def test_iter_labels_follows_next_token():
+    rekognition = LocalRekognition(labels_per_video=7, page_size=3, polls=0)
+    job_id = rekognition.start_label_detection(Video={'S3Object': {'Bucket': BUCKET, 'Name': 'a.mp4'}})['JobId']
+
+    labels = list(iter_labels(rekognition, job_id))
+
+    assert [label['Timestamp'] for label in labels] == [i * 1000 for i in range(7)]
+    assert rekognition.requests['GetLabelDetection'] == 3
+
+
+def test_iter_labels_pages_after_a_single_label_poll():
+    rekognition = LocalRekognition(labels_per_video=7, page_size=3, polls=1)
+    job_id = rekognition.start_label_detection(Video={'S3Object': {'Bucket': BUCKET, 'Name': 'a.mp4'}})['JobId']
+
+    first_page = wait_for_job(rekognition, job_id, initial_delay=1, max_delay=4, sleep=RecordingSleep())
+    labels = list(iter_labels(rekognition, job_id, first_page))
+
+    assert [label['Timestamp'] for label in labels] == [i * 1000 for i in range(7)]
+    assert rekognition.max_results == [1, 1, None, None]
+
+
+def test_start_job_retries_throttling(tmp_path):
+    rekognition = LocalRekognition(throttled_starts=3)
+    sleep = RecordingSleep()
+    orchestrator = make_orchestrator(rekognition, LocalS3(tmp_path / 's3'), tmp_path / 'cache', sleep=sleep)
+
+    assert orchestrator.start_job('a.mp4') == 'job-1'
+    assert rekognition.requests['StartLabelDetection'] == 4
+    assert sleep.delays == [1, 2, 4]
+
+
+def test_start_job_gives_up_after_max_attempts(tmp_path):
+    rekognition = LocalRekognition(max_jobs=0)
+    sleep = RecordingSleep()
+    orchestrator = LabelDetectionOrchestrator(
+        rekognition, LocalS3(tmp_path / 's3'), BUCKET, cache_dir=None,
+        initial_delay=1, max_delay=8, max_start_attempts=4, start_timeout=None, sleep=sleep
+    )
+
+    try:
+        orchestrator.start_job('a.mp4')
+    except LimitExceededException:
+        pass
+    else:
+        raise AssertionError('start_job did not give up')
+    assert rekognition.requests['StartLabelDetection'] == 4
+    assert sleep.delays == [1, 2, 4]
+
+
+def test_start_job_gives_up_at_deadline(tmp_path):
+    rekognition = LocalRekognition(max_jobs=0)
+    sleep = RecordingSleep()
+    orchestrator = LabelDetectionOrchestrator(
+        rekognition, LocalS3(tmp_path / 's3'), BUCKET, cache_dir=None,
+        initial_delay=1, max_delay=8, max_start_attempts=100, start_timeout=20, sleep=sleep
+    )
+
+    try:
+        orchestrator.start_job('a.mp4')
+    except LimitExceededException:
+        pass
+    else:
+        raise AssertionError('start_job did not give up')
+    # 1 + 2 + 4 + 8 = 15 seconds waited, the next wait of 8 would pass the deadline
+    assert sleep.delays == [1, 2, 4, 8]
+
+
+def test_orchestrator_respects_limits_and_backs_off(tmp_path):
+    video_keys = make_videos(tmp_path / 's3', 6)
+    rekognition = LocalRekognition(labels_per_video=7, page_size=3, polls=2, max_jobs=2)
+    sleep = RecordingSleep()
+    orchestrator = make_orchestrator(rekognition, LocalS3(tmp_path / 's3'), tmp_path / 'cache', concurrency=4, sleep=sleep)
+
+    key_frames = orchestrator.run(video_keys)
+
+    assert orchestrator.errors == {}
+    assert sorted(key_frames) == sorted(video_keys)
+    # Person labels at every other second, gathered across the three pages of every job
+    assert all(frames == [0, 2000, 4000, 6000] for frames in key_frames.values())
+    assert sorted(rekognition.started) == sorted(video_keys)
+    # Four workers against a limit of two jobs: starts were throttled and retried with backoff
+    assert rekognition.max_running <= 2
+    assert rekognition.requests['StartLabelDetection'] > len(video_keys)
+    assert max(sleep.delays) <= 8
+    assert 2 in sleep.delays
+
+
+def test_orchestrator_bounds_concurrency(tmp_path):
+    video_keys = make_videos(tmp_path / 's3', 8)
+    rekognition = LocalRekognition(polls=3, max_jobs=100)
+    orchestrator = make_orchestrator(rekognition, LocalS3(tmp_path / 's3'), tmp_path / 'cache', concurrency=3)
+
+    orchestrator.run(video_keys)
+
+    assert rekognition.requests['StartLabelDetection'] == len(video_keys)
+    assert rekognition.max_running <= 3
+
+
+def test_orchestrator_records_failed_jobs(tmp_path):
+    video_keys = make_videos(tmp_path / 's3', 4)
+    rekognition = LocalRekognition(max_jobs=4, failing=[video_keys[1]])
+    orchestrator = make_orchestrator(rekognition, LocalS3(tmp_path / 's3'), tmp_path / 'cache')
+
+    key_frames = orchestrator.run(video_keys)
+
+    assert set(orchestrator.errors) == {video_keys[1]}
+    assert 'FAILED' in orchestrator.errors[video_keys[1]]
+    assert sorted(key_frames) == sorted(video_keys[:1] + video_keys[2:])
+    # Nothing is cached for the failed video, so the next run tries it again
+    assert len(os.listdir(tmp_path / 'cache')) == 3
+
+
+def test_orchestrator_caches_labels_per_etag(tmp_path):
+    video_keys = make_videos(tmp_path / 's3', 4)
+    s3 = LocalS3(tmp_path / 's3')
+    rekognition = LocalRekognition(max_jobs=4)
+    first = make_orchestrator(rekognition, s3, tmp_path / 'cache').run(video_keys)
+    assert len(rekognition.started) == 4
+
+    # Same ETags: every video is answered from the cache, no job is started
+    rekognition = LocalRekognition(max_jobs=4)
+    assert make_orchestrator(rekognition, s3, tmp_path / 'cache').run(video_keys) == first
+    assert rekognition.started == []
+
+    # A replaced video has a new ETag and is analyzed again, alone
+    with open(os.path.join(tmp_path / 's3', BUCKET, video_keys[2]), 'ab') as f:
+        f.write(b'new version')
+    rekognition = LocalRekognition(max_jobs=4)
+    assert make_orchestrator(rekognition, s3, tmp_path / 'cache').run(video_keys) == first
+    assert rekognition.started == [video_keys[2]]
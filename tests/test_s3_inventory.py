@@ -0,0 +1,167 @@
+"""
+Drives s3_inventory against inventories written in every format it reads: gzip CSV, Parquet and
+ORC (both need pyarrow and are skipped without it), as a local copy and through LocalS3.
+
+Usage:
+    python -m pytest tests
+"""
+
+import csv
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote_plus
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, 'benchmarks'), TESTS_DIR]
+
+import s3_inventory
+from local_s3 import LocalS3
+
+INVENTORY_BUCKET = 'inventories'
+CONFIGURATION = 'videos/daily'
+SCHEMA = 'Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag, StorageClass'
+DAY = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# Rows of the inventory: an old version and a delete marker are listed but not yielded
+ROWS = [
+    {'key': '1014000000/a/1.mp4', 'version_id': 'v2', 'is_latest': True, 'is_delete_marker': False, 'size': 10, 'last_modified_date': DAY, 'e_tag': 'e1'},
+    {'key': '1014000000/a/1.mp4', 'version_id': 'v1', 'is_latest': False, 'is_delete_marker': False, 'size': 9, 'last_modified_date': DAY - timedelta(days=5), 'e_tag': 'e0'},
+    {'key': '1014000000/a/with space.mp4', 'version_id': 'v1', 'is_latest': True, 'is_delete_marker': False, 'size': 20, 'last_modified_date': DAY + timedelta(days=1), 'e_tag': 'e2'},
+    {'key': '1014000000/b/thumb.jpg', 'version_id': 'v1', 'is_latest': True, 'is_delete_marker': False, 'size': 30, 'last_modified_date': DAY + timedelta(days=2), 'e_tag': 'e3'},
+    {'key': '1014000000/c/gone.mp4', 'version_id': 'v3', 'is_latest': True, 'is_delete_marker': True, 'size': None, 'last_modified_date': DAY, 'e_tag': None},
+    {'key': 'other/d.mp4', 'version_id': 'v1', 'is_latest': True, 'is_delete_marker': False, 'size': 40, 'last_modified_date': DAY, 'e_tag': 'e4'},
+]
+
+EXPECTED = [
+    {'Key': '1014000000/a/1.mp4', 'Size': 10, 'ETag': '"e1"', 'LastModified': DAY, 'StorageClass': 'STANDARD'},
+    {'Key': '1014000000/a/with space.mp4', 'Size': 20, 'ETag': '"e2"', 'LastModified': DAY + timedelta(days=1), 'StorageClass': 'STANDARD'},
+    {'Key': '1014000000/b/thumb.jpg', 'Size': 30, 'ETag': '"e3"', 'LastModified': DAY + timedelta(days=2), 'StorageClass': 'STANDARD'},
+    {'Key': 'other/d.mp4', 'Size': 40, 'ETag': '"e4"', 'LastModified': DAY, 'StorageClass': 'STANDARD'},
+]
+
+
+def write_csv(path, rows):
+    with gzip.open(path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow([
+                'videos', quote_plus(row['key'], safe='/'), row['version_id'], str(row['is_latest']).lower(),
+                str(row['is_delete_marker']).lower(), '' if row['size'] is None else row['size'],
+                row['last_modified_date'].strftime('%Y-%m-%dT%H:%M:%S.000Z'), row['e_tag'] or '', 'STANDARD'
+            ])
+
+
+def write_arrow(path, rows, file_format):
+    pyarrow = pytest.importorskip('pyarrow')
+    table = pyarrow.Table.from_pylist(
+        [dict(row, bucket='videos', storage_class='STANDARD') for row in rows],
+        schema=pyarrow.schema([
+            ('bucket', pyarrow.string()), ('key', pyarrow.string()), ('version_id', pyarrow.string()),
+            ('is_latest', pyarrow.bool_()), ('is_delete_marker', pyarrow.bool_()), ('size', pyarrow.int64()),
+            ('last_modified_date', pyarrow.timestamp('ms')), ('e_tag', pyarrow.string()), ('storage_class', pyarrow.string())
+        ])
+    )
+    if file_format == 'Parquet':
+        pytest.importorskip('pyarrow.parquet').write_table(table, path, row_group_size=2)
+    else:
+        pytest.importorskip('pyarrow.orc').write_table(table, path)
+
+
+def write_inventory(root, file_format):
+    """
+    Writes an inventory configuration folder in the inventory bucket of a LocalS3 root: two data
+    files, an older manifest and a newer dated folder whose manifest is not written yet.
+
+    Returns:
+    - path (str): The local configuration folder.
+    """
+    configuration_path = os.path.join(root, INVENTORY_BUCKET, CONFIGURATION)
+    os.makedirs(os.path.join(configuration_path, 'data'))
+    extension = {'CSV': 'csv.gz', 'Parquet': 'parquet', 'ORC': 'orc'}[file_format]
+    files = []
+    for number, rows in enumerate([ROWS[:3], ROWS[3:]]):
+        name = f'data/part-{number}.{extension}'
+        path = os.path.join(configuration_path, name)
+        if file_format == 'CSV':
+            write_csv(path, rows)
+        else:
+            write_arrow(path, rows, file_format)
+        files.append({'key': f'{CONFIGURATION}/{name}', 'size': os.path.getsize(path)})
+    manifest = {
+        'sourceBucket': 'videos',
+        'destinationBucket': f'arn:aws:s3:::{INVENTORY_BUCKET}',
+        'fileFormat': file_format,
+        'fileSchema': SCHEMA if file_format == 'CSV' else 'message s3.inventory { }',
+        'files': files
+    }
+    os.makedirs(os.path.join(configuration_path, '2024-01-01T01-00Z'))
+    with open(os.path.join(configuration_path, '2024-01-01T01-00Z', 'manifest.json'), 'w') as f:
+        json.dump(dict(manifest, files=[]), f)
+    os.makedirs(os.path.join(configuration_path, '2024-01-02T01-00Z'))
+    with open(os.path.join(configuration_path, '2024-01-02T01-00Z', 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    # Being written: no manifest yet, the one before is the latest
+    os.makedirs(os.path.join(configuration_path, '2024-01-03T01-00Z'))
+    with open(os.path.join(configuration_path, '2024-01-03T01-00Z', 'manifest.checksum'), 'w') as f:
+        f.write('')
+    return configuration_path
+
+
+@pytest.mark.parametrize('file_format', ['CSV', 'Parquet', 'ORC'])
+def test_local_inventory_yields_current_objects(tmp_path, file_format):
+    configuration_path = write_inventory(str(tmp_path), file_format)
+
+    objects = list(s3_inventory.iter_objects(None, configuration_path))
+
+    assert objects == EXPECTED
+
+
+@pytest.mark.parametrize('file_format', ['CSV', 'Parquet', 'ORC'])
+def test_s3_inventory_reads_the_latest_manifest(tmp_path, file_format):
+    write_inventory(str(tmp_path), file_format)
+    s3 = LocalS3(str(tmp_path))
+
+    objects = list(s3_inventory.iter_objects(s3, f's3://{INVENTORY_BUCKET}/{CONFIGURATION}/'))
+
+    assert objects == EXPECTED
+    # The manifest and the two data files, no listing of the inventoried bucket
+    assert s3.requests['GetObject'] == 3
+
+
+@pytest.mark.parametrize('file_format', ['CSV', 'Parquet', 'ORC'])
+def test_inventory_filters_and_projects(tmp_path, file_format):
+    configuration_path = write_inventory(str(tmp_path), file_format)
+
+    objects = list(s3_inventory.iter_objects(
+        None, configuration_path, prefix='1014000000/', suffix='.mp4',
+        modified_since=DAY + timedelta(hours=1), columns=('Size',)
+    ))
+
+    # Only the key, the asked columns and what the filters need are decoded
+    assert objects == [{'Key': '1014000000/a/with space.mp4', 'Size': 20, 'LastModified': DAY + timedelta(days=1)}]
+
+
+def test_find_manifest_without_manifest(tmp_path):
+    os.makedirs(tmp_path / '2024-01-03T01-00Z')
+
+    with pytest.raises(FileNotFoundError):
+        s3_inventory.find_manifest(str(tmp_path))
+
+
+def test_arrow_formats_need_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(s3_inventory, 'parquet', None)
+
+    with pytest.raises(ImportError, match='pyarrow'):
+        list(s3_inventory.iter_arrow_rows(str(tmp_path / 'part.parquet'), 'Parquet', {'key'}))
+
+
+def test_snake_case_matches_the_columnar_names():
+    names = [s3_inventory.snake_case(name.strip()) for name in SCHEMA.split(',')]
+
+    assert names == ['bucket', 'key', 'version_id', 'is_latest', 'is_delete_marker', 'size', 'last_modified_date', 'e_tag', 'storage_class']
@@ -0,0 +1,158 @@
+"""
+Drives s3_listing against LocalS3: shard discovery, ordered and unordered merging of the shards,
+filters, flat prefixes, errors of a shard, early stops and index_keys.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, 'benchmarks'), TESTS_DIR]
+
+import s3_listing
+from local_s3 import LocalS3
+
+BUCKET = 'videos'
+
+
+class SlowShardS3(LocalS3):
+    """LocalS3 whose listings of some prefixes are slow or fail, to shuffle the order pages arrive in."""
+
+    def __init__(self, root, delays=None, failing=None):
+        super().__init__(root)
+        self.delays = delays or {}
+        self.failing = failing
+
+    def get_paginator(self, operation_name):
+        return SlowShardPaginator(self, super().get_paginator(operation_name))
+
+
+class SlowShardPaginator:
+    def __init__(self, client, paginator):
+        self.client = client
+        self.paginator = paginator
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        # Shards are listed without a delimiter, the discovery of the levels is left alone
+        if Delimiter is None:
+            if Prefix == self.client.failing:
+                raise RuntimeError(f'Listing of {Prefix} failed')
+            time.sleep(self.client.delays.get(Prefix, 0))
+        yield from self.paginator.paginate(Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter, **kwargs)
+
+
+def make_bucket(root, keys):
+    for key in keys:
+        path = os.path.join(root, BUCKET, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+    return sorted(keys)
+
+
+def hierarchy():
+    keys = ['top.mp4', '1014000000/above-shards.json']
+    for season in range(3):
+        for episode in range(4):
+            prefix = f'1014000000/101408000{season}/10140800{season}{episode}'
+            keys += [f'{prefix}/video/{episode}.mp4', f'{prefix}/landscape-regular-thumb-tv.jpg']
+    return keys
+
+
+def test_discover_shards_splits_by_level(tmp_path):
+    make_bucket(tmp_path, hierarchy())
+
+    shards, objects = s3_listing.discover_shards(LocalS3(str(tmp_path)), BUCKET, depth=2)
+
+    assert shards == [f'1014000000/101408000{season}/' for season in range(3)]
+    assert sorted(obj['Key'] for obj in objects) == ['1014000000/above-shards.json', 'top.mp4']
+
+
+def test_discover_shards_keeps_flat_prefixes_whole(tmp_path):
+    flat = [f'flat/{number:05d}.mp4' for number in range(s3_listing.LEVEL_OBJECTS + 1)]
+    make_bucket(tmp_path, flat + ['1014000000/1014080000/a.mp4'])
+
+    shards, objects = s3_listing.discover_shards(LocalS3(str(tmp_path)), BUCKET, depth=2)
+
+    assert shards == ['1014000000/1014080000/', 'flat/']
+    assert objects == []
+
+
+def test_ordered_listing_matches_a_single_paginator(tmp_path):
+    keys = make_bucket(tmp_path, hierarchy())
+    # The first shard is the slowest, so its pages arrive last
+    s3 = SlowShardS3(str(tmp_path), delays={'1014000000/1014080000/': 0.2})
+
+    listed = [obj['Key'] for obj in s3_listing.iter_objects(s3, BUCKET, ordered=True, workers=4)]
+
+    assert listed == keys
+
+
+def test_unordered_listing_yields_every_object_once(tmp_path):
+    keys = make_bucket(tmp_path, hierarchy())
+    s3 = SlowShardS3(str(tmp_path), delays={'1014000000/1014080000/': 0.2})
+
+    listed = [obj['Key'] for obj in s3_listing.iter_objects(s3, BUCKET, workers=4)]
+
+    assert sorted(listed) == keys
+    # Pages are yielded as they arrive: the slow shard comes after the others
+    assert listed[-1].startswith('1014000000/1014080000/')
+    assert listed != keys
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_listing_filters_by_suffix_and_date(tmp_path, ordered):
+    keys = make_bucket(tmp_path, hierarchy())
+    now = datetime.now(timezone.utc)
+    old = (now - timedelta(days=3)).timestamp()
+    for key in keys[::2]:
+        os.utime(os.path.join(tmp_path, BUCKET, key), (old, old))
+
+    listed = s3_listing.iter_objects(
+        LocalS3(str(tmp_path)), BUCKET, suffix='.mp4', modified_since=now - timedelta(days=1), ordered=ordered
+    )
+
+    assert sorted(obj['Key'] for obj in listed) == [key for key in keys[1::2] if key.endswith('.mp4')]
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_listing_raises_the_error_of_a_shard(tmp_path, ordered):
+    make_bucket(tmp_path, hierarchy())
+    s3 = SlowShardS3(str(tmp_path), failing='1014000000/1014080001/')
+
+    with pytest.raises(RuntimeError, match='1014080001'):
+        list(s3_listing.iter_objects(s3, BUCKET, ordered=ordered, workers=2))
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_listing_stops_early(tmp_path, ordered):
+    make_bucket(tmp_path, hierarchy())
+    s3 = SlowShardS3(str(tmp_path), delays={'1014000000/1014080002/': 0.5})
+
+    started = time.monotonic()
+    listing = s3_listing.iter_objects(s3, BUCKET, ordered=ordered, workers=4)
+    first = next(listing)
+    listing.close()
+
+    assert first['Key']
+    # The slow shard is not waited for
+    assert time.monotonic() - started < 0.5
+
+
+def test_index_keys_keeps_the_named_files(tmp_path):
+    keys = make_bucket(tmp_path, hierarchy())
+    s3 = LocalS3(str(tmp_path))
+
+    index = s3_listing.index_keys(s3, BUCKET, ['landscape-regular-thumb-tv.jpg'])
+    assert index == {key for key in keys if key.endswith('/landscape-regular-thumb-tv.jpg')}
+
+    index = s3_listing.index_keys(s3, BUCKET, ['landscape-regular-thumb-tv.jpg'], prefixes=['1014000000/1014080001/'])
+    assert index == {key for key in keys if key.startswith('1014000000/1014080001/') and key.endswith('.jpg')}
@@ -0,0 +1,192 @@
+"""
+Drives s3_range_fetch against small MP4 files built box by box and served by LocalS3: the moov
+lookup (faststart, after the mdat, empty objects), the sample tables (stco and co64) and the
+sparse files written by fetch_video.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import struct
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [REPO_ROOT, os.path.join(REPO_ROOT, 'benchmarks'), TESTS_DIR]
+
+from local_s3 import LocalS3
+from s3_range_fetch import HEADER_READ_SIZE, fetch_video, find_moov, gop_byte_ranges, parse_video_track
+
+BUCKET = 'videos'
+
+# One sample per second, a keyframe every GOP samples
+TIMESCALE = 1000
+SAMPLES = 60
+GOP = 10
+SAMPLE_SIZE = 64 * 1024
+
+
+def box(box_type, *payloads):
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, *payloads):
+    return box(box_type, b'\0\0\0\0', *payloads)
+
+
+def sample_size(number):
+    # Sizes vary so offsets cannot be guessed from the sample number
+    return SAMPLE_SIZE + number * 16
+
+
+def build_moov(mdat_payload_offset, co64):
+    sizes = [sample_size(number) for number in range(SAMPLES)]
+    # Two samples per chunk
+    chunk_offsets = [mdat_payload_offset + sum(sizes[:number]) for number in range(0, SAMPLES, 2)]
+    if co64:
+        chunk_box = full_box(b'co64', struct.pack(f'>I{len(chunk_offsets)}Q', len(chunk_offsets), *chunk_offsets))
+    else:
+        chunk_box = full_box(b'stco', struct.pack(f'>I{len(chunk_offsets)}I', len(chunk_offsets), *chunk_offsets))
+    stbl = box(
+        b'stbl',
+        full_box(b'stsd', struct.pack('>I', 0)),
+        full_box(b'stts', struct.pack('>III', 1, SAMPLES, TIMESCALE)),
+        full_box(b'stss', struct.pack(f'>I{SAMPLES // GOP}I', SAMPLES // GOP, *range(1, SAMPLES + 1, GOP))),
+        full_box(b'stsz', struct.pack(f'>II{SAMPLES}I', 0, SAMPLES, *sizes)),
+        full_box(b'stsc', struct.pack('>IIII', 1, 1, 2, 1)),
+        chunk_box,
+    )
+    header = struct.pack('>IIII', 0, 0, TIMESCALE, SAMPLES * TIMESCALE)
+    trak = box(
+        b'trak',
+        box(b'mdia', full_box(b'mdhd', header), full_box(b'hdlr', b'\0\0\0\0', b'vide'), box(b'minf', stbl)),
+    )
+    sound = box(b'trak', box(b'mdia', full_box(b'hdlr', b'\0\0\0\0', b'soun')))
+    return box(b'moov', full_box(b'mvhd', header), sound, trak)
+
+
+def build_mp4(layout='faststart', co64=False):
+    """Returns the bytes of an MP4 with one video track and the offset of its moov atom."""
+    ftyp = box(b'ftyp', b'isom', b'\0\0\2\0', b'isomiso2')
+    mdat_payload = b''.join(bytes([number]) * sample_size(number) for number in range(SAMPLES))
+    mdat = box(b'mdat', mdat_payload)
+    moov_size = len(build_moov(0, co64))
+    if layout == 'faststart':
+        moov = build_moov(len(ftyp) + moov_size + 8, co64)
+        return ftyp + moov + mdat, len(ftyp)
+    moov = build_moov(len(ftyp) + 8, co64)
+    return ftyp + mdat + moov, len(ftyp) + len(mdat)
+
+
+def store(tmp_path, data, key='video.mp4'):
+    path = tmp_path / BUCKET / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return LocalS3(str(tmp_path)), key
+
+
+@pytest.mark.parametrize('co64', [False, True])
+def test_parse_video_track_expands_sample_tables(co64):
+    data, moov_offset = build_mp4(co64=co64)
+
+    track = parse_video_track(data[moov_offset:])
+
+    assert track['timescale'] == TIMESCALE
+    assert track['duration'] == SAMPLES
+    assert track['times'] == [number * TIMESCALE for number in range(SAMPLES)]
+    assert track['sizes'] == [sample_size(number) for number in range(SAMPLES)]
+    assert track['keyframes'] == list(range(0, SAMPLES, GOP))
+    # Every sample offset points at its own bytes in the mdat
+    for number, (offset, size) in enumerate(zip(track['offsets'], track['sizes'])):
+        assert data[offset:offset + size] == bytes([number]) * size
+
+
+def test_gop_byte_ranges_cover_the_gops_around_a_time_frame():
+    data, moov_offset = build_mp4()
+    track = parse_video_track(data[moov_offset:])
+
+    ranges = gop_byte_ranges(track, ['00:00:25'], margin=1)
+
+    # Samples 20 (keyframe before 24 s) to 30 (keyframe after 26 s), merged with the first keyframe
+    offsets, sizes = track['offsets'], track['sizes']
+    window = (offsets[20], offsets[30] + sizes[30] - 1)
+    assert any(start <= window[0] and window[1] <= end for start, end in ranges)
+    assert any(start <= offsets[0] and offsets[0] + sizes[0] - 1 <= end for start, end in ranges)
+
+
+def test_find_moov_faststart_reads_one_range(tmp_path):
+    data, moov_offset = build_mp4('faststart')
+    s3, key = store(tmp_path, data)
+
+    head, offset, moov = find_moov(s3, BUCKET, key, len(data))
+
+    assert offset == moov_offset
+    assert head == data[:len(head)] and moov == data[moov_offset:moov_offset + len(moov)]
+    assert len(head) == moov_offset + len(moov)
+    assert s3.requests['GetObject'] == 1
+
+
+@pytest.mark.parametrize('co64', [False, True])
+def test_find_moov_after_mdat_follows_box_headers(tmp_path, co64):
+    data, moov_offset = build_mp4('moov-at-end', co64=co64)
+    assert moov_offset > HEADER_READ_SIZE
+    s3, key = store(tmp_path, data)
+
+    head, offset, moov = find_moov(s3, BUCKET, key, len(data))
+
+    assert offset == moov_offset
+    assert moov == data[moov_offset:]
+    assert head == data[:HEADER_READ_SIZE]
+    # The first range, the header of the box after the mdat and the moov atom itself
+    assert s3.requests['GetObject'] == 3
+    assert s3.bytes_in == HEADER_READ_SIZE + 16 + len(moov)
+    assert parse_video_track(moov)['keyframes'] == list(range(0, SAMPLES, GOP))
+
+
+def test_find_moov_without_moov(tmp_path):
+    data = box(b'ftyp', b'isom') + box(b'mdat', b'\0' * 1024)
+    s3, key = store(tmp_path, data)
+
+    assert find_moov(s3, BUCKET, key, len(data)) is None
+
+
+def test_find_moov_empty_object_makes_no_request(tmp_path):
+    s3, key = store(tmp_path, b'')
+
+    assert find_moov(s3, BUCKET, key, 0) is None
+    assert s3.requests['GetObject'] == 0
+
+
+def test_fetch_video_empty_object_downloads_it(tmp_path):
+    s3, key = store(tmp_path, b'')
+    local_path = tmp_path / 'local.mp4'
+
+    assert fetch_video(s3, BUCKET, key, str(local_path), ['00:00:05'], object_size=0) == 0
+    assert local_path.read_bytes() == b''
+
+
+@pytest.mark.parametrize('layout', ['faststart', 'moov-at-end'])
+def test_fetch_video_writes_a_sparse_copy(tmp_path, layout):
+    data, moov_offset = build_mp4(layout, co64=layout != 'faststart')
+    s3, key = store(tmp_path, data)
+    local_path = tmp_path / 'local.mp4'
+
+    bytes_fetched = fetch_video(s3, BUCKET, key, str(local_path), ['00:00:45'], margin=1, object_size=len(data))
+
+    local = local_path.read_bytes()
+    assert len(local) == len(data)
+    # Box headers read while looking for the moov atom are not counted
+    assert bytes_fetched <= s3.bytes_in < len(data) // 2
+    assert s3.requests['GetObject'] > 1  # Ranged GETs, not one full download
+    track = parse_video_track(local[moov_offset:])
+    # The GOP around 45 s (samples 40 to 50) and the first keyframe have the bytes of the source
+    for number in [0] + list(range(40, 51)):
+        offset, size = track['offsets'][number], track['sizes'][number]
+        assert local[offset:offset + size] == data[offset:offset + size]
+    # Samples far from the time frame were not fetched
+    offset, size = track['offsets'][15], track['sizes'][15]
+    assert local[offset:offset + size] != data[offset:offset + size]
@@ -0,0 +1,102 @@
+"""
+Drives thumbnail_state through the life of a source video: new, started, failed, done, replaced
+and regenerated, including the done_etag that keeps a failed regeneration stale, and the
+migration of databases created before done_etag existed.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sqlite3
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTS_DIR)
+sys.path[:0] = [REPO_ROOT]
+
+from thumbnail_state import ThumbnailState
+
+VIDEO_KEY = '1014000000/1014080000/1014080067/video/a.mp4'
+THUMBNAILS = ['1014000000/1014080000/1014080067/landscape-regular-thumb-tv.jpg']
+
+
+def test_new_video_needs_processing(tmp_path):
+    state = ThumbnailState(str(tmp_path / 'state.db'))
+
+    assert state.get(VIDEO_KEY) is None
+    assert state.needs_processing(VIDEO_KEY, '"v1"')
+    assert not state.is_stale(VIDEO_KEY, '"v1"')
+
+
+def test_started_and_failed_videos_are_retried(tmp_path):
+    state = ThumbnailState(str(tmp_path / 'state.db'))
+
+    state.mark_started(VIDEO_KEY, '"v1"', 100, '2024-01-01 00:00:00+00:00')
+    assert state.get(VIDEO_KEY)['status'] == 'started'
+    assert state.needs_processing(VIDEO_KEY, '"v1"')
+
+    state.mark_failed(VIDEO_KEY, RuntimeError('decode error'))
+    record = state.get(VIDEO_KEY)
+    assert record['status'] == 'failed' and record['error'] == 'decode error'
+    assert record['done_etag'] is None
+    assert state.needs_processing(VIDEO_KEY, '"v1"')
+
+
+def test_done_video_is_skipped_until_replaced(tmp_path):
+    state = ThumbnailState(str(tmp_path / 'state.db'))
+    state.mark_started(VIDEO_KEY, '"v1"', 100, '2024-01-01')
+
+    state.mark_done(VIDEO_KEY, '"v1"', 100, '2024-01-01', THUMBNAILS, {'render': 0.5})
+
+    record = state.get(VIDEO_KEY)
+    assert record['status'] == 'done' and record['done_etag'] == '"v1"'
+    assert record['thumbnail_keys'] == THUMBNAILS and record['timings'] == {'render': 0.5}
+    assert not state.needs_processing(VIDEO_KEY, '"v1"')
+    # A new ETag means the source was replaced
+    assert state.needs_processing(VIDEO_KEY, '"v2"')
+    assert state.is_stale(VIDEO_KEY, '"v2"')
+
+
+def test_failed_regeneration_keeps_the_video_stale(tmp_path):
+    path = str(tmp_path / 'state.db')
+    state = ThumbnailState(path)
+    state.mark_done(VIDEO_KEY, '"v1"', 100, '2024-01-01', THUMBNAILS)
+
+    # The replaced source starts and fails: done_etag still names the old version
+    state.mark_started(VIDEO_KEY, '"v2"', 200, '2024-02-01')
+    state.mark_failed(VIDEO_KEY, 'interrupted')
+    state.close()
+
+    state = ThumbnailState(path)
+    record = state.get(VIDEO_KEY)
+    assert record['etag'] == '"v2"' and record['done_etag'] == '"v1"'
+    assert state.needs_processing(VIDEO_KEY, '"v2"')
+    assert state.is_stale(VIDEO_KEY, '"v2"')
+
+    state.mark_started(VIDEO_KEY, '"v2"', 200, '2024-02-01')
+    state.mark_done(VIDEO_KEY, '"v2"', 200, '2024-02-01', THUMBNAILS)
+    assert not state.needs_processing(VIDEO_KEY, '"v2"')
+    assert not state.is_stale(VIDEO_KEY, '"v2"')
+
+
+def test_databases_without_done_etag_are_migrated(tmp_path):
+    path = str(tmp_path / 'state.db')
+    connection = sqlite3.connect(path)
+    connection.execute('''
+        CREATE TABLE videos (
+            video_key TEXT PRIMARY KEY, etag TEXT, size INTEGER, last_modified TEXT, status TEXT,
+            thumbnail_keys TEXT, timings TEXT, error TEXT, updated_at TEXT
+        )
+    ''')
+    connection.execute("INSERT INTO videos (video_key, etag, status) VALUES ('done.mp4', '\"v1\"', 'done')")
+    connection.execute("INSERT INTO videos (video_key, etag, status) VALUES ('failed.mp4', '\"v1\"', 'failed')")
+    connection.commit()
+    connection.close()
+
+    state = ThumbnailState(path)
+
+    assert state.get('done.mp4')['done_etag'] == '"v1"'
+    assert not state.needs_processing('done.mp4', '"v1"')
+    assert state.get('failed.mp4')['done_etag'] is None
+    assert state.needs_processing('failed.mp4', '"v1"')
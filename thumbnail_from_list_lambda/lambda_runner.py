@@ -1,7 +1,10 @@
 import boto3
-import subprocess
-import os
+import decode_backend
+import frame_selection
+import video_probe
 import json
+from s3_range_fetch import SEEK_MARGIN, parse_timestamp
+from tmp_cache import SourceVideoCache
 
 # Initialize S3 client
 s3 = boto3.client('s3')
@@ -17,64 +20,89 @@ time_frames = ['00:05:00']  # Frames to capture thumbnails
 
 # Path to FFmpeg
 ffmpeg_path = '/opt/ffmpeg/ffmpeg'  # Adjust the path as necessary
+ffprobe_path = '/opt/ffmpeg/ffprobe'
 
-def lambda_handler(event, context):
-    # Extract the video_key from the event
-    video_key = event.get('VIDEO_KEY')
-    if not video_key:
-        return {
-            'statusCode': 400,
-            'body': 'VIDEO_KEY not found in the event'
-        }
+# Frame decoder ('pyav', 'ffmpeg' or 'auto': PyAV when it, Pillow and NumPy are in the layer) and whether PyAV
+# derives the smaller sizes from the largest one (FFmpeg scales every size itself)
+decode_backend_name = 'auto'
+downscale_from_largest = True
 
-    # Source and destination bucket names
-    source_bucket_name = 'avs-vod-mc-input-2c87c40d939653bdbef99ff1ce204afc'
-    destination_bucket_name = 'caracol-image-ingest-prod'
-
-    # Temporary paths
-    local_video_path = f'/tmp/{os.path.basename(video_key)}'
-    
-    try:
-        # Download the video from the S3 bucket
-        s3.download_file(source_bucket_name, video_key, local_video_path)
-        
+# Use the best keyframe within selection_window seconds of each time frame instead of the exact time
+select_best_frames = True
+selection_window = 15
+
+# Source videos kept in /tmp between warm invocations (bucket/key/ETag), within the size of /tmp
+# minus the room a render needs (or SOURCE_CACHE_MAX_BYTES bytes)
+source_cache = SourceVideoCache('/tmp/source-cache')
+
+# Duration and keyframe index of every source version (ETag) probed by this container, used to seek with FFmpeg
+probe_cache = video_probe.ProbeCache('/tmp/probe-cache', ffprobe_path)
+
+def generate_thumbnails(video_key, source_bucket_name, destination_bucket_name):
+    # Download only the parts of the video needed for the time frames, unless a warm container already has them
+    margin = selection_window + SEEK_MARGIN if select_best_frames else SEEK_MARGIN
+    head = s3.head_object(Bucket=source_bucket_name, Key=video_key)
+    with source_cache.open(s3, source_bucket_name, video_key, time_frames, margin, head) as local_video_path:
         # Create thumbnails
         root_dir = '/'.join(video_key.split('/')[:-2])  # Extracts the root directory
-        
-        for frame in time_frames:
-            for width, height, name in sizes:
-                frame_thumbnail = f'/tmp/{name}.{format}'
-                thumbnail_key = f'{root_dir}/{name}.{format}'
-                
-                # Generate the thumbnail
-                ffmpeg_command = [
-                    ffmpeg_path, '-i', local_video_path, '-ss', frame, '-vframes', '1', 
-                    '-vf', f'scale={width}:{height}', frame_thumbnail
-                ]
-                subprocess.run(ffmpeg_command, check=True)
-                
-                # Upload the thumbnail to the S3 bucket
-                with open(frame_thumbnail, 'rb') as f:
+
+        backend = decode_backend.get_backend(decode_backend_name, ffmpeg_path)
+        # FFmpeg needs the duration and keyframes up front to clamp and seek, PyAV reads them itself
+        probe = probe_cache.get(local_video_path, source_bucket_name, video_key, head['ETag']) if backend.name == 'ffmpeg' else None
+        with backend.open(local_video_path, probe) as video:
+            for frame in time_frames:
+                if select_best_frames:
+                    frame = frame_selection.select_frame(video, frame, selection_window)
+
+                # Generate every thumbnail size from a single decode of the frame
+                if backend.name == 'pyav':
+                    thumbnails = decode_backend.render_thumbnails(video, frame, sizes, format, downscale_from_largest)
+                else:
+                    # FFmpeg scales and encodes every size itself, each image written to its own pipe
+                    thumbnails = video.encode_thumbnails(parse_timestamp(frame), sizes, format)
+
+                for name, image in thumbnails:
+                    thumbnail_key = f'{root_dir}/{name}.{format}'
+
+                    # Upload the thumbnail to the S3 bucket straight from memory
                     s3.put_object(
                         Bucket=destination_bucket_name,
                         Key=thumbnail_key,
-                        Body=f
+                        Body=image
                     )
-                
-                # Remove the local thumbnail after upload
-                os.remove(frame_thumbnail)
 
-        # Remove the local video file after processing
-        os.remove(local_video_path)
-        
-        return {
-            'statusCode': 200,
-            'body': 'Thumbnails generated and uploaded successfully.'
-        }
-    
-    except Exception as e:
-        print(f'Error: {e}')
+def lambda_handler(event, context):
+    # Extract the video keys from the event: a batch in VIDEO_KEYS or a single VIDEO_KEY
+    video_keys = event.get('VIDEO_KEYS') or ([event['VIDEO_KEY']] if event.get('VIDEO_KEY') else [])
+    if not video_keys:
         return {
-            'statusCode': 500,
-            'body': f'Error processing video: {e}'
+            'statusCode': 400,
+            'body': 'VIDEO_KEY not found in the event'
         }
+
+    # Source and destination bucket names
+    source_bucket_name = event.get('SOURCE_BUCKET', 'avs-vod-mc-input-2c87c40d939653bdbef99ff1ce204afc')
+    destination_bucket_name = event.get('DESTINATION_BUCKET', 'caracol-image-ingest-prod')
+
+    # The videos of a batch share the warm container, its decoder and its source cache
+    results = {}
+    for video_key in video_keys:
+        try:
+            generate_thumbnails(video_key, source_bucket_name, destination_bucket_name)
+            results[video_key] = 'succeeded'
+        except Exception as e:
+            print(f'Error processing {video_key}: {e}')
+            results[video_key] = f'Error processing video: {e}'
+
+    # 200 when every video succeeded, 207 when only some did, 500 when all of them failed
+    failed = sum(1 for result in results.values() if result != 'succeeded')
+    if not failed:
+        status_code = 200
+    elif failed < len(results):
+        status_code = 207
+    else:
+        status_code = 500
+    return {
+        'statusCode': status_code,
+        'body': json.dumps(results)
+    }
@@ -1,5 +1,17 @@
 import boto3
 import json
+import os
+import random
+import sys
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# The shared modules (s3_catalog, s3_listing) live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3_listing
+from s3_catalog import S3Catalog
 
 # Name of the source and destination buckets
 source_bucket_name = 'avs-vod-mc-input-2c87c40d939653bdbef99ff1ce204afc'
@@ -8,23 +20,23 @@ destination_bucket_name = 'caracol-image-ingest-prod'
 # Name of the Lambda function
 lambda_function_name = 'GenerateThumbnails'
 
-# Initialize S3 and Lambda clients
-s3_client = boto3.client('s3')
-lambda_client = boto3.client('lambda')
+# Lambda executions running at the same time and videos sent to each one
+max_concurrent_invocations = 100
+videos_per_invocation = 5
 
-# List all .mp4 files in the source bucket
-response = s3_client.list_objects_v2(Bucket=source_bucket_name)
-mp4_files = [content['Key'] for content in response.get('Contents', []) if content['Key'].endswith('.mp4')]
+# Throttled invocations are retried with full-jitter exponential backoff
+max_invoke_attempts = 8
+retry_base_delay = 1
+retry_max_delay = 60
 
-# Function to check if a thumbnail already exists in the destination bucket
-def thumbnail_exists(bucket_name, thumbnail_key):
-    try:
-        s3_client.head_object(Bucket=bucket_name, Key=thumbnail_key)
-        return True
-    except s3_client.exceptions.ClientError:
-        return False
+# Concurrent list_objects_v2 requests used to list the source bucket
+listing_workers = 16
+
+# Local catalog of the buckets shared by the scripts (see s3_catalog.py), e.g. 's3_catalog.db'; videos uploaded into a
+# prefix listed less than s3_catalog.MAX_AGE ago are not seen. None lists the source bucket on every run
+catalog_path = None
 
-# Define the root directory for the thumbnails
+# Thumbnails generated by the Lambda function for every video
 sizes = [
     (260, 163, 'landscape-regular-thumb-mobile'),
     (377, 236, 'landscape-regular-thumb-tablet'),
@@ -33,43 +45,125 @@ sizes = [
 format = 'jpg'
 time_frames = ['00:05:00']
 
-# Loop through each .mp4 file found
-for video_key in mp4_files:
-    print(f"Processing {video_key}...")
-    
-    root_dir = '/'.join(video_key.split('/')[:-2])
-    
-    all_thumbnails_exist = True
-    for frame in time_frames:
-        for width, height, name in sizes:
-            thumbnail_key = f'{root_dir}/{name}.{format}'
-            if not thumbnail_exists(destination_bucket_name, thumbnail_key):
-                all_thumbnails_exist = False
-                break
-        if not all_thumbnails_exist:
-            break
+# Function to create the S3 and Lambda clients; the S3 client needs one connection per listing worker, the Lambda
+# client one per concurrent invocation and must wait as long as the function may run
+def create_clients():
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=listing_workers))
+    lambda_client = boto3.client('lambda', config=Config(
+        max_pool_connections=max_concurrent_invocations,
+        read_timeout=900,
+        retries={'mode': 'standard', 'max_attempts': 1}
+    ))
+    return s3_client, lambda_client
 
-    if all_thumbnails_exist:
-        print(f"All thumbnails for {video_key} already exist, skipping Lambda invocation.")
-        continue
+# Function to list all .mp4 files in the source bucket, from the catalog (only new or stale prefixes are listed again)
+# or listing its prefixes concurrently
+def list_mp4_files(s3_client, bucket_name):
+    if catalog_path:
+        catalog = S3Catalog(catalog_path)
+        try:
+            catalog.ensure_fresh(s3_client, bucket_name, workers=listing_workers)
+            return [content['Key'] for content in catalog.query(bucket_name, suffix='.mp4')]
+        finally:
+            catalog.close()
+    return sorted(
+        content['Key']
+        for content in s3_listing.iter_objects(s3_client, bucket_name, suffix='.mp4', workers=listing_workers)
+    )
 
-    # Invoke the Lambda function synchronously
+# Function to invoke the Lambda function for a batch of videos, retrying throttled invocations
+def invoke_batch(lambda_client, video_keys):
+    """
+    Returns:
+    - results (dict): 'succeeded' or the error message of every video in the batch.
+    """
     payload = json.dumps({
-        'VIDEO_KEY': video_key,
+        'VIDEO_KEYS': video_keys,
         'SOURCE_BUCKET': source_bucket_name,
         'DESTINATION_BUCKET': destination_bucket_name
     })
-    response = lambda_client.invoke(
-        FunctionName=lambda_function_name,
-        InvocationType='RequestResponse',  # Uses 'RequestResponse' for synchronous invocation
-        Payload=payload  # Sends the video_key and bucket names as payload
-    )
+    for attempt in range(max_invoke_attempts):
+        try:
+            response = lambda_client.invoke(
+                FunctionName=lambda_function_name,
+                InvocationType='RequestResponse',  # Uses 'RequestResponse' for synchronous invocation
+                Payload=payload  # Sends the video keys and bucket names as payload
+            )
+            break
+        except (lambda_client.exceptions.TooManyRequestsException,
+                lambda_client.exceptions.EC2ThrottledException,
+                lambda_client.exceptions.ServiceException) as e:
+            if attempt == max_invoke_attempts - 1:
+                raise
+            delay = random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+            print(f'Invocation throttled ({e.__class__.__name__}), retrying {len(video_keys)} videos in {delay:.1f} seconds...')
+            time.sleep(delay)
 
     # Check the Lambda response to ensure the execution was successful
-    status_code = response['StatusCode']
-    if status_code == 200:
-        print(f"Lambda for {video_key} completed successfully.")
-    else:
-        print(f"Error invoking Lambda for {video_key}. Status code: {status_code}")
+    body = json.loads(response['Payload'].read() or 'null')
+    if response.get('FunctionError') or not isinstance(body, dict) or 'statusCode' not in body:
+        error = body.get('errorMessage') if isinstance(body, dict) else body
+        return {video_key: f'Lambda error: {error}' for video_key in video_keys}
+    try:
+        return json.loads(body['body'])
+    except (TypeError, ValueError):
+        # Plain text answer of a single video invocation
+        result = 'succeeded' if body['statusCode'] == 200 else body['body']
+        return {video_key: result for video_key in video_keys}
+
+def main():
+    s3_client, lambda_client = create_clients()
+
+    mp4_files = list_mp4_files(s3_client, source_bucket_name)
+    print(f'Found {len(mp4_files)} .mp4 files in {source_bucket_name}')
+
+    # Index the destination bucket once instead of calling head_object for every thumbnail
+    thumbnail_names = {f'{name}.{format}' for width, height, name in sizes}
+    existing_thumbnails = s3_listing.index_keys(s3_client, destination_bucket_name, thumbnail_names, workers=listing_workers)
+    print(f'Indexed {len(existing_thumbnails)} existing thumbnails in {destination_bucket_name}')
+
+    # Keep only the videos with a missing thumbnail
+    pending_videos = []
+    for video_key in mp4_files:
+        root_dir = '/'.join(video_key.split('/')[:-2])
+
+        all_thumbnails_exist = all(
+            f'{root_dir}/{name}.{format}' in existing_thumbnails
+            for frame in time_frames
+            for width, height, name in sizes
+        )
+        if all_thumbnails_exist:
+            print(f"All thumbnails for {video_key} already exist, skipping Lambda invocation.")
+            continue
+        pending_videos.append(video_key)
+
+    # Invoke the Lambda function for batches of videos, many executions at a time
+    batches = [pending_videos[i:i + videos_per_invocation] for i in range(0, len(pending_videos), videos_per_invocation)]
+    print(f'Invoking {lambda_function_name} for {len(pending_videos)} videos in {len(batches)} batches...')
+    summary = {'succeeded': 0, 'failed': 0, 'skipped': len(mp4_files) - len(pending_videos)}
+    failures = {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_concurrent_invocations) as executor:
+        futures = {executor.submit(invoke_batch, lambda_client, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                results = {video_key: f'Invocation failed: {e}' for video_key in futures[future]}
+            for video_key in futures[future]:
+                result = results.get(video_key, 'No result returned')
+                if result == 'succeeded':
+                    summary['succeeded'] += 1
+                    print(f"Lambda for {video_key} completed successfully.")
+                else:
+                    summary['failed'] += 1
+                    failures[video_key] = result
+                    print(f"Error processing {video_key}: {result}")
+
+    print(f"Processing completed in {time.monotonic() - started:.1f}s: {summary}")
+    for video_key, error in failures.items():
+        print(f'  {video_key}: {error}')
+    return summary
 
-print("Processing completed.")
+if __name__ == '__main__':
+    main()
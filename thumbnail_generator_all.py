@@ -1,7 +1,18 @@
 import os
+import shutil
 import boto3
-import subprocess
+import decode_backend
+import frame_selection
+import s3_inventory
+import s3_listing
+import video_probe
+import tempfile
+import time
 from datetime import datetime
+from s3_catalog import S3Catalog
+from s3_range_fetch import SEEK_MARGIN, fetch_video, parse_timestamp
+from thumbnail_pipeline import ThumbnailPipeline
+from thumbnail_state import ThumbnailState
 
 # Initialize the S3 client
 s3 = boto3.client('s3')
@@ -12,6 +23,7 @@ destination_bucket_name = 'caracol-image-ingest-prod'
 
 # Path to the FFmpeg binary in CloudShell
 ffmpeg_path = "/mnt/c/Users/Bruno/Desktop/clients/python_scripts/ffmpeg-7.0.1-amd64-static/ffmpeg"
+ffprobe_path = "/mnt/c/Users/Bruno/Desktop/clients/python_scripts/ffmpeg-7.0.1-amd64-static/ffprobe"
 
 # Thumbnail sizes and corresponding names
 sizes = [
@@ -23,35 +35,102 @@ sizes = [
 # Format for the thumbnail images
 format = 'jpg'
 
-# Time frames to capture thumbnails from the video
+# Time frames to capture thumbnails from the video. The thumbnail keys do not name the frame, so
+# only the first one is rendered; the others would overwrite it under the same keys
 time_frames = ['00:05:00']
 
+# Concurrency of each pipeline stage (set all to 1 to process one video at a time)
+download_workers = 4
+render_workers = os.cpu_count()
+upload_workers = 8
+
+# Downloads wait until /tmp has at least this much free space, for at most max_tmp_wait seconds
+min_free_tmp_bytes = 2 * 1024 ** 3
+max_tmp_wait = 600
+
+# Concurrent list_objects_v2 requests used to list the source bucket, one prefix shard each
+listing_workers = 16
+
+# S3 Inventory of the source bucket (manifest.json or configuration folder, s3://... or local, see s3_inventory.py):
+# read instead of listing the bucket, so videos uploaded since the last inventory are picked up by the next run
+inventory_location = None
+
+# Local catalog of the buckets shared by the scripts (see s3_catalog.py), e.g. 's3_catalog.db': listings become
+# queries and only new or stale prefixes are listed again, so videos uploaded into a prefix listed less than
+# s3_catalog.MAX_AGE ago wait for a later run (None lists the buckets on every run)
+catalog_path = None
+
+# Answer thumbnail existence checks from one listing of the destination bucket instead of HEAD requests
+use_thumbnail_index = True
+
+# Keep thumbnails in memory (decoder -> put_object) instead of writing them to /tmp before uploading
+in_memory_thumbnails = True
+
+# Frame decoder: 'pyav' decodes in-process, 'ffmpeg' runs the binary, 'auto' uses PyAV when it, Pillow and
+# NumPy are installed (the Lambda layer must ship them), FFmpeg otherwise
+decode_backend_name = 'auto'
+
+# With PyAV, decode once at the largest size and derive the smaller sizes from it with Pillow
+# (FFmpeg scales every size itself in one split/scale run)
+downscale_from_largest = True
+
+# Use the best keyframe (not black, flat or blurry) within selection_window seconds of each time frame
+select_best_frames = True
+selection_window = 15
+
+# Duration and keyframe index of every source version (ETag) probed in this run, used to seek with FFmpeg
+probe_cache = video_probe.ProbeCache(ffprobe_path=ffprobe_path)
+
+# Local database of processed videos and their ETags; later runs only process new or changed videos (None disables it)
+state_db_path = 'thumbnail_state.db'
+
+# State store opened by process_videos() and the listing of the videos it is processing
+state = None
+video_objects = {}
+
+# Catalog opened by list_mp4_objects() when catalog_path is set
+catalog = None
+
+# Function to list all .mp4 objects (Key, ETag, Size, LastModified) in the source bucket
+def list_mp4_objects(bucket_name):
+    global catalog
+    if inventory_location:
+        inventory = s3_inventory.iter_objects(s3, inventory_location, suffix='.mp4', columns=('Key', 'Size', 'ETag', 'LastModified'))
+        return sorted(inventory, key=lambda obj: obj['Key'])
+    if catalog_path:
+        if catalog is None:
+            catalog = S3Catalog(catalog_path)
+        catalog.ensure_fresh(s3, bucket_name, workers=listing_workers)
+        return list(catalog.query(bucket_name, suffix='.mp4'))
+    # Shards are listed concurrently and their pages come in any order, sort them back by key
+    mp4_objects = s3_listing.iter_objects(s3, bucket_name, suffix='.mp4', workers=listing_workers)
+    return sorted(mp4_objects, key=lambda obj: obj['Key'])
+
 # Function to list all .mp4 files in the source bucket
 def list_mp4_files(bucket_name):
-    mp4_files = []
-    paginator = s3.get_paginator('list_objects_v2')
-    for page in paginator.paginate(Bucket=bucket_name):
-        for obj in page.get('Contents', []):
-            if obj['Key'].endswith('.mp4'):
-                mp4_files.append(obj['Key'])
-    return mp4_files
+    return [obj['Key'] for obj in list_mp4_objects(bucket_name)]
+
+# Keys of the thumbnails already in the destination bucket, filled by load_thumbnail_index()
+existing_thumbnails = None
+
+# Function to list the destination bucket once and index the thumbnails that already exist
+def load_thumbnail_index(bucket_name, prefixes=None):
+    global existing_thumbnails
+    thumbnail_names = {f'{name}.{format}' for width, height, name in sizes}
+    existing_thumbnails = s3_listing.index_keys(s3, bucket_name, thumbnail_names, prefixes, workers=listing_workers)
+    print(f'Indexed {len(existing_thumbnails)} existing thumbnails in {bucket_name}')
+    return existing_thumbnails
 
 # Function to check if a thumbnail already exists in the destination bucket
 def thumbnail_exists(bucket_name, thumbnail_key):
+    if existing_thumbnails is not None and bucket_name == destination_bucket_name:
+        return thumbnail_key in existing_thumbnails
     try:
         s3.head_object(Bucket=bucket_name, Key=thumbnail_key)
         return True
     except s3.exceptions.ClientError:
         return False
 
-# Function to create a thumbnail from the video
-def create_thumbnail(video_path, frame, frame_thumbnail, width, height):
-    ffmpeg_command = [
-        ffmpeg_path, '-i', video_path, '-ss', frame, '-vframes', '1', 
-        '-vf', f'scale={width}:{height}', f'{frame_thumbnail}.{format}'
-    ]
-    subprocess.run(ffmpeg_command, check=True)
-
 # Function to upload a thumbnail to the destination bucket
 def s3_upload(file_key, bucket_name, image_file):
     print(f'Uploading file {image_file} to bucket {bucket_name} at path {file_key}')
@@ -62,54 +141,163 @@ def s3_upload(file_key, bucket_name, image_file):
             Body=f
         )
 
+# Function to upload a thumbnail held in memory to the destination bucket
+def s3_upload_bytes(file_key, bucket_name, image):
+    print(f'Uploading {len(image)} bytes to bucket {bucket_name} at path {file_key}')
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=file_key,
+        Body=image
+    )
+
+# Download stage: skips videos whose thumbnails all exist, otherwise fetches the video
+def download_video(video_key):
+    root_dir = os.path.dirname(os.path.dirname(video_key))  # Adjusted for directory structure
+    video_object = video_objects.get(video_key, {})
+    etag, size, last_modified = video_object.get('ETag'), video_object.get('Size'), video_object.get('LastModified')
+
+    if state is not None and state.is_stale(video_key, etag):
+        # The source was replaced since its thumbnails were generated
+        print(f'[{datetime.now()}] {video_key} changed since the last run, regenerating all thumbnails.')
+        missing_sizes = list(sizes)
+    else:
+        missing_sizes = [
+            (width, height, name) for width, height, name in sizes
+            if not thumbnail_exists(destination_bucket_name, f'{root_dir}/{name}.{format}')
+        ]
+
+    if not missing_sizes:
+        print(f'[{datetime.now()}] All thumbnails for {video_key} already exist, skipping download and generation.')
+        if state is not None:
+            state.mark_done(video_key, etag, size, last_modified, [f'{root_dir}/{name}.{format}' for width, height, name in sizes])
+        return None
+
+    if state is not None:
+        state.mark_started(video_key, etag, size, last_modified)
+    started = time.monotonic()
+
+    # Per-job scratch directory so concurrent jobs never share file names, even for videos with the
+    # same file name under different prefixes
+    output_dir = tempfile.mkdtemp(prefix=f'{os.path.splitext(os.path.basename(video_key))[0]}-', dir='/tmp')
+    job = {
+        'video_key': video_key,
+        'root_dir': root_dir,
+        'output_dir': output_dir,
+        'local_video_path': os.path.join(output_dir, os.path.basename(video_key)),
+        'etag': etag,
+        'missing_sizes': missing_sizes,
+        'thumbnails': [],
+        'images': [],
+        'timings': {}
+    }
+
+    # Log message before downloading the next video
+    print(f'[{datetime.now()}] Starting download of video {video_key} from {source_bucket_name}...')
+
+    # Download only the parts of the video needed for the rendered time frame
+    try:
+        margin = selection_window + SEEK_MARGIN if select_best_frames else SEEK_MARGIN
+        fetch_video(s3, source_bucket_name, video_key, job['local_video_path'], time_frames[:1], margin, object_size=size)
+    except Exception:
+        cleanup_job(job)
+        raise
+    job['timings']['download'] = time.monotonic() - started
+    print(f'[{datetime.now()}] Finished downloading video {video_key}.')
+    return job
+
+# Render stage: decodes the frame once and scales it to every missing size
+def render_thumbnails(job):
+    print(f'[{datetime.now()}] Starting thumbnail generation for video {job["video_key"]}...')
+    started = time.monotonic()
+    backend = decode_backend.get_backend(decode_backend_name, ffmpeg_path)
+    pending_sizes = job['missing_sizes']
+    # FFmpeg needs the duration and keyframes up front to clamp and seek, PyAV reads them itself
+    probe = None
+    if backend.name == 'ffmpeg':
+        probe = probe_cache.get(job['local_video_path'], source_bucket_name, job['video_key'], job['etag'])
+    with backend.open(job['local_video_path'], probe) as video:
+        # Thumbnail keys do not name the frame, see time_frames
+        frame = time_frames[0]
+        if select_best_frames:
+            frame = frame_selection.select_frame(video, frame, selection_window)
+        if backend.name == 'pyav':
+            # Decode once through PyAV, then scale and encode each size with Pillow
+            thumbnails = decode_backend.render_thumbnails(video, frame, pending_sizes, format, downscale_from_largest)
+        else:
+            # Decode once and let FFmpeg scale and encode every size, each image written to its own pipe
+            thumbnails = video.encode_thumbnails(parse_timestamp(frame), pending_sizes, format)
+    for name, image in thumbnails:
+        if in_memory_thumbnails:
+            job['images'].append((f'{job["root_dir"]}/{name}.{format}', image))
+        else:
+            frame_thumbnail = os.path.join(job['output_dir'], f'{name}.{format}')
+            with open(frame_thumbnail, 'wb') as f:
+                f.write(image)
+            job['thumbnails'].append((f'{job["root_dir"]}/{name}.{format}', frame_thumbnail))
+
+    # The source video is no longer needed once the thumbnails exist
+    os.remove(job['local_video_path'])
+    job['timings']['render'] = time.monotonic() - started
+    return job
+
+# Upload stage: sends the generated thumbnails to the destination bucket
+def upload_thumbnails(job):
+    started = time.monotonic()
+    for thumbnail_key, image_file in job['thumbnails']:
+        s3_upload(thumbnail_key, destination_bucket_name, image_file)
+        if existing_thumbnails is not None:
+            existing_thumbnails.add(thumbnail_key)
+    for thumbnail_key, image in job['images']:
+        s3_upload_bytes(thumbnail_key, destination_bucket_name, image)
+        if existing_thumbnails is not None:
+            existing_thumbnails.add(thumbnail_key)
+    job['timings']['upload'] = time.monotonic() - started
+
+    if state is not None:
+        video_key = job['video_key']
+        video_object = video_objects.get(video_key, {})
+        state.mark_done(
+            video_key, video_object.get('ETag'), video_object.get('Size'), video_object.get('LastModified'),
+            [f'{job["root_dir"]}/{name}.{format}' for width, height, name in sizes], job['timings']
+        )
+    print(f'[{datetime.now()}] Finished processing video {job["video_key"]}.\n')
+
+# Removes the per-video scratch directory, whether or not the job succeeded
+def cleanup_job(job):
+    shutil.rmtree(job['output_dir'], ignore_errors=True)
+
 # Main function to process videos in CloudShell
 def process_videos():
-    mp4_files = list_mp4_files(source_bucket_name)
-
-    for video_key in mp4_files:
-        video_filename = os.path.splitext(os.path.basename(video_key))[0]
-        root_dir = os.path.dirname(os.path.dirname(video_key))  # Adjusted for directory structure
-        output_dir = '/tmp'
-
-        all_thumbnails_exist = True
-        for frame in time_frames:
-            for width, height, name in sizes:
-                thumbnail_key = f'{root_dir}/{name}.{format}'
-                if not thumbnail_exists(destination_bucket_name, thumbnail_key):
-                    all_thumbnails_exist = False
-                    break
-            if not all_thumbnails_exist:
-                break
-
-        if all_thumbnails_exist:
-            print(f'[{datetime.now()}] All thumbnails for {video_key} already exist, skipping download and generation.')
-            continue
-
-        # Log message before downloading the next video
-        print(f'[{datetime.now()}] Starting download of video {video_key} from {source_bucket_name}...')
-
-        local_video_path = f'/tmp/{os.path.basename(video_key)}'
-
-        # Download the video from the source bucket
-        s3.download_file(source_bucket_name, video_key, local_video_path)
-        print(f'[{datetime.now()}] Finished downloading video {video_key}.')
-
-        # Log message before starting the thumbnail generation
-        print(f'[{datetime.now()}] Starting thumbnail generation for video {video_key}...')
-
-        for frame in time_frames:
-            for width, height, name in sizes:
-                frame_thumbnail = os.path.join(output_dir, f'{name}')
-                thumbnail_key = f'{root_dir}/{name}.{format}'
-
-                if not thumbnail_exists(destination_bucket_name, thumbnail_key):
-                    create_thumbnail(local_video_path, frame, frame_thumbnail, width, height)
-                    s3_upload(thumbnail_key, destination_bucket_name, f'{frame_thumbnail}.{format}')
-                    os.remove(f'{frame_thumbnail}.{format}')  # Remove the generated thumbnail after upload
-
-        # Remove the local video file after processing
-        os.remove(local_video_path)
-        print(f'[{datetime.now()}] Finished processing video {video_key}.\n')
+    global state
+    mp4_objects = list_mp4_objects(source_bucket_name)
+    video_objects.update({obj['Key']: obj for obj in mp4_objects})
+
+    if state_db_path:
+        # Only new, changed or unfinished videos go through the pipeline
+        state = ThumbnailState(state_db_path)
+        mp4_objects = [obj for obj in mp4_objects if state.needs_processing(obj['Key'], obj['ETag'])]
+        print(f'[{datetime.now()}] {len(mp4_objects)} videos are new, changed or unfinished since the last run.')
+    mp4_files = [obj['Key'] for obj in mp4_objects]
+
+    if use_thumbnail_index:
+        load_thumbnail_index(destination_bucket_name)
+    pipeline = ThumbnailPipeline(
+        download_video, render_thumbnails, upload_thumbnails, cleanup_job,
+        download_workers=download_workers,
+        render_workers=render_workers,
+        upload_workers=upload_workers,
+        tmp_dir='/tmp',
+        min_free_bytes=min_free_tmp_bytes,
+        max_disk_wait=max_tmp_wait
+    )
+    summary = pipeline.run(mp4_files)
+
+    if state is not None:
+        for video_key, error in pipeline.errors.items():
+            state.mark_failed(video_key, error)
+        state.close()
+        state = None
+    return summary
 
 if __name__ == '__main__':
     process_videos()
@@ -1,7 +1,14 @@
 import os
+import shutil
 import boto3
-import subprocess
+import decode_backend
+import frame_selection
+import s3_listing
+import video_probe
+import tempfile
 from datetime import datetime
+from s3_range_fetch import SEEK_MARGIN, fetch_video, parse_timestamp
+from thumbnail_pipeline import ThumbnailPipeline
 
 # Initialize the S3 client
 s3 = boto3.client('s3')
@@ -12,6 +19,7 @@ destination_bucket_name = 'caracol-image-ingest-prod'
 
 # Path to the FFmpeg binary in CloudShell
 ffmpeg_path = "./ffmpeg-7.0.1-amd64-static/ffmpeg"
+ffprobe_path = "./ffmpeg-7.0.1-amd64-static/ffprobe"
 
 # Thumbnail sizes and corresponding names
 sizes = [
@@ -23,25 +31,60 @@ sizes = [
 # Format for the thumbnail images
 format = 'jpg'
 
-# Time frames to capture thumbnails from the video
+# Time frames to capture thumbnails from the video. The thumbnail keys do not name the frame, so
+# only the first one is rendered; the others would overwrite it under the same keys
 time_frames = ['00:05:00']
 
+# Concurrency of each pipeline stage (set all to 1 to process one video at a time)
+download_workers = 4
+render_workers = os.cpu_count()
+upload_workers = 8
+
+# Downloads wait until /tmp has at least this much free space
+min_free_tmp_bytes = 2 * 1024 ** 3
+
+# Answer thumbnail existence checks from one listing of the destination bucket instead of HEAD requests
+use_thumbnail_index = True
+
+# Keep thumbnails in memory (decoder -> put_object) instead of writing them to /tmp before uploading
+in_memory_thumbnails = True
+
+# Frame decoder: 'pyav' decodes in-process, 'ffmpeg' runs the binary, 'auto' uses PyAV when it, Pillow and
+# NumPy are installed (the Lambda layer must ship them), FFmpeg otherwise
+decode_backend_name = 'auto'
+
+# With PyAV, decode once at the largest size and derive the smaller sizes from it with Pillow
+# (FFmpeg scales every size itself in one split/scale run)
+downscale_from_largest = True
+
+# Use the best keyframe (not black, flat or blurry) within selection_window seconds of each time frame
+select_best_frames = True
+selection_window = 15
+
+# Duration and keyframe index of every source version (ETag) probed in this run, used to seek with FFmpeg
+probe_cache = video_probe.ProbeCache(ffprobe_path=ffprobe_path)
+
+# Keys of the thumbnails already in the destination bucket, filled by load_thumbnail_index()
+existing_thumbnails = None
+
+# Function to list the destination bucket once and index the thumbnails that already exist
+def load_thumbnail_index(bucket_name, prefixes=None):
+    global existing_thumbnails
+    thumbnail_names = {f'{name}.{format}' for width, height, name in sizes}
+    existing_thumbnails = s3_listing.index_keys(s3, bucket_name, thumbnail_names, prefixes)
+    print(f'Indexed {len(existing_thumbnails)} existing thumbnails in {bucket_name}')
+    return existing_thumbnails
+
 # Function to check if a thumbnail already exists in the destination bucket
 def thumbnail_exists(bucket_name, thumbnail_key):
+    if existing_thumbnails is not None and bucket_name == destination_bucket_name:
+        return thumbnail_key in existing_thumbnails
     try:
         s3.head_object(Bucket=bucket_name, Key=thumbnail_key)
         return True
     except s3.exceptions.ClientError:
         return False
 
-# Function to create a thumbnail from the video
-def create_thumbnail(video_path, frame, frame_thumbnail, width, height):
-    ffmpeg_command = [
-        ffmpeg_path, '-i', video_path, '-ss', frame, '-vframes', '1', 
-        '-vf', f'scale={width}:{height}', f'{frame_thumbnail}.{format}'
-    ]
-    subprocess.run(ffmpeg_command, check=True)
-
 # Function to upload a thumbnail to the destination bucket
 def s3_upload(file_key, bucket_name, image_file):
     print(f'Uploading file {image_file} to bucket {bucket_name} at path {file_key}')
@@ -52,53 +95,120 @@ def s3_upload(file_key, bucket_name, image_file):
             Body=f
         )
 
+# Function to upload a thumbnail held in memory to the destination bucket
+def s3_upload_bytes(file_key, bucket_name, image):
+    print(f'Uploading {len(image)} bytes to bucket {bucket_name} at path {file_key}')
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=file_key,
+        Body=image
+    )
+
+# Download stage: skips videos whose thumbnails all exist, otherwise fetches the video
+def download_video(video_key):
+    root_dir = os.path.dirname(os.path.dirname(video_key))  # Adjusted for directory structure
+    missing_sizes = [
+        (width, height, name) for width, height, name in sizes
+        if not thumbnail_exists(destination_bucket_name, f'{root_dir}/{name}.{format}')
+    ]
+
+    if not missing_sizes:
+        print(f'[{datetime.now()}] All thumbnails for {video_key} already exist, skipping download and generation.')
+        return None
+
+    # Per-job scratch directory so concurrent jobs never share file names, even for videos with the
+    # same file name under different prefixes
+    output_dir = tempfile.mkdtemp(prefix=f'{os.path.splitext(os.path.basename(video_key))[0]}-', dir='/tmp')
+    job = {
+        'video_key': video_key,
+        'root_dir': root_dir,
+        'output_dir': output_dir,
+        'local_video_path': os.path.join(output_dir, os.path.basename(video_key)),
+        'missing_sizes': missing_sizes,
+        'thumbnails': [],
+        'images': []
+    }
+
+    # Log message before downloading the next video
+    print(f'[{datetime.now()}] Starting download of video {video_key} from {source_bucket_name}...')
+
+    # Download only the parts of the video needed for the rendered time frame
+    try:
+        head = s3.head_object(Bucket=source_bucket_name, Key=video_key)
+        job['etag'] = head['ETag']
+        margin = selection_window + SEEK_MARGIN if select_best_frames else SEEK_MARGIN
+        fetch_video(s3, source_bucket_name, video_key, job['local_video_path'], time_frames[:1], margin, object_size=head['ContentLength'])
+    except Exception:
+        cleanup_job(job)
+        raise
+    print(f'[{datetime.now()}] Finished downloading video {video_key}.')
+    return job
+
+# Render stage: decodes the frame once and scales it to every missing size
+def render_thumbnails(job):
+    print(f'[{datetime.now()}] Starting thumbnail generation for video {job["video_key"]}...')
+    backend = decode_backend.get_backend(decode_backend_name, ffmpeg_path)
+    pending_sizes = job['missing_sizes']
+    # FFmpeg needs the duration and keyframes up front to clamp and seek, PyAV reads them itself
+    probe = None
+    if backend.name == 'ffmpeg':
+        probe = probe_cache.get(job['local_video_path'], source_bucket_name, job['video_key'], job['etag'])
+    with backend.open(job['local_video_path'], probe) as video:
+        # Thumbnail keys do not name the frame, see time_frames
+        frame = time_frames[0]
+        if select_best_frames:
+            frame = frame_selection.select_frame(video, frame, selection_window)
+        if backend.name == 'pyav':
+            # Decode once through PyAV, then scale and encode each size with Pillow
+            thumbnails = decode_backend.render_thumbnails(video, frame, pending_sizes, format, downscale_from_largest)
+        else:
+            # Decode once and let FFmpeg scale and encode every size, each image written to its own pipe
+            thumbnails = video.encode_thumbnails(parse_timestamp(frame), pending_sizes, format)
+    for name, image in thumbnails:
+        if in_memory_thumbnails:
+            job['images'].append((f'{job["root_dir"]}/{name}.{format}', image))
+        else:
+            frame_thumbnail = os.path.join(job['output_dir'], f'{name}.{format}')
+            with open(frame_thumbnail, 'wb') as f:
+                f.write(image)
+            job['thumbnails'].append((f'{job["root_dir"]}/{name}.{format}', frame_thumbnail))
+
+    # The source video is no longer needed once the thumbnails exist
+    os.remove(job['local_video_path'])
+    return job
+
+# Upload stage: sends the generated thumbnails to the destination bucket
+def upload_thumbnails(job):
+    for thumbnail_key, image_file in job['thumbnails']:
+        s3_upload(thumbnail_key, destination_bucket_name, image_file)
+        if existing_thumbnails is not None:
+            existing_thumbnails.add(thumbnail_key)
+    for thumbnail_key, image in job['images']:
+        s3_upload_bytes(thumbnail_key, destination_bucket_name, image)
+        if existing_thumbnails is not None:
+            existing_thumbnails.add(thumbnail_key)
+    print(f'[{datetime.now()}] Finished processing video {job["video_key"]}.\n')
+
+# Removes the per-video scratch directory, whether or not the job succeeded
+def cleanup_job(job):
+    shutil.rmtree(job['output_dir'], ignore_errors=True)
+
 # Main function to process videos from a list of keys
 def process_videos(video_keys):
-    for video_key in video_keys:
-        print(f'[{datetime.now()}] Processing {video_key}...')
-        video_filename = os.path.splitext(os.path.basename(video_key))[0]
-        root_dir = os.path.dirname(os.path.dirname(video_key))  # Adjusted for directory structure
-        output_dir = '/tmp'
-
-        all_thumbnails_exist = True
-        for frame in time_frames:
-            for width, height, name in sizes:
-                thumbnail_key = f'{root_dir}/{name}.{format}'
-                if not thumbnail_exists(destination_bucket_name, thumbnail_key):
-                    all_thumbnails_exist = False
-                    break
-            if not all_thumbnails_exist:
-                break
-
-        if all_thumbnails_exist:
-            print(f'[{datetime.now()}] All thumbnails for {video_key} already exist, skipping download and generation.')
-            continue
-
-        # Log message before downloading the next video
-        print(f'[{datetime.now()}] Starting download of video {video_key} from {source_bucket_name}...')
-
-        local_video_path = f'/tmp/{os.path.basename(video_key)}'
-
-        # Download the video from the source bucket
-        s3.download_file(source_bucket_name, video_key, local_video_path)
-        print(f'[{datetime.now()}] Finished downloading video {video_key}.')
-
-        # Log message before starting thumbnail generation
-        print(f'[{datetime.now()}] Starting thumbnail generation for video {video_key}...')
-
-        for frame in time_frames:
-            for width, height, name in sizes:
-                frame_thumbnail = os.path.join(output_dir, f'{name}')
-                thumbnail_key = f'{root_dir}/{name}.{format}'
-
-                if not thumbnail_exists(destination_bucket_name, thumbnail_key):
-                    create_thumbnail(local_video_path, frame, frame_thumbnail, width, height)
-                    s3_upload(thumbnail_key, destination_bucket_name, f'{frame_thumbnail}.{format}')
-                    os.remove(f'{frame_thumbnail}.{format}')  # Remove the generated thumbnail after upload
-
-        # Remove the local video file after processing
-        os.remove(local_video_path)
-        print(f'[{datetime.now()}] Finished processing video {video_key}.\n')
+    if use_thumbnail_index:
+        # List only the productions (first two key levels) the videos belong to
+        production_prefixes = sorted({'/'.join(video_key.split('/')[:2]) + '/' for video_key in video_keys})
+        load_thumbnail_index(destination_bucket_name, production_prefixes)
+
+    pipeline = ThumbnailPipeline(
+        download_video, render_thumbnails, upload_thumbnails, cleanup_job,
+        download_workers=download_workers,
+        render_workers=render_workers,
+        upload_workers=upload_workers,
+        tmp_dir='/tmp',
+        min_free_bytes=min_free_tmp_bytes
+    )
+    return pipeline.run(video_keys)
 
 if __name__ == '__main__':
     # List of video keys to process
@@ -7,11 +7,17 @@ It performs the following steps:
 2. Initiates label detection analysis on the video using AWS Rekognition.
 3. Monitors the status of the job until it completes.
 4. Extracts key frames where labels of interest are detected.
-5. Uses FFmpeg to extract and save these key frames as PNG images locally.
+5. Uses FFmpeg to extract and save these key frames as PNG images locally, in a single decode
+   pass for all of them (`save_frames_locally`).
+
+With key_frame_engine = 'local', steps 2 to 4 are replaced by `detect_key_frames`, which finds
+scene changes with FFmpeg's scene score in one decode pass on the local copy of the video,
+without calling Rekognition.
 
 Dependencies:
 - boto3: AWS SDK for Python
 - FFmpeg: Multimedia framework for handling video, audio, and other multimedia files
+- numpy and Pillow: Used to write the extracted frames as PNG images in parallel
 
 Ensure you have FFmpeg installed and accessible in '/usr/local/bin/ffmpeg/ffmpeg-7.0.1-amd64-static/ffmpeg'.
 
@@ -19,9 +25,16 @@ Note: Adjust the S3 bucket name ('bucket') and video file name ('video_key') as
 """
 
 import boto3
-import time
 import subprocess
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from decode_backend import encode_image
+from rekognition_jobs import LabelDetectionOrchestrator, iter_labels, key_frames_from_labels, wait_for_job
 
 # AWS Rekognition and S3 clients
 rekognition = boto3.client('rekognition')
@@ -50,7 +63,7 @@ def start_video_analysis(bucket, video):
 def check_job_status(job_id):
     """
     Checks the status of the label detection job on AWS Rekognition.
-    Waits until the job completes.
+    Waits until the job completes, polling with an increasing delay.
     
     Args:
     - job_id (str): ID of the analysis job on AWS Rekognition.
@@ -58,18 +71,15 @@ def check_job_status(job_id):
     Returns:
     - status (dict): Dictionary containing job status information.
     """
-    status = rekognition.get_label_detection(JobId=job_id)
-    while status['JobStatus'] == 'IN_PROGRESS':
-        print("Waiting for analysis to complete...")
-        time.sleep(10)
-        status = rekognition.get_label_detection(JobId=job_id)
-    print(f'Job status: {status}')
+    status = wait_for_job(rekognition, job_id)
+    print(f'Job status: {status["JobStatus"]}')
     return status
 
 # Function to extract key frames
 def extract_key_frames(job_id):
     """
     Extracts key frames from the video where labels of interest (e.g., Person, Face, Object, Scene) are detected.
+    Every page of the results is read.
     
     Args:
     - job_id (str): ID of the analysis job on AWS Rekognition.
@@ -77,18 +87,51 @@ def extract_key_frames(job_id):
     Returns:
     - key_frames (list): List of timestamps (in milliseconds) where key frames are detected.
     """
-    results = rekognition.get_label_detection(JobId=job_id)
-    key_frames = []
-
-    if results['JobStatus'] == 'SUCCEEDED':
-        for label in results['Labels']:
-            if label['Label']['Name'] in ['Person', 'Face', 'Object', 'Scene']:  # Adjust as needed
-                timestamp = label['Timestamp']
-                key_frames.append(timestamp)
+    labels = ({'Timestamp': label['Timestamp'], 'Name': label['Label']['Name']} for label in iter_labels(rekognition, job_id))
+    key_frames = key_frames_from_labels(labels)
 
     print(f'Extracted key frames: {key_frames}')
     return key_frames
 
+# Function to detect key frames locally
+def detect_key_frames(video_path, threshold=0.3, max_frames=None, scale_width=320):
+    """
+    Detects scene changes in the video with FFmpeg's scene score in a single decode pass.
+    The frames are downscaled before scoring, which keeps the pass fast on HD sources.
+    
+    Args:
+    - video_path (str): Local path of the video file.
+    - threshold (float): Minimum scene score (0 to 1) for a frame to count as a scene change.
+    - max_frames (int): Maximum number of key frames to return, all of them when None.
+    - scale_width (int): Width the frames are downscaled to before scoring.
+    
+    Returns:
+    - key_frames (list): List of timestamps (in milliseconds) of the scene changes, ranked from
+      the strongest change to the weakest, in the same shape as extract_key_frames.
+    """
+    ffmpeg_command = [
+        'ffmpeg', '-v', 'error', '-an', '-sn', '-dn', '-i', video_path,
+        '-vf', f"scale={scale_width}:-2,select='gt(scene,{threshold})',metadata=print:file=-",
+        '-f', 'null', '-'
+    ]
+    result = subprocess.run(ffmpeg_command, capture_output=True, text=True, check=True)
+
+    # metadata=print writes a "frame:N pts:X pts_time:T" line followed by the frame's scene score
+    scenes = []
+    pts_time = None
+    for line in result.stdout.splitlines():
+        match = re.search(r'pts_time:(\S+)', line)
+        if match:
+            pts_time = float(match.group(1))
+        elif line.startswith('lavfi.scene_score=') and pts_time is not None:
+            scenes.append((float(line.split('=', 1)[1]), int(round(pts_time * 1000))))
+            pts_time = None
+
+    scenes.sort(key=lambda scene: scene[0], reverse=True)
+    key_frames = [timestamp for score, timestamp in scenes[:max_frames]]
+    print(f'Detected key frames: {key_frames}')
+    return key_frames
+
 # Function to download video from S3
 def download_video_from_s3(bucket, video_key, local_path):
     """
@@ -118,48 +161,151 @@ def save_frame_locally(video_path, timestamp):
     Returns:
     - frame_file (str): Local path where the frame image file is saved.
     """
-    # Create the ./frames directory if it doesn't exist
-    os.makedirs('./frames', exist_ok=True)
+    return save_frames_locally(video_path, [timestamp]).get(timestamp)
 
-    frame_file = f'./frames/frame_{timestamp}.png'  # Define the output file path
+# Function to read one PPM image from an FFmpeg pipe
+def read_ppm_frame(pipe):
+    """
+    Reads one binary PPM image, as written by FFmpeg's ppm encoder, from a pipe.
+    
+    Returns:
+    - frame (ndarray): RGB image, or None at the end of the stream.
+    """
+    magic = pipe.readline()
+    if not magic:
+        return None
+    width, height = map(int, pipe.readline().split())
+    pipe.readline()  # Max value, always 255
+    data = pipe.read(width * height * 3)
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+
+# Function to save many frames locally in one pass
+def save_frames_locally(video_path, timestamps, output_dir='./frames', workers=None):
+    """
+    Extracts and saves the frames at all the timestamps in a single FFmpeg decode pass.
+    
+    The millisecond timestamps are converted to presentation times once and FFmpeg seeks to the
+    earliest one, then selects the first frame at or after each of them while decoding forward.
+    The selected frames are streamed back as raw images and written as PNG files by a pool of
+    threads while FFmpeg keeps decoding.
+    
+    Args:
+    - video_path (str): Local path of the video file.
+    - timestamps (list): Timestamps (in milliseconds) of the key frames to extract.
+    - output_dir (str): Directory where the PNG files are written.
+    - workers (int): Threads writing PNG files, defaults to the number of cores.
+    
+    Returns:
+    - frame_files (dict): Local path of the PNG file of each timestamp that could be extracted.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pending = sorted(set(timestamps))
+    if not pending:
+        return {}
 
-    # FFmpeg command to extract the frame
+    # First frame at or after each presentation time (prev_t is NaN for the first decoded frame)
+    seconds = [timestamp / 1000 for timestamp in pending]
+    terms = '+'.join(f'gte(t,{second})*(lt(prev_t,{second})+isnan(prev_t))' for second in seconds)
     ffmpeg_command = [
-        'ffmpeg', '-i', video_path, '-vf', f'select=eq(n\,{timestamp})', '-vsync', 'vfr', frame_file
+        'ffmpeg', '-hide_banner', '-ss', str(seconds[0]), '-copyts', '-an', '-sn', '-dn', '-i', video_path,
+        '-vf', f"select='gt({terms},0)',showinfo", '-fps_mode', 'passthrough',
+        '-f', 'image2pipe', '-c:v', 'ppm', 'pipe:1'
     ]
+    process = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    # Execute the FFmpeg command
-    result = subprocess.run(ffmpeg_command, capture_output=True, text=True)
-    print(f'FFmpeg command output: {result.stdout}')
-    print(f'FFmpeg command error: {result.stderr}')
+    # showinfo logs the time of every selected frame on stderr before the frame reaches stdout
+    frame_times = []
+    frame_time_ready = threading.Condition()
+    stderr_lines = []
 
-    # Check if the file was generated
-    if not os.path.exists(frame_file):
-        print(f'Error: Frame {timestamp} was not generated.')
-        return
+    def read_stderr():
+        for line in process.stderr:
+            line = line.decode(errors='replace')
+            match = re.search(r'pts_time:\s*(-?[\d.]+)', line)
+            with frame_time_ready:
+                if match:
+                    frame_times.append(float(match.group(1)))
+                else:
+                    stderr_lines.append(line)
+                frame_time_ready.notify_all()
+        with frame_time_ready:
+            frame_times.append(None)
+            frame_time_ready.notify_all()
+
+    stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+    stderr_reader.start()
+
+    def write_frame(frame, frame_file):
+        with open(frame_file, 'wb') as f:
+            f.write(encode_image(frame, format='png'))
+        return frame_file
 
-    print(f'Saved frame {timestamp} locally at {frame_file}')
-    return frame_file
+    frame_files = {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {}
+        index = 0
+        while pending:
+            frame = read_ppm_frame(process.stdout)
+            if frame is None:
+                break
+            with frame_time_ready:
+                frame_time_ready.wait_for(lambda: len(frame_times) > index)
+                frame_time = frame_times[index]
+            index += 1
+            if frame_time is None:
+                break
+
+            # Every timestamp up to this frame's time resolves to it
+            while pending and pending[0] / 1000 <= frame_time + 0.0005:
+                timestamp = pending.pop(0)
+                frame_file = os.path.join(output_dir, f'frame_{timestamp}.png')
+                futures[timestamp] = pool.submit(write_frame, frame, frame_file)
+
+        process.stdout.close()
+        process.wait()
+        stderr_reader.join()
+        for timestamp, future in futures.items():
+            frame_files[timestamp] = future.result()
+
+    for timestamp in pending:
+        print(f'Error: Frame {timestamp} was not generated.')
+    if process.returncode != 0 and stderr_lines:
+        print(f'FFmpeg command error: {"".join(stderr_lines)}')
+    print(f'Saved {len(frame_files)} frames locally in {output_dir}')
+    return frame_files
 
 # S3 parameters
 bucket = 'thumbnail-generator-poc'
-video_key = 'file_example_MP4_1920_18MG.mp4'  # Adjust as per your setup
-local_video_path = '/tmp/video.mp4'  # Temporary path to save the video locally
+video_keys = ['file_example_MP4_1920_18MG.mp4']  # Adjust as per your setup
+local_dir = '/tmp'  # Temporary directory to save the videos locally
+frames_dir = './frames'  # Frames of each video are saved in a subdirectory named after it
 
-# Download the video from S3
-download_video_from_s3(bucket, video_key, local_video_path)
+# Key frame engine: 'local' detects scene changes with FFmpeg, 'rekognition' runs a label detection job
+key_frame_engine = 'local'
+scene_threshold = 0.3  # Minimum scene score of a key frame (local engine)
+max_key_frames = 20  # Strongest scene changes kept (local engine)
+rekognition_concurrency = 5  # Label detection jobs running at the same time (rekognition engine)
+rekognition_cache_dir = 'rekognition_cache'  # Labels cached per video ETag, repeat runs never reanalyze
 
-# Start video analysis
-job_id = start_video_analysis(bucket, video_key)
+if __name__ == '__main__':
+    if key_frame_engine == 'rekognition':
+        # Analyze every video with Rekognition, a few jobs at a time
+        orchestrator = LabelDetectionOrchestrator(rekognition, s3, bucket, rekognition_concurrency, rekognition_cache_dir)
+        key_frames_by_video = orchestrator.run(video_keys)
+    else:
+        key_frames_by_video = dict.fromkeys(video_keys)
 
-# Check job status
-status = check_job_status(job_id)
+    for video_key, key_frames in key_frames_by_video.items():
+        # Download the video from S3
+        local_video_path = os.path.join(local_dir, os.path.basename(video_key))
+        download_video_from_s3(bucket, video_key, local_video_path)
 
-# Extract key frames
-key_frames = extract_key_frames(job_id)
+        if key_frames is None:
+            # Detect scene changes on the local copy
+            key_frames = detect_key_frames(local_video_path, scene_threshold, max_key_frames)
 
-# Save key frames locally
-for timestamp in key_frames:
-    save_frame_locally(local_video_path, timestamp)
+        # Save key frames locally in one decode pass
+        save_frames_locally(local_video_path, key_frames, os.path.join(frames_dir, os.path.splitext(os.path.basename(video_key))[0]))
+        os.remove(local_video_path)
 
-print("Key frames saved locally.")
+    print("Key frames saved locally.")
@@ -1,7 +1,14 @@
 import os
 import boto3
-import subprocess
+import decode_backend
+import video_probe
 import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from s3_range_fetch import parse_timestamp
+from tmp_cache import SourceVideoCache
 
 # Inicializa o cliente S3
 s3 = boto3.client('s3')
@@ -10,6 +17,15 @@ s3_resource = boto3.resource('s3')
 # Defina o bucket de logs como uma variável fixa
 LOG_BUCKET = 'thumbnail-on-demand'
 
+# Os logs são gravados no S3 quando acumulam esta quantidade de entradas ou bytes, ou após este intervalo
+LOG_FLUSH_ENTRIES = 50
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_SECONDS = 2.0
+
+# Manifesto dos thumbnails já gerados, um objeto JSON por vídeo de origem (None desativa o cache de resultados)
+MANIFEST_BUCKET = LOG_BUCKET
+MANIFEST_PREFIX = 'manifests'
+
 # Configurações de tamanho para thumbnails
 SIZES = [
     (260, 163, 'landscape-regular-thumb-mobile'),
@@ -20,8 +36,32 @@ SIZES = [
 # Formato de saída das thumbnails
 FORMAT = 'jpg'
 
+# Decodificador: 'pyav' decodifica no próprio processo, 'ffmpeg' executa o binário, 'auto' usa PyAV se ele, o Pillow
+# e o NumPy estiverem instalados (a layer da Lambda precisa incluí-los), senão o FFmpeg
+DECODE_BACKEND = 'auto'
+FFMPEG_PATH = 'ffmpeg'
+FFPROBE_PATH = 'ffprobe'
+
+# Com o PyAV, decodifica cada frame uma vez no maior tamanho e deriva os menores a partir dele com o Pillow
+# (o FFmpeg redimensiona todos os tamanhos numa única execução split/scale)
+DOWNSCALE_FROM_LARGEST = True
+
+# Time frames renderizados por execução do FFmpeg; cada um é uma entrada com seu próprio decodificador,
+# então o limite controla a memória usada por uma execução
+FFMPEG_FRAMES_PER_RUN = 10
+
+# Uploads simultâneos dos thumbnails
+UPLOAD_WORKERS = 8
+
+# Vídeos de origem mantidos em /tmp entre invocações quentes, por bucket/key/ETag, até o tamanho do /tmp
+# menos o espaço que uma renderização precisa (ou SOURCE_CACHE_MAX_BYTES bytes)
+SOURCE_CACHE = SourceVideoCache('/tmp/source-cache')
+
+# Duração e keyframes de cada versão (ETag) dos vídeos de origem, usados para as buscas do FFmpeg
+PROBE_CACHE = video_probe.ProbeCache('/tmp/probe-cache', FFPROBE_PATH)
+
 def cleanup_tmp():
-    """Remove todos os arquivos do diretório /tmp"""
+    """Remove os arquivos soltos do diretório /tmp; o cache de vídeos (subdiretório) é preservado"""
     try:
         for filename in os.listdir('/tmp'):
             file_path = os.path.join('/tmp', filename)
@@ -30,132 +70,248 @@ def cleanup_tmp():
     except Exception as e:
         print(f'Erro ao limpar o diretório /tmp: {str(e)}')
 
-def write_logs_to_s3(logs, job_id):
-    """Escreve os logs no bucket de logs no S3"""
-    try:
-        s3.put_object(
-            Bucket=LOG_BUCKET,
-            Key=f'logs/{job_id}.json',
-            Body=json.dumps(logs),
-            ContentType='application/json'
-        )
-    except Exception as e:
-        print(f'Erro ao escrever logs no S3: {str(e)}')
+class S3LogSink:
+    """
+    Acumula os logs em memória e grava no S3 em segundo plano, em partes JSON Lines
+    (logs/{job_id}/00000.jsonl, 00001.jsonl, ...) com apenas as entradas novas de cada gravação.
+    Uma gravação acontece quando o buffer passa de LOG_FLUSH_ENTRIES entradas ou LOG_FLUSH_BYTES
+    bytes, ou a cada LOG_FLUSH_SECONDS; close() grava o restante antes de o handler retornar.
+    """
+
+    def __init__(self, bucket, job_id):
+        self.bucket = bucket
+        self.job_id = job_id
+        self.entries = []  # Todas as mensagens, devolvidas na resposta
+        self.pending = []
+        self.pending_bytes = 0
+        self.part = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
 
-def download_video_segment(bucket_name, video_key, start_time, duration, local_video_path, logs, job_id):
-    """Baixa um segmento do vídeo do S3 usando FFmpeg"""
+    def append(self, message):
+        line = json.dumps({'timestamp': datetime.now(timezone.utc).isoformat(), 'message': message})
+        with self.condition:
+            self.entries.append(message)
+            self.pending.append(line)
+            self.pending_bytes += len(line) + 1
+            if self._full():
+                self.condition.notify()
+
+    def _full(self):
+        return len(self.pending) >= LOG_FLUSH_ENTRIES or self.pending_bytes >= LOG_FLUSH_BYTES
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self._full(), timeout=LOG_FLUSH_SECONDS)
+                lines, self.pending, self.pending_bytes = self.pending, [], 0
+                closed = self.closed
+            if lines:
+                self._write(lines)
+            if closed:
+                return
+
+    def _write(self, lines):
+        """Escreve uma parte JSON Lines no bucket de logs no S3"""
+        try:
+            s3.put_object(
+                Bucket=self.bucket,
+                Key=f'logs/{self.job_id}/{self.part:05d}.jsonl',
+                Body=('\n'.join(lines) + '\n').encode(),
+                ContentType='application/x-ndjson'
+            )
+            self.part += 1
+        except Exception as e:
+            print(f'Erro ao escrever logs no S3: {str(e)}')
+
+    def close(self):
+        """Grava os logs pendentes e encerra a thread de gravação"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+def download_video_segment(bucket_name, video_key, time_frames, logs, job_id, head=None):
+    """
+    Baixa do S3 apenas os trechos do vídeo necessários para os time frames.
+    Retorna um context manager com o caminho local do vídeo; os trechos já baixados por
+    invocações anteriores são reaproveitados do cache em /tmp.
+    """
+    log_message = f'Downloading video segments: {video_key} from the S3 bucket: {bucket_name} for time frames {time_frames}'
+    logs.append(log_message)
+
+    # Baixa o cabeçalho e os GOPs que cobrem os time frames com ranged GETs, se ainda não estiverem no cache
+    return SOURCE_CACHE.open(s3, bucket_name, video_key, time_frames, head=head)
+
+def s3_upload(file_key, bucket_name, image, logs, job_id):
+    """Faz upload de um thumbnail gerado em memória para o S3 e retorna o ETag do objeto gravado"""
     try:
-        log_message = f'Downloading video segment: {video_key} from the S3 bucket: {bucket_name} starting at {start_time} for {duration} seconds'
-        logs.append(log_message)
-        write_logs_to_s3(logs, job_id)
+        logs.append(f'Uploading thumbnail to S3: {file_key}')
 
-        # Baixar o vídeo do S3 para o diretório EFS
-        s3.download_file(bucket_name, video_key, local_video_path)
-        
-        # Comando FFmpeg para baixar o segmento do vídeo
-        ffmpeg_command = [
-            'ffmpeg', '-i', local_video_path, '-ss', str(start_time), 
-            '-t', str(duration), '-c', 'copy', local_video_path
-        ]
-        subprocess.run(ffmpeg_command, check=True)
-        if not os.path.exists(local_video_path):
-            raise FileNotFoundError(f'File {local_video_path} does not exist after download.')
-    except subprocess.CalledProcessError as e:
-        logs.append(f'FFmpeg error: {str(e)}')
-        write_logs_to_s3(logs, job_id)
-        raise
+        response = s3.put_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Body=image,
+            ContentType='image/jpeg'
+        )
+        return response.get('ETag')
     except Exception as e:
-        logs.append(f'Error downloading video segment from S3: {str(e)}')
-        write_logs_to_s3(logs, job_id)
+        logs.append(f'Error uploading thumbnail to S3: {str(e)}')
         raise
 
-def create_thumbnail(video_path, frame, frame_thumbnail, width, height, logs, job_id):
-    """Cria thumbnails a partir de um frame específico"""
+def thumbnail_key(root_dir, frame, name, time_frames):
+    """
+    Chave de destino de um thumbnail. Com um único time frame mantém o nome de sempre; com vários,
+    o time frame (em milissegundos) entra no nome para que um não sobrescreva o outro.
+    """
+    if len(time_frames) == 1:
+        return f'{root_dir}/{name}.{FORMAT}'
+    return f'{root_dir}/{name}-{round(parse_timestamp(frame) * 1000)}ms.{FORMAT}'
+
+def manifest_key(source_bucket_name, video_key):
+    """Chave do manifesto de um vídeo de origem"""
+    digest = hashlib.sha256(f'{source_bucket_name}/{video_key}'.encode()).hexdigest()
+    return f'{MANIFEST_PREFIX}/{digest}.json'
+
+def result_key(etag, frame, width, height, destination_bucket_name, file_key):
+    """
+    Identifica um thumbnail renderizado: ETag da origem + time frame + tamanho + formato + destino.
+    A chave de destino entra porque o mesmo time frame tem nomes diferentes em pedidos de um ou de vários frames.
+    """
+    return f'{etag}|{parse_timestamp(frame):.3f}|{width}x{height}|{FORMAT}|{destination_bucket_name}/{file_key}'
+
+def load_manifest(source_bucket_name, video_key):
+    """Lê o manifesto de um vídeo; retorna um dicionário vazio se ele ainda não existir"""
     try:
-        logs.append(f'Generating thumbnail at {frame} with size {width}x{height}')
-        write_logs_to_s3(logs, job_id)
-        
-        ffmpeg_command = [
-            'ffmpeg', '-i', video_path, '-ss', frame, '-vframes', '1', 
-            '-vf', f'scale={width}:{height}', frame_thumbnail
-        ]
-        subprocess.run(ffmpeg_command, check=True)
-        if not os.path.exists(frame_thumbnail):
-            raise Exception(f'Thumbnail {frame_thumbnail} was not created successfully.')
-    except subprocess.CalledProcessError as e:
-        logs.append(f'FFmpeg error: {str(e)}')
-        write_logs_to_s3(logs, job_id)
-        raise
-    except Exception as e:
-        logs.append(f'Error creating thumbnail: {str(e)}')
-        write_logs_to_s3(logs, job_id)
-        raise
+        response = s3.get_object(Bucket=MANIFEST_BUCKET, Key=manifest_key(source_bucket_name, video_key))
+        return json.loads(response['Body'].read())
+    except Exception:
+        return {}
 
-def s3_upload(file_key, bucket_name, image_file, logs, job_id):
-    """Faz upload dos thumbnails gerados para o S3"""
+def save_manifest(source_bucket_name, video_key, manifest):
+    """
+    Grava o manifesto de um vídeo. Duas requisições simultâneas podem sobrescrever as entradas
+    uma da outra; isso só causa uma nova renderização, pois o manifesto é apenas um cache.
+    """
     try:
-        logs.append(f'Uploading thumbnail to S3: {file_key}')
-        write_logs_to_s3(logs, job_id)
-        
-        with open(image_file, 'rb') as f:
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=file_key,
-                Body=f,
-                ContentType='image/jpeg'
-            )
+        s3.put_object(
+            Bucket=MANIFEST_BUCKET,
+            Key=manifest_key(source_bucket_name, video_key),
+            Body=json.dumps(manifest),
+            ContentType='application/json'
+        )
     except Exception as e:
-        logs.append(f'Error uploading thumbnail to S3: {str(e)}')
-        write_logs_to_s3(logs, job_id)
-        raise
+        print(f'Erro ao gravar o manifesto no S3: {str(e)}')
+
+def forget_overwritten(manifest, destination_bucket_name, file_key):
+    """
+    Remove do manifesto as entradas que apontam para um arquivo de destino prestes a ser sobrescrito
+    (por exemplo name.jpg, gravado por pedidos de um único time frame diferentes). Assim as entradas
+    que restam continuam válidas e um acerto no manifesto não precisa conferir o S3.
+    """
+    for key, entry in list(manifest.items()):
+        if entry['bucket'] == destination_bucket_name and entry['key'] == file_key:
+            del manifest[key]
+
+def render_frames(backend, video, frames):
+    """
+    Renderiza todos os tamanhos dos time frames (já em ordem) no vídeo aberto e gera (frame, {nome: imagem}).
+    O PyAV decodifica cada frame uma vez e o Pillow redimensiona; o FFmpeg renderiza até FFMPEG_FRAMES_PER_RUN
+    time frames numa única execução, com uma busca por time frame.
+    """
+    if backend.name == 'pyav':
+        # Busca em ordem, para que cada uma avance no mesmo vídeo aberto
+        for frame in frames:
+            yield frame, dict(decode_backend.render_thumbnails(video, frame, SIZES, FORMAT, DOWNSCALE_FROM_LARGEST))
+        return
+    for start in range(0, len(frames), FFMPEG_FRAMES_PER_RUN):
+        batch = frames[start:start + FFMPEG_FRAMES_PER_RUN]
+        for frame, images in zip(batch, video.encode_frames([parse_timestamp(frame) for frame in batch], SIZES, FORMAT)):
+            yield frame, dict(images)
 
 def process_video(source_bucket_name, video_key, destination_bucket_name, time_frames, logs, job_id):
-    """Processa o vídeo e gera thumbnails"""
-    local_video_path = f'/tmp/{os.path.basename(video_key)}'  # Usando o EFS em vez de /tmp
-    output_dir = '/tmp'  # Usando o EFS
+    """
+    Processa o vídeo e gera thumbnails. Todos os time frames pendentes são decodificados em ordem
+    numa única abertura do vídeo (PyAV) ou numa única execução do FFmpeg, e os uploads acontecem
+    em paralelo com a decodificação.
+    """
     thumbnail_urls = []
-    
-    # Defina o tempo inicial e a duração do segmento do vídeo que você quer baixar
-    START_TIME = 0  # Por exemplo, inicie do início
-    DURATION = 10  # Duração de 10 segundos
 
     try:
         logs.append(f'Processing video: {video_key}')
-        write_logs_to_s3(logs, job_id)
-        
-        # Faz download de um segmento do vídeo
-        download_video_segment(source_bucket_name, video_key, START_TIME, DURATION, local_video_path, logs, job_id)
         
         # Divide o caminho do arquivo para formar o caminho de destino dos thumbnails
         key_parts = video_key.split('/')
         root_dir = '/'.join(key_parts[:-2])  # Exemplo: 1012000000/1012010000/1012010001
         video_filename = os.path.splitext(key_parts[-1])[0]
 
-        # Para cada frame de tempo e tamanho, gera os thumbnails
+        # Um único HEAD serve ao manifesto, ao cache de /tmp e ao cache de probes; o manifesto é lido ao mesmo tempo
+        with ThreadPoolExecutor(max_workers=2) as lookups:
+            manifest_future = lookups.submit(load_manifest, source_bucket_name, video_key) if MANIFEST_BUCKET else None
+            source_head = s3.head_object(Bucket=source_bucket_name, Key=video_key)
+            manifest = manifest_future.result() if manifest_future else {}
+        source_etag = source_head['ETag']
+
+        # Consulta o manifesto: thumbnails já gerados para esta versão do vídeo não são refeitos. As entradas
+        # são confiáveis sem HEAD, pois cada sobrescrita de um destino remove as entradas antigas dele
+        cached = {}
         for frame in time_frames:
             for width, height, name in SIZES:
-                # Mude o caminho do thumbnail para usar o nome correto
-                frame_thumbnail = os.path.join(output_dir, f'{name}.{FORMAT}')
-                
-                # Gera a thumbnail
-                create_thumbnail(local_video_path, frame, frame_thumbnail, width, height, logs, job_id)
+                file_key = thumbnail_key(root_dir, frame, name, time_frames)
+                entry = manifest.get(result_key(source_etag, frame, width, height, destination_bucket_name, file_key))
+                if entry:
+                    cached[(frame, name)] = f's3://{entry["bucket"]}/{entry["key"]}'
+        pending_frames = [frame for frame in time_frames if any((frame, name) not in cached for _, _, name in SIZES)]
+
+        if not pending_frames:
+            logs.append(f'All thumbnails for {video_key} at {time_frames} found in the manifest')
+        else:
+            if cached:
+                logs.append(f'{len(cached)} thumbnails found in the manifest, rendering time frames {pending_frames}')
 
-                # Ajusta o file_key para que as imagens sejam armazenadas no diretório do vídeo
-                file_key = f'{root_dir}/{name}.{FORMAT}'  # Ajusta para o nome desejado
-                s3_upload(file_key, destination_bucket_name, frame_thumbnail, logs, job_id)
+            # Faz download apenas dos segmentos do vídeo que cobrem os time frames (ou usa o cache)
+            with download_video_segment(source_bucket_name, video_key, pending_frames, logs, job_id, source_head) as local_video_path, \
+                    ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploads:
+                backend = decode_backend.get_backend(DECODE_BACKEND, FFMPEG_PATH)
+                logs.append(f'Rendering {len(pending_frames)} time frames with the {backend.name} backend')
+                # O FFmpeg precisa da duração e dos keyframes antes de buscar; o PyAV os lê sozinho
+                probe = PROBE_CACHE.get(local_video_path, source_bucket_name, video_key, source_etag) if backend.name == 'ffmpeg' else None
+                futures = []
+                with backend.open(local_video_path, probe) as video:
+                    for frame, images in render_frames(backend, video, sorted(pending_frames, key=parse_timestamp)):
+                        pending_sizes = [size for size in SIZES if (frame, size[2]) not in cached]
+                        for width, height, name in pending_sizes:
+                            # Ajusta o file_key para que as imagens sejam armazenadas no diretório do vídeo
+                            file_key = thumbnail_key(root_dir, frame, name, time_frames)
+                            future = uploads.submit(s3_upload, file_key, destination_bucket_name, images[name], logs, job_id)
+                            futures.append((frame, width, height, name, file_key, future))
 
-                thumbnail_urls.append(f's3://{destination_bucket_name}/{file_key}')
+                for frame, width, height, name, file_key, future in futures:
+                    etag = future.result()
+                    cached[(frame, name)] = f's3://{destination_bucket_name}/{file_key}'
+                    if MANIFEST_BUCKET:
+                        forget_overwritten(manifest, destination_bucket_name, file_key)
+                        if etag:
+                            manifest[result_key(source_etag, frame, width, height, destination_bucket_name, file_key)] = {
+                                'bucket': destination_bucket_name, 'key': file_key, 'etag': etag
+                            }
+
+            if MANIFEST_BUCKET:
+                save_manifest(source_bucket_name, video_key, manifest)
+
+        thumbnail_urls = [cached[(frame, name)] for frame in time_frames for _, _, name in SIZES]
 
     except Exception as e:
         logs.append(f'Error during video processing: {str(e)}')
-        write_logs_to_s3(logs, job_id)
         raise
     
     return thumbnail_urls
 
 def lambda_handler(event, context):
     """AWS Lambda function handler."""
-    logs = []  # Inicializar os logs
+    logs = S3LogSink(LOG_BUCKET, context.aws_request_id)  # Inicializar os logs, gravados no S3 em segundo plano
     try:
 
         cleanup_tmp()
@@ -169,8 +325,6 @@ def lambda_handler(event, context):
         job_id = context.aws_request_id
         logs.append(f'Received request: {json.dumps(body)}')
 
-        write_logs_to_s3(logs, job_id)
-
         thumbnail_urls = process_video(source_bucket_name, video_key, destination_bucket_name, time_frames, logs, job_id)
 
         # Construir o link para os logs do CloudWatch
@@ -180,7 +334,7 @@ def lambda_handler(event, context):
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Thumbnail generation process completed!',
-                'logs': logs,
+                'logs': logs.entries,
                 'thumbnails': thumbnail_urls,
                 'log_url': log_url  # Adicionando o link para o CloudWatch
             })
@@ -188,7 +342,6 @@ def lambda_handler(event, context):
     except Exception as e:
         error_message = f'Error processing request: {str(e)}'
         logs.append(error_message)
-        write_logs_to_s3(logs, context.aws_request_id)
 
         # Construir o link para os logs do CloudWatch em caso de erro
         log_url = f'https://console.aws.amazon.com/cloudwatch/home?region={context.invoked_function_arn.split(":")[3]}#logsV2:log-groups/log-group:/aws/lambda/{context.function_name}/log-events/{context.aws_request_id}'
@@ -197,7 +350,10 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': json.dumps({
                 'error': error_message,
-                'logs': logs,
+                'logs': logs.entries,
                 'log_url': log_url  # Adicionando o link para o CloudWatch
             })
         }
+    finally:
+        # Grava os logs pendentes antes de o Lambda congelar o container
+        logs.close()
@@ -0,0 +1,215 @@
+"""
+Staged concurrent executor for thumbnail jobs: download -> render -> upload.
+
+Each stage has its own pool of worker threads and the stages are linked by bounded queues,
+so a slow stage applies backpressure to the ones before it. Rendering workers each drive one
+FFmpeg child process at a time, so sizing that stage to the number of cores gives a process
+pool for FFmpeg without pickling jobs across processes.
+
+Before a download starts, the download workers wait until the scratch directory has at least
+`min_free_bytes` free, which keeps `/tmp` from filling up with videos waiting to be rendered.
+The wait is logged and bounded: an item fails when the space does not come back within
+`max_disk_wait` seconds, or at once when no job is in flight that could free it.
+
+The stage callables are:
+- download(item) -> job, or None to skip the item.
+- render(job) -> job, ready to upload.
+- upload(job) -> None.
+- cleanup(job) -> None, always called once a job leaves the pipeline, even after a failure.
+"""
+
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+# Marks the end of the stream on a queue
+_STOP = object()
+
+
+class ThumbnailPipeline:
+    def __init__(self, download, render, upload, cleanup=None, download_workers=4, render_workers=None,
+                 upload_workers=8, queue_size=4, tmp_dir='/tmp', min_free_bytes=2 * 1024 ** 3, max_disk_wait=600):
+        """
+        Args:
+        - download, render, upload, cleanup (callable): Stage functions, see the module docstring.
+        - download_workers (int): Concurrent downloads.
+        - render_workers (int): Concurrent FFmpeg processes, defaults to the number of cores.
+        - upload_workers (int): Concurrent uploads.
+        - queue_size (int): Jobs allowed to wait between two stages.
+        - tmp_dir (str): Scratch directory watched for free space.
+        - min_free_bytes (int): Free space required in `tmp_dir` before starting a download.
+        - max_disk_wait (float): Seconds a download waits for that space before its item fails.
+        """
+        self.download = download
+        self.render = render
+        self.upload = upload
+        self.cleanup = cleanup
+        self.download_workers = download_workers
+        self.render_workers = render_workers or os.cpu_count() or 1
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
+        self.tmp_dir = tmp_dir
+        self.min_free_bytes = min_free_bytes
+        self.max_disk_wait = max_disk_wait
+        # Jobs between the start of their download and their cleanup, the only ones that can free space
+        self.in_flight = 0
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.summary = {'processed': 0, 'skipped': 0, 'failed': 0}
+        self.errors = {}
+
+    def stop(self):
+        """Stops taking new items; jobs already downloaded are still rendered and uploaded."""
+        self.stopping.set()
+
+    def run(self, items):
+        """
+        Runs every item through the pipeline and waits for all stages to drain.
+
+        Returns:
+        - summary (dict): Counts of processed, skipped and failed items.
+        """
+        input_queue = queue.Queue(maxsize=self.queue_size)
+        render_queue = queue.Queue(maxsize=self.queue_size)
+        upload_queue = queue.Queue(maxsize=self.queue_size)
+
+        stages = [
+            (self.download_workers, self._download_worker, input_queue, render_queue),
+            (self.render_workers, self._render_worker, render_queue, upload_queue),
+            (self.upload_workers, self._upload_worker, upload_queue, None),
+        ]
+        stage_threads = []
+        for workers, target, source, sink in stages:
+            threads = [threading.Thread(target=target, args=(source, sink), daemon=True) for _ in range(workers)]
+            for thread in threads:
+                thread.start()
+            stage_threads.append((threads, sink))
+
+        try:
+            for item in items:
+                if self.stopping.is_set():
+                    break
+                input_queue.put(item)
+        except KeyboardInterrupt:
+            print(f'[{datetime.now()}] Interrupted, finishing jobs already in progress...')
+            self.stop()
+        finally:
+            for _ in range(self.download_workers):
+                input_queue.put(_STOP)
+
+            # Close each stage once every worker of the previous stage has exited
+            for (threads, sink), next_workers in zip(stage_threads, (self.render_workers, self.upload_workers, 0)):
+                for thread in threads:
+                    thread.join()
+                for _ in range(next_workers):
+                    sink.put(_STOP)
+
+        print(f'[{datetime.now()}] Pipeline finished: {self.summary}')
+        return self.summary
+
+    def _record(self, outcome, item=None, error=None):
+        with self.lock:
+            self.summary[outcome] += 1
+            if error is not None:
+                self.errors[item] = str(error)
+
+    def _finish(self, job):
+        """Called once for every download started, whether it produced a job or not."""
+        if self.cleanup is not None and job is not None:
+            try:
+                self.cleanup(job)
+            except Exception as e:
+                print(f'Error cleaning up job: {str(e)}')
+        with self.lock:
+            self.in_flight -= 1
+
+    def _wait_for_disk(self):
+        """
+        Waits until `tmp_dir` has `min_free_bytes` free.
+
+        Returns:
+        - ready (bool): True when there is space, False when the pipeline is stopping.
+
+        Raises OSError when the space does not come back within `max_disk_wait` seconds, or as soon
+        as no job is in flight, since nothing would free it.
+        """
+        started = time.monotonic()
+        logged = None
+        while not self.stopping.is_set():
+            free = shutil.disk_usage(self.tmp_dir).free
+            if free >= self.min_free_bytes:
+                return True
+            with self.lock:
+                in_flight = self.in_flight
+            waited = time.monotonic() - started
+            if in_flight == 0 or waited >= self.max_disk_wait:
+                raise OSError(
+                    f'Only {free} bytes free in {self.tmp_dir}, {self.min_free_bytes} needed '
+                    f'(waited {waited:.0f}s, {in_flight} jobs in flight)'
+                )
+            if logged is None or time.monotonic() - logged >= 30:
+                print(f'[{datetime.now()}] Waiting for space in {self.tmp_dir}: {free} bytes free, {self.min_free_bytes} needed, {in_flight} jobs in flight...')
+                logged = time.monotonic()
+            time.sleep(1)
+        return False
+
+    def _download_worker(self, source, sink):
+        while True:
+            item = source.get()
+            if item is _STOP:
+                return
+            try:
+                if not self._wait_for_disk():
+                    continue
+            except OSError as e:
+                print(f'[{datetime.now()}] Download failed for {item}: {str(e)}')
+                self._record('failed', item, e)
+                continue
+            with self.lock:
+                self.in_flight += 1
+            job = None
+            try:
+                job = self.download(item)
+            except Exception as e:
+                print(f'[{datetime.now()}] Download failed for {item}: {str(e)}')
+                self._record('failed', item, e)
+                self._finish(job)
+                continue
+            if job is None:
+                self._record('skipped')
+                self._finish(job)
+                continue
+            sink.put((item, job))
+
+    def _render_worker(self, source, sink):
+        while True:
+            entry = source.get()
+            if entry is _STOP:
+                return
+            item, job = entry
+            try:
+                job = self.render(job)
+            except Exception as e:
+                print(f'[{datetime.now()}] Rendering failed for {item}: {str(e)}')
+                self._record('failed', item, e)
+                self._finish(job)
+                continue
+            sink.put((item, job))
+
+    def _upload_worker(self, source, sink):
+        while True:
+            entry = source.get()
+            if entry is _STOP:
+                return
+            item, job = entry
+            try:
+                self.upload(job)
+                self._record('processed')
+            except Exception as e:
+                print(f'[{datetime.now()}] Upload failed for {item}: {str(e)}')
+                self._record('failed', item, e)
+            finally:
+                self._finish(job)
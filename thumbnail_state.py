@@ -0,0 +1,122 @@
+"""
+Persistent state of thumbnail runs, stored in a local SQLite database.
+
+Every processed source video is recorded with the ETag, size and LastModified it had when
+its thumbnails were generated, the thumbnail keys written and the time spent in each stage.
+Later runs only process videos that are new, changed (different ETag) or not finished, so an
+interrupted run resumes where it stopped and replaced sources are detected as stale.
+
+`done_etag` only changes when every thumbnail of a video has been written, so a source whose
+regeneration failed or was interrupted is still stale on the next run.
+"""
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class ThumbnailState:
+    def __init__(self, path='thumbnail_state.db'):
+        """
+        Args:
+        - path (str): Location of the SQLite database file, created on first use.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS videos (
+                video_key TEXT PRIMARY KEY,
+                etag TEXT,
+                done_etag TEXT,
+                size INTEGER,
+                last_modified TEXT,
+                status TEXT,
+                thumbnail_keys TEXT,
+                timings TEXT,
+                error TEXT,
+                updated_at TEXT
+            )
+        ''')
+        # Databases created before done_etag existed: the ETag of finished videos is the one they were done with
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(videos)')]
+        if 'done_etag' not in columns:
+            self.connection.execute('ALTER TABLE videos ADD COLUMN done_etag TEXT')
+            self.connection.execute("UPDATE videos SET done_etag = etag WHERE status = 'done'")
+        self.connection.commit()
+
+    def get(self, video_key):
+        """
+        Returns the stored record of a video.
+
+        Returns:
+        - record (dict): Stored columns of the video, or None if it was never processed.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, done_etag, size, last_modified, status, thumbnail_keys, timings, error FROM videos WHERE video_key = ?',
+                (video_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        etag, done_etag, size, last_modified, status, thumbnail_keys, timings, error = row
+        return {
+            'video_key': video_key,
+            'etag': etag,
+            'done_etag': done_etag,
+            'size': size,
+            'last_modified': last_modified,
+            'status': status,
+            'thumbnail_keys': json.loads(thumbnail_keys or '[]'),
+            'timings': json.loads(timings or '{}'),
+            'error': error
+        }
+
+    def needs_processing(self, video_key, etag):
+        """Returns True unless the video was already finished with the same ETag."""
+        record = self.get(video_key)
+        return record is None or record['status'] != 'done' or record['done_etag'] != etag
+
+    def is_stale(self, video_key, etag):
+        """
+        Returns True if the video was finished before but its source has been replaced since, even if
+        a later attempt at the new source started and failed.
+        """
+        record = self.get(video_key)
+        return record is not None and record['done_etag'] is not None and record['done_etag'] != etag
+
+    def _upsert(self, video_key, **columns):
+        columns['updated_at'] = datetime.now().isoformat()
+        names = ', '.join(columns)
+        placeholders = ', '.join('?' for _ in columns)
+        updates = ', '.join(f'{name} = excluded.{name}' for name in columns)
+        with self.lock:
+            self.connection.execute(
+                f'INSERT INTO videos (video_key, {names}) VALUES (?, {placeholders}) '
+                f'ON CONFLICT(video_key) DO UPDATE SET {updates}',
+                (video_key, *columns.values())
+            )
+            self.connection.commit()
+
+    def mark_started(self, video_key, etag, size, last_modified):
+        """
+        Records that a video is being processed; it is retried if the run stops before it is done.
+        done_etag is left as it is until mark_done.
+        """
+        self._upsert(video_key, etag=etag, size=size, last_modified=str(last_modified), status='started', error=None)
+
+    def mark_done(self, video_key, etag, size, last_modified, thumbnail_keys, timings=None):
+        """Records that every thumbnail of a video exists for the given ETag."""
+        self._upsert(
+            video_key, etag=etag, done_etag=etag, size=size, last_modified=str(last_modified), status='done',
+            thumbnail_keys=json.dumps(thumbnail_keys), timings=json.dumps(timings or {}), error=None
+        )
+
+    def mark_failed(self, video_key, error):
+        """Records the error of a failed video so the next run retries it."""
+        self._upsert(video_key, status='failed', error=str(error))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
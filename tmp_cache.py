@@ -0,0 +1,200 @@
+"""
+Cache of source videos in the Lambda `/tmp` scratch space, kept across warm invocations.
+
+Videos are keyed by bucket, key and ETag, so a replaced source is never served from the cache.
+Every entry is a (possibly sparse) file written by `fetch_video` and remembers which time
+frames it can decode:
+- a request for time frames that are already covered skips S3 entirely;
+- a request for new time frames of the same video only fetches the missing ranges into the
+  same file.
+
+The cache keeps the disk usage of its files under `max_bytes` by evicting the least recently
+used entries. By default the budget is the SOURCE_CACHE_MAX_BYTES environment variable, or the size
+of the file system holding the cache (512 MB of /tmp by default on Lambda) minus `headroom`, the
+room a render still needs next to the cache. Entries are handed out with a context manager and are never evicted while in use,
+so the cache is safe to share between the threads of one process. `make_room` evicts unused
+entries early when a caller needs the space for new work.
+
+Files of the directory that no cache of this process knows, left over by a process that ended,
+are removed once they are older than `ORPHAN_AGE`: a younger one may belong to another process
+using the same directory. Caches of one process may share a directory.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from s3_range_fetch import SEEK_MARGIN, fetch_video, parse_timestamp
+
+# Environment variable overriding the default budget of the cache, in bytes
+MAX_BYTES_VARIABLE = 'SOURCE_CACHE_MAX_BYTES'
+
+# Room left on the file system for the scratch files of a render when the budget is derived from its size
+RENDER_HEADROOM = 256 * 1024 ** 2
+
+# Seconds after which an unknown file of the cache directory is a leftover, longer than a Lambda invocation can last
+ORPHAN_AGE = 15 * 60
+
+# Paths of the entries of every cache of this process, so caches sharing a directory keep each other's files
+_known_paths = set()
+_known_paths_lock = threading.Lock()
+
+
+def default_max_bytes(cache_dir, headroom=RENDER_HEADROOM):
+    """Returns the budget of a cache: SOURCE_CACHE_MAX_BYTES, or the size of its file system minus `headroom`."""
+    if os.environ.get(MAX_BYTES_VARIABLE):
+        return int(os.environ[MAX_BYTES_VARIABLE])
+    return max(shutil.disk_usage(cache_dir).total - headroom, 0)
+
+
+class SourceVideoCache:
+    def __init__(self, cache_dir='/tmp/source-cache', max_bytes=None, headroom=RENDER_HEADROOM):
+        """
+        Args:
+        - cache_dir (str): Directory of the cached videos. Leftovers from another process are
+          removed once older than ORPHAN_AGE, their coverage is unknown.
+        - max_bytes (int): Disk usage allowed for the cached videos; None uses `default_max_bytes`.
+        - headroom (int): Bytes of the file system left for renders when max_bytes is None.
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # Least recently used first
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = default_max_bytes(cache_dir, headroom) if max_bytes is None else max_bytes
+        self._prune_orphans()
+
+    def _name(self, bucket_name, video_key, etag):
+        return hashlib.sha256(f'{bucket_name}/{video_key}/{etag}'.encode()).hexdigest()[:32]
+
+    def _entry(self, bucket_name, video_key, etag):
+        """Returns the entry of a video version, creating it and dropping older versions."""
+        name = self._name(bucket_name, video_key, etag)
+        entry = self.entries.get(name)
+        if entry is None:
+            for stale_name, stale in list(self.entries.items()):
+                if stale['source'] == (bucket_name, video_key) and stale['users'] == 0:
+                    self._remove(stale_name)
+            extension = os.path.splitext(video_key)[1]
+            entry = {
+                'source': (bucket_name, video_key),
+                'path': os.path.join(self.cache_dir, f'{name}{extension}'),
+                'windows': set(),  # (seconds, margin) that can be decoded
+                'complete': False,
+                'bytes': 0,
+                'users': 0,
+                'lock': threading.Lock()
+            }
+            self.entries[name] = entry
+            with _known_paths_lock:
+                _known_paths.add(entry['path'])
+        self.entries.move_to_end(name)
+        return entry
+
+    def _remove(self, name):
+        entry = self.entries.pop(name)
+        with _known_paths_lock:
+            _known_paths.discard(entry['path'])
+        if os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+    def _prune_orphans(self):
+        """Removes the files of the directory no cache of this process knows, once older than ORPHAN_AGE."""
+        threshold = time.time() - ORPHAN_AGE
+        with _known_paths_lock:
+            known = set(_known_paths)
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                if path not in known and os.path.isfile(path) and os.stat(path).st_mtime < threshold:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """Removes least recently used entries until the cache fits in its budget."""
+        total = sum(entry['bytes'] for entry in self.entries.values())
+        if total > self.max_bytes:
+            self._prune_orphans()
+        for name, entry in list(self.entries.items()):
+            if total <= self.max_bytes:
+                break
+            if entry['users'] == 0:
+                total -= entry['bytes']
+                self._remove(name)
+
+    def covers(self, bucket_name, video_key, etag, time_frames, margin=SEEK_MARGIN):
+        """True when the cached copy of a video version can already decode `time_frames`, nothing would be fetched."""
+        with self.lock:
+            entry = self.entries.get(self._name(bucket_name, video_key, etag))
+            if entry is None:
+                return False
+            return entry['complete'] or all((parse_timestamp(frame), margin) in entry['windows'] for frame in time_frames)
+
+    def make_room(self, free_bytes):
+        """
+        Evicts least recently used entries that are not in use until the file system of the cache
+        has `free_bytes` free, or nothing more can be evicted.
+
+        Returns:
+        - free (int): Bytes free on the file system afterwards.
+        """
+        with self.lock:
+            free = shutil.disk_usage(self.cache_dir).free
+            for name, entry in list(self.entries.items()):
+                if free >= free_bytes:
+                    break
+                if entry['users'] == 0:
+                    self._remove(name)
+                    free = shutil.disk_usage(self.cache_dir).free
+        return free
+
+    @contextmanager
+    def open(self, s3, bucket_name, video_key, time_frames, margin=SEEK_MARGIN, head=None):
+        """
+        Yields the local path of a video that can decode `time_frames`, fetching what is missing.
+
+        Args:
+        - s3 (botocore client): S3 client used for the requests.
+        - bucket_name (str): S3 bucket name where the video is stored.
+        - video_key (str): Key name of the video file in the S3 bucket.
+        - time_frames (list): Time frames that will be extracted from the file.
+        - margin (float): Seconds around each time frame that must be decodable.
+        - head (dict): head_object response of the video when the caller already has it.
+        """
+        if head is None:
+            head = s3.head_object(Bucket=bucket_name, Key=video_key)
+        with self.lock:
+            entry = self._entry(bucket_name, video_key, head['ETag'])
+            entry['users'] += 1
+        try:
+            with entry['lock']:
+                missing = [
+                    frame for frame in time_frames
+                    if not entry['complete'] and (parse_timestamp(frame), margin) not in entry['windows']
+                ]
+                if missing:
+                    try:
+                        bytes_fetched = fetch_video(
+                            s3, bucket_name, video_key, entry['path'], missing, margin,
+                            object_size=head['ContentLength'], update=bool(entry['windows'])
+                        )
+                    except Exception:
+                        entry['windows'].clear()
+                        raise
+                    entry['complete'] = bytes_fetched >= head['ContentLength']
+                    entry['windows'].update((parse_timestamp(frame), margin) for frame in missing)
+                    # Blocks actually allocated, the file is sparse
+                    entry['bytes'] = os.stat(entry['path']).st_blocks * 512
+                else:
+                    print(f'Using cached copy of {video_key} for time frames {time_frames}')
+            with self.lock:
+                self._evict()
+            yield entry['path']
+        finally:
+            with self.lock:
+                entry['users'] -= 1
+                self._evict()
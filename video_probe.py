@@ -0,0 +1,271 @@
+"""
+Probes a video once for its duration, stream info and keyframe index and plans fast seeks from it.
+
+It performs the following steps:
+1. Reads the duration, start time and video stream info with ffprobe (headers only, nothing
+   is decoded). PyAV is used instead when the ffprobe binary is not available.
+2. Reads the keyframe index from the MP4 sample tables (stss) of the local file, which costs
+   no reads of the media data. Other containers list their packets with ffprobe.
+3. Caches the result by bucket, key and ETag, in memory and optionally as JSON files, so every
+   version of a source is probed only once.
+
+`seek_arguments` turns a probe and a time frame into FFmpeg arguments: an input-side seek to
+the keyframe at or before the time frame, followed by an output-side seek that decodes only
+the frames between that keyframe and the time frame. Time frames past the end of the video
+are clamped like everywhere else (see s3_range_fetch.clamp_seconds).
+
+Dependencies:
+- ffprobe, or av (PyAV) as a fallback
+"""
+
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import threading
+from bisect import bisect_right
+
+try:
+    import av
+except ImportError:
+    av = None
+
+from s3_range_fetch import clamp_seconds, parse_timestamp, parse_video_track
+
+
+def read_local_moov(video_path):
+    """Returns the moov atom of a local MP4 file, or None when the file has no readable moov."""
+    with open(video_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, box_type = struct.unpack_from('>I4s', header)
+            if size == 1:
+                size = struct.unpack_from('>Q', header, 8)[0]
+            elif size == 0:
+                size = file_size - offset
+            if size < 8:
+                return None
+            if box_type == b'moov':
+                f.seek(offset)
+                return f.read(size)
+            offset += size
+    return None
+
+
+def mp4_index(video_path):
+    """
+    Reads the duration and keyframe times of the video track from the MP4 sample tables.
+
+    Returns:
+    - (duration, keyframes) (tuple): Duration and keyframe times in seconds from the start of the
+      track, or None when the file is not an MP4 the sample tables can be read from.
+    """
+    try:
+        moov = read_local_moov(video_path)
+        if moov is None:
+            return None
+        track = parse_video_track(moov)
+    except (ValueError, KeyError, struct.error, StopIteration):
+        return None
+    times, timescale = track['times'], track['timescale']
+    if not times:
+        return None
+    duration = track['duration']
+    if not duration:
+        # The last sample lasts as long as the one before it
+        last_delta = times[-1] - times[-2] if len(times) > 1 else 0
+        duration = (times[-1] + last_delta) / timescale
+    return duration, [times[index] / timescale for index in track['keyframes']]
+
+
+def parse_frame_rate(rate):
+    """Converts an FFmpeg rate such as '30000/1001' to frames per second."""
+    numerator, _, denominator = str(rate).partition('/')
+    try:
+        value = float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return value or None
+
+
+def probe_with_ffprobe(video_path, ffprobe_path='ffprobe', list_packets=False):
+    """
+    Runs ffprobe once on the video.
+
+    Args:
+    - video_path (str): Local path of the video.
+    - ffprobe_path (str): ffprobe binary.
+    - list_packets (bool): Also list the video packets to find the keyframes, which reads the
+      whole file. Only needed when the container has no index that can be read directly.
+    """
+    entries = 'format=duration,start_time:stream=codec_name,width,height,avg_frame_rate'
+    if list_packets:
+        entries += ':packet=pts_time,flags'
+    ffprobe_command = [
+        ffprobe_path, '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', entries, '-of', 'json', video_path
+    ]
+    result = subprocess.run(ffprobe_command, check=True, capture_output=True)
+    output = json.loads(result.stdout)
+
+    video_format = output.get('format', {})
+    stream = (output.get('streams') or [{}])[0]
+    start_time = float(video_format.get('start_time') or 0)
+    probe = {
+        'duration': float(video_format['duration']) if video_format.get('duration') else None,
+        'start_time': start_time,
+        'codec': stream.get('codec_name'),
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'frame_rate': parse_frame_rate(stream.get('avg_frame_rate')),
+        'keyframes': None
+    }
+    if list_packets:
+        probe['keyframes'] = sorted(
+            float(packet['pts_time']) - start_time for packet in output.get('packets', [])
+            if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')
+        )
+    return probe
+
+
+def probe_with_pyav(video_path, list_packets=False):
+    """Same as probe_with_ffprobe, in-process with PyAV (packets are demuxed, never decoded)."""
+    if av is None:
+        raise ImportError('Neither ffprobe nor PyAV is available to probe the video.')
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        start_time = container.start_time / av.time_base if container.start_time else 0.0
+        probe = {
+            'duration': container.duration / av.time_base if container.duration else None,
+            'start_time': start_time,
+            'codec': stream.codec_context.name,
+            'width': stream.codec_context.width,
+            'height': stream.codec_context.height,
+            'frame_rate': float(stream.average_rate) if stream.average_rate else None,
+            'keyframes': None
+        }
+        if list_packets:
+            probe['keyframes'] = sorted(
+                float(packet.pts * stream.time_base) - start_time for packet in container.demux(stream)
+                if packet.is_keyframe and packet.pts is not None
+            )
+    return probe
+
+
+def probe_video(video_path, ffprobe_path='ffprobe'):
+    """
+    Probes the duration, stream info and keyframe index of a local video.
+
+    Returns:
+    - probe (dict): duration and start_time (seconds), codec, width, height, frame_rate and the
+      sorted keyframe times in seconds from the start of the video.
+    """
+    index = mp4_index(video_path)
+    try:
+        probe = probe_with_ffprobe(video_path, ffprobe_path, list_packets=index is None)
+    except FileNotFoundError:
+        if av is None and index is not None:
+            # Neither ffprobe nor PyAV, the MP4 index alone still gives the duration and keyframes
+            probe = {'duration': index[0], 'start_time': 0.0, 'codec': None, 'width': None, 'height': None, 'frame_rate': None}
+        else:
+            probe = probe_with_pyav(video_path, list_packets=index is None)
+    if index is not None:
+        probe['keyframes'] = index[1]
+        if not probe['duration']:
+            probe['duration'] = index[0]
+    return probe
+
+
+def plan_seek(probe, frame):
+    """
+    Works out how to reach a time frame quickly.
+
+    Returns:
+    - (seconds, keyframe) (tuple): The time frame clamped to the video and the time of the
+      keyframe at or before it, both in seconds.
+    """
+    seconds = parse_timestamp(frame)
+    if not probe:
+        return seconds, seconds
+    seconds = clamp_seconds(seconds, probe.get('duration'))
+    keyframes = probe.get('keyframes') or []
+    index = bisect_right(keyframes, seconds) - 1
+    keyframe = keyframes[index] if index >= 0 else 0.0
+    return seconds, keyframe
+
+
+def seek_arguments(probe, frame):
+    """
+    Returns the FFmpeg arguments that put the output at `frame`.
+
+    Args:
+    - probe (dict): Result of probe_video, or None to let FFmpeg seek on its own.
+    - frame (str): Requested time frame.
+
+    Returns:
+    - (input_args, output_args) (tuple): Arguments for before and after `-i`. The input side jumps
+      to the keyframe without decoding, the output side decodes from there up to the time frame.
+    """
+    if not probe:
+        return ['-ss', str(frame)], []
+    seconds, keyframe = plan_seek(probe, frame)
+    input_args = ['-ss', f'{keyframe:.3f}', '-noaccurate_seek']
+    # Output timestamps start at the input seek point, so the offset is relative to the keyframe
+    output_args = ['-ss', f'{seconds - keyframe:.3f}'] if seconds > keyframe else []
+    return input_args, output_args
+
+
+class ProbeCache:
+    def __init__(self, cache_dir=None, ffprobe_path='ffprobe'):
+        """
+        Args:
+        - cache_dir (str): Directory of the JSON probe cache shared between runs, memory only when None.
+        - ffprobe_path (str): ffprobe binary.
+        """
+        self.cache_dir = cache_dir
+        self.ffprobe_path = ffprobe_path
+        self.lock = threading.Lock()
+        self.probes = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_name(self, bucket_name, video_key, etag):
+        name = hashlib.sha256(f'{bucket_name}/{video_key}'.encode()).hexdigest()[:32]
+        etag = etag.strip('"')
+        return f'{name}-{etag}'
+
+    def get(self, video_path, bucket_name, video_key, etag):
+        """
+        Returns the probe of a video version, probing the local file only the first time.
+
+        Args:
+        - video_path (str): Local (possibly sparse) copy of the video.
+        - bucket_name, video_key (str): Source of the video.
+        - etag (str): ETag of the source, None probes without caching.
+        """
+        if not etag:
+            return probe_video(video_path, self.ffprobe_path)
+        name = self.cache_name(bucket_name, video_key, etag)
+        with self.lock:
+            if name in self.probes:
+                return self.probes[name]
+        path = os.path.join(self.cache_dir, f'{name}.json') if self.cache_dir else None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                probe = json.load(f)
+        else:
+            probe = probe_video(video_path, self.ffprobe_path)
+            print(f'Probed {video_key}: {probe["duration"]}s, {len(probe["keyframes"])} keyframes')
+            if path:
+                # Write then rename so an interrupted run never leaves a partial cache entry
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(probe, f)
+                os.replace(tmp_path, path)
+        with self.lock:
+            self.probes[name] = probe
+        return probe